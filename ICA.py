@@ -1,9 +1,106 @@
 from __future__ import print_function
 
 import numpy as np
+import time
 from sklearn.decomposition import FastICA
+from tools import delay_embedding, matcorr, select_chunks, RunningMoments
 
-def instICA(X, n_comp='all', n_chunks=1, chunk_size=None):
+def fastica_restart(filename, shape, dtype, n_comp, seed, max_iter=200, tol=1e-4, kurt_thresh=0.7, skew_thresh=0.5,
+                    chunk_size=100000):
+    """Fits FastICA from the random initialization seed on the (samples x features) memmap in filename and scores
+    the solution by the skewness and kurtosis of its sources: sum of |skewness| of the sources with
+    |skewness| >= skew_thresh plus sum of kurtosis of the sources with kurtosis >= kurt_thresh (the criteria of
+    tools.clean_sources).
+
+    Returns
+    -------
+    score, W (components_), A (mixing_), mean (mean_), number of iterations
+
+    """
+    X = np.memmap(filename, dtype=dtype, mode='r', shape=shape)
+    ica = FastICA(n_components=n_comp, random_state=seed, max_iter=max_iter, tol=tol)
+    ica.fit(X)
+
+    moments = RunningMoments(n_comp)
+    for start in range(0, shape[0], chunk_size):
+        moments.update(np.matmul(ica.components_, np.transpose(X[start:start + chunk_size] - ica.mean_)))
+    sk = np.abs(moments.skew())
+    ku = moments.kurtosis()
+    score = np.sum(sk[sk >= skew_thresh]) + np.sum(ku[ku >= kurt_thresh])
+
+    return score, ica.components_, ica.mixing_, ica.mean_, ica.n_iter_
+
+
+def fastica_restarts(X, n_comp, n_restarts=4, nprocesses=None, seed=None, max_iter=200, tol=1e-4,
+                     kurt_thresh=0.7, skew_thresh=0.5, tmp_folder=None):
+    """Runs FastICA from n_restarts random initializations in a process pool and keeps the solution with the
+    highest skewness/kurtosis score (see fastica_restart). X is written once to a memmap shared by the processes.
+
+    Parameters
+    ----------
+    X : np.array
+        2d array of analog signals (N x T)
+    n_comp : int
+             number of ICA components
+    n_restarts : int
+                 number of random initializations
+    nprocesses : int
+                 number of processes (default -> min(n_restarts, number of cpus)). If 1, restarts run sequentially
+    seed : int
+           random seed of the initializations
+    max_iter, tol : FastICA parameters
+    kurt_thresh, skew_thresh : thresholds of the score (as in tools.clean_sources)
+    tmp_folder : folder of the temporary memmap (default -> system temporary folder)
+
+    Returns
+    -------
+    W : unmixing matrix (components_) of the best restart
+    A : mixing matrix (mixing_) of the best restart
+    mean : mean removed before unmixing
+    scores : scores of all restarts
+
+    """
+    import os
+    import tempfile
+    import multiprocessing
+
+    seeds = np.random.RandomState(seed).randint(2 ** 31 - 1, size=n_restarts)
+    shape = (X.shape[1], X.shape[0])
+    dtype = np.dtype(X.dtype).str
+    fd, filename = tempfile.mkstemp(suffix='.dat', dir=tmp_folder)
+    os.close(fd)
+    try:
+        X_mmap = np.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+        X_mmap[:] = np.transpose(X)
+        X_mmap.flush()
+        del X_mmap
+
+        args = [(filename, shape, dtype, n_comp, s, max_iter, tol, kurt_thresh, skew_thresh) for s in seeds]
+        if nprocesses is None:
+            nprocesses = np.min([n_restarts, multiprocessing.cpu_count()])
+        if nprocesses > 1:
+            pool = multiprocessing.Pool(nprocesses)
+            try:
+                results = [pool.apply_async(fastica_restart, arg) for arg in args]
+                fits = [result.get() for result in results]
+            finally:
+                # all results are collected (or a worker raised): stop the workers so they do not outlive the call
+                pool.terminate()
+                pool.join()
+        else:
+            fits = [fastica_restart(*arg) for arg in args]
+    finally:
+        os.remove(filename)
+
+    scores = np.array([fit[0] for fit in fits])
+    best = fits[int(np.argmax(scores))]
+    print('FastICA restarts scores: ', np.round(scores, 2), ' best: ', int(np.argmax(scores)))
+
+    return best[1], best[2], best[3], scores
+
+
+def instICA(X, n_comp='all', n_chunks=1, chunk_size=None, chunk_mode='random', threshold=5, noise_fraction=0.2,
+            seed=None, project_size=100000, n_restarts=1, nprocesses=None, sources_file=None):
     """Performs instantaneous ICA.
 
     Parameters
@@ -12,10 +109,34 @@ def instICA(X, n_comp='all', n_chunks=1, chunk_size=None):
         2d array of analog signals (N x T)
     n_comp : int or 'all'
              number of ICA components
+    n_chunks : int
+               if > 1, FastICA is fit on n_chunks non-overlapping chunks of chunk_size samples (see
+               tools.select_chunks)
+    chunk_size : int
+                 number of samples per chunk
+    chunk_mode : 'random' or 'activity'
+                 uniform chunk placement or chunks around threshold crossings plus a noise fraction
+    threshold : float
+                threshold (in robust standard deviations) of the 'activity' chunk selection
+    noise_fraction : float
+                     fraction of random (noise) chunks in 'activity' mode
+    seed : int
+           random seed of the chunk selection
+    project_size : int
+                   number of samples projected at a time on the sources
+    n_restarts : int
+                 if > 1, FastICA is run from n_restarts random initializations in parallel and the solution with
+                 the highest source skewness/kurtosis is kept (see fastica_restarts)
+    nprocesses : int
+                 number of processes for the restarts
+    sources_file : str
+                   if given, sources are written to a memmapped .npy file (X can be a memmap, e.g.
+                   np.load('recordings.npy', mmap_mode='r'): only the chunks are loaded in memory). Requires
+                   n_chunks > 1
 
     Returns
     -------
-    sources : sources
+    sources : sources, with the floating point type of X (float64 for integer X). Memmap if sources_file is given
     A : mixing matrix
     W : unmixing matrix
 
@@ -27,42 +148,150 @@ def instICA(X, n_comp='all', n_chunks=1, chunk_size=None):
 
     n_obs = X.shape[1]
 
+    if sources_file is not None and n_chunks <= 1:
+        raise AttributeError('Out-of-core ICA (sources_file) requires n_chunks > 1 and chunk_size: FastICA on the '
+                             'whole recording loads it in memory')
+
     if n_chunks > 1:
         if chunk_size is None:
             raise AttributeError('Chunk size (n_samples) is required')
         else:
-            assert chunk_size*n_chunks < n_obs
-            chunk_init = []
-            idxs = []
-            for c in range(n_chunks):
-                proceed = False
-                i = 0
-                while not proceed and i<1000:
-                    c_init = np.random.randint(n_obs-n_chunks-1)
-                    proceed = True
-                    for prev_c in chunk_init:
-                        if c_init > prev_c and c_init < c_init + chunk_size:
-                            proceed = False
-                            i += 1
-                            print('failed ', i)
-
-                idxs.extend(range(c_init, c_init + chunk_size))
-
+            idxs = select_chunks(X, n_chunks, chunk_size, mode=chunk_mode, threshold=threshold,
+                                 noise_fraction=noise_fraction, seed=seed)
             X_reduced = X[:, idxs]
-            print(X_reduced.shape)
     else:
         X_reduced = X
 
     print(n_comp)
 
-    ica = FastICA(n_components=n_comp) #, algorithm='deflation')
-    ica.fit(np.transpose(X_reduced))
-    sources = np.transpose(ica.transform(np.transpose(X)))
-    A = np.transpose(ica.mixing_)
-    W = ica.components_
+    if n_restarts > 1:
+        W, mixing, mean, _ = fastica_restarts(X_reduced, n_comp, n_restarts=n_restarts, nprocesses=nprocesses,
+                                              seed=seed)
+    else:
+        ica = FastICA(n_components=n_comp) #, algorithm='deflation')
+        ica.fit(np.transpose(X_reduced))
+        W, mixing, mean = ica.components_, ica.mixing_, ica.mean_
+    A = np.transpose(mixing)
+
+    # the recording is centered and projected in chunks (no transposed copy of the whole recording)
+    if np.issubdtype(X.dtype, np.floating):
+        dtype = X.dtype
+    else:
+        dtype = np.float64
+    if sources_file is not None:
+        sources = np.lib.format.open_memmap(sources_file, mode='w+', dtype=dtype, shape=(n_comp, n_obs))
+    else:
+        sources = np.zeros((n_comp, n_obs), dtype=dtype)
+    for start in range(0, n_obs, project_size):
+        sources[:, start:start + project_size] = np.matmul(W, X[:, start:start + project_size] -
+                                                           mean[:, np.newaxis])
+    if sources_file is not None:
+        sources.flush()
 
     return sources, A, W
 
+def segICA(X, n_comp='all', n_segments=4, warm_start=True, max_iter=200, tol=1e-4, seed=None, verbose=True):
+    """Performs instantaneous ICA segment-wise on a long recording.
+
+    Each time segment is whitened (PCA) and separated with FastICA, starting from the unmixing matrix of the
+    previous segment (warm_start), so that segments after the first converge in few iterations. Components are
+    tracked across segments by the correlation of their mixing vectors (matcorr): the components of each segment
+    are permuted and sign-flipped to match the previous segment, and the sources are concatenated.
+
+    Parameters
+    ----------
+    X : np.array
+        2d array of analog signals (N x T)
+    n_comp : int or 'all'
+             number of ICA components
+    n_segments : int
+                 number of time segments
+    warm_start : bool
+                 if True, FastICA of a segment starts from the unmixing matrix of the previous segment,
+                 otherwise from a random matrix
+    max_iter : int
+               maximum number of FastICA iterations per segment
+    tol : float
+          FastICA tolerance
+    seed : int
+           random seed of the initialization of the first (or, if not warm_start, every) segment
+    verbose : bool
+
+    Returns
+    -------
+    sources : sources (tracked components concatenated over segments)
+    A : mixing matrix of the last segment
+    W : unmixing matrix of the last segment
+    info : dict with per segment 'bounds' (sample ranges), 'A' and 'W' (n_segments x n_comp x N), 'corr' (mixing
+           vector correlation of each tracked component with the previous segment), 'n_iter' and 'time' (s)
+
+    """
+    if n_comp == 'all' or n_comp is None:
+        n_comp = X.shape[0]
+    else:
+        n_comp = int(n_comp)
+
+    n_obs = X.shape[1]
+    bounds = np.linspace(0, n_obs, n_segments + 1).astype(int)
+    rng = np.random.RandomState(seed)
+
+    sources = np.zeros((n_comp, n_obs))
+    info = {'bounds': np.array([bounds[:-1], bounds[1:]]).T, 'A': [], 'W': [], 'corr': [], 'n_iter': [],
+            'time': []}
+    W = None
+    for seg, (start, stop) in enumerate(info['bounds']):
+        t_start = time.time()
+        X_seg = X[:, start:stop]
+        means = np.mean(X_seg, axis=1, keepdims=True)
+        X_seg = X_seg - means
+
+        # PCA whitening of the segment: (n_comp x N) sphere
+        eigvals, eigvecs = np.linalg.eigh(np.cov(X_seg))
+        eigvals, eigvecs = eigvals[::-1][:n_comp], eigvecs[:, ::-1][:, :n_comp]
+        sphere = np.matmul(np.diag(1. / np.sqrt(eigvals)), eigvecs.T)
+        X_white = np.matmul(sphere, X_seg)
+
+        if warm_start and W is not None:
+            # previous unmixing expressed in the whitened space of this segment
+            w_init = np.matmul(W, np.linalg.pinv(sphere))
+        else:
+            w_init = rng.randn(n_comp, n_comp)
+
+        ica = FastICA(n_components=n_comp, whiten=False, w_init=w_init, max_iter=max_iter, tol=tol)
+        ica.fit(np.transpose(X_white))
+        W_seg = np.matmul(ica.components_, sphere)
+        A_seg = np.linalg.pinv(W_seg)
+
+        if W is None:
+            corr = np.ones(n_comp)
+        else:
+            # match mixing vectors of this segment to the previous one (permutation and sign)
+            corr_match, indx, indy, _ = matcorr(np.transpose(np.linalg.pinv(W)), np.transpose(A_seg))
+            order = np.zeros(n_comp, dtype=int)
+            order[indx] = indy
+            corr = np.zeros(n_comp)
+            corr[indx] = corr_match
+            W_seg = np.sign(corr)[:, np.newaxis] * W_seg[order]
+            A_seg = np.linalg.pinv(W_seg)
+            corr = np.abs(corr)
+
+        W = W_seg
+        sources[:, start:stop] = np.matmul(W, X_seg)
+        info['A'].append(np.transpose(A_seg))
+        info['W'].append(W)
+        info['corr'].append(corr)
+        info['n_iter'].append(ica.n_iter_)
+        info['time'].append(time.time() - t_start)
+        if verbose:
+            print('Segment ', seg + 1, '/', n_segments, ' iterations: ', ica.n_iter_, ' time: ',
+                  round(info['time'][-1], 2), ' s - average tracking correlation: ', round(np.mean(corr), 3))
+
+    for key in ['A', 'W', 'corr', 'n_iter', 'time']:
+        info[key] = np.array(info[key])
+    A = info['A'][-1]
+
+    return sources, A, W, info
+
 def iICAweights(weight, mea_dim=None, axis=None, cmap='viridis', style='mat', origin='lower'):
     import matplotlib.pyplot as plt
     if len(weight.shape) == 3:
@@ -113,13 +342,8 @@ def cICAemb(X, n_comp='all', L=3):
 
     """
     n_chan = X.shape[0]
-    X_block = np.zeros((L*n_chan, X.shape[1]-L))
-    for ch in range(n_chan):
-        for lag in range(L):
-            if lag == 0:
-                X_block[L * ch + lag, :] = X[ch, L-lag:]
-            else:
-                X_block[L * ch + lag, :] = X[ch, L - lag:-lag]
+    # one vectorized copy of the strided embedding (FastICA centers and whitens a private copy of its input anyway)
+    X_block = delay_embedding(X, L).reshape(L * n_chan, -1)
 
     if n_comp == 'all':
         n_comp = X_block.shape[0]
@@ -159,7 +383,7 @@ def cICAweights(weight, mea_dim=None, cmap='viridis', style='mat', origin='lower
         return axes, images
 
 
-def gFICA(X, dim, mode='time', n_comp='all'):
+def gFICA(X, dim, mode='time', n_comp='all', n_restarts=1, nprocesses=None, seed=None):
     """Performs instantaneous gradient-flow ICA described in:
 
     Stanacevic, M., Cauwenberghs, G., & Zweig, G. (2002, May).
@@ -175,6 +399,13 @@ def gFICA(X, dim, mode='time', n_comp='all'):
     mode : 'time' - 'space' - 'spacetime'
     n_comp : int or 'all'
              number of ICA components
+    n_restarts : int
+                 if > 1, FastICA is run from n_restarts random initializations in parallel and the solution with
+                 the highest source skewness/kurtosis is kept (see fastica_restarts)
+    nprocesses : int
+                 number of processes for the restarts
+    seed : int
+           random seed of the restarts
 
     Returns
     -------
@@ -215,10 +446,14 @@ def gFICA(X, dim, mode='time', n_comp='all'):
     if n_comp == 'all':
         n_comp = X_gf.shape[0]
 
-    ica = FastICA(n_components=n_comp)
-    sources = np.transpose(ica.fit_transform(np.transpose(X_gf)))
-    A = ica.mixing_
-    W = ica.components_
+    if n_restarts > 1:
+        W, A, mean, _ = fastica_restarts(X_gf, n_comp, n_restarts=n_restarts, nprocesses=nprocesses, seed=seed)
+        sources = np.matmul(W, X_gf - mean[:, np.newaxis])
+    else:
+        ica = FastICA(n_components=n_comp)
+        sources = np.transpose(ica.fit_transform(np.transpose(X_gf)))
+        A = ica.mixing_
+        W = ica.components_
 
     return sources, A, W
 
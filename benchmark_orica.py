@@ -0,0 +1,832 @@
+'''
+Benchmarks of the ORICA implementations on synthetic recordings
+'''
+from __future__ import print_function
+
+import numpy as np
+import os, sys
+from os.path import join
+import time
+
+import orICA as orica
+from numpy import linalg as la
+from scipy.linalg import sqrtm, eigh
+from tools import evaluate_PI, matcorr
+
+
+def generate_synthetic_recording(n_chans, n_samples, n_sources=None, seed=0):
+    '''
+    Mixes super-gaussian (laplacian) sources with a random mixing matrix.
+
+    Parameters
+    ----------
+    n_chans: number of channels
+    n_samples: number of samples
+    n_sources: number of sources (default -> n_chans)
+    seed: random seed
+
+    Returns
+    -------
+    recordings: (n_chans x n_samples)
+    mixing: (n_chans x n_sources)
+    sources: (n_sources x n_samples)
+
+    '''
+    if n_sources is None:
+        n_sources = n_chans
+    rng = np.random.RandomState(seed)
+    sources = rng.laplace(size=(n_sources, n_samples))
+    mixing = rng.randn(n_chans, n_sources)
+    recordings = np.matmul(mixing, sources)
+
+    return recordings, mixing, sources
+
+
+def load_recordings(folders, n_chans_list=(32, 128, 384), n_samples=60000):
+    '''
+    Returns (name, recordings, mixing) tuples from gtICA recording folders or, if no folder is given,
+    from synthetic recordings for each channel count.
+    '''
+    datasets = []
+    if len(folders) > 0:
+        for folder in folders:
+            recordings = np.load(join(folder, 'recordings.npy')).astype('float')
+            mixing = np.load(join(folder, 'mixing.npy')).T
+            datasets.append((os.path.split(os.path.abspath(folder))[-1], recordings, mixing))
+    else:
+        for n_chans in n_chans_list:
+            recordings, mixing, _ = generate_synthetic_recording(n_chans, n_samples, seed=n_chans)
+            datasets.append(('synthetic-' + str(n_chans), recordings, mixing))
+
+    return datasets
+
+
+def dense_orica_update(icaweights, blockdata, lambda_k, kurtsign):
+    '''ORICA block update with the dense diag(lambda_k / Q) product (implementation before the in-place kernel)'''
+    nChs, nPts = blockdata.shape
+    f = np.zeros((nChs, nPts))
+    y = np.matmul(icaweights, blockdata)
+    f[np.where(kurtsign == 1), :] = -2 * np.tanh(y[np.where(kurtsign == 1), :])
+    f[np.where(kurtsign == 0), :] = 2 * np.tanh(y[np.where(kurtsign == 0), :])
+    lambda_prod = np.prod(1. / (1. - lambda_k))
+    Q = 1 + lambda_k * (np.sum(f * y, axis=0) - 1)
+
+    return lambda_prod * (icaweights - np.matmul(np.matmul(np.matmul(y, np.diag(lambda_k / Q)), f.T), icaweights))
+
+
+def dense_whitening_update(icasphere, blockdata, lambda_avg):
+    '''RLS whitening update with v v^T computed for the fitness and twice for the update and the n x n x n product
+    (implementation before rls_whitening_update)'''
+    nPts = blockdata.shape[1]
+    v = np.matmul(icasphere, blockdata)
+    modelFitness = np.eye(len(icasphere)) - np.matmul(v, v.T) / nPts
+    QWhite = lambda_avg / (1 - lambda_avg) + np.trace(np.matmul(v, v.T)) / nPts
+    return 1 / lambda_avg * (icasphere - np.matmul(np.matmul(v, v.T) / nPts / QWhite, icasphere)), modelFitness
+
+
+def loop_adaptive_ff(lambda_pr, n_samples, gain, decay_rate_alpha):
+    '''Adaptive forgetting factors with the per-sample loop (implementation before orica_adaptive_ff)'''
+    lambda_ = np.zeros(n_samples)
+    lam_pr = lambda_pr
+    for i in range(n_samples):
+        lam_new = (1 + gain) * lam_pr - decay_rate_alpha * lam_pr ** 2
+        lambda_[i] = lam_new
+        lam_pr = lam_new
+    return lambda_
+
+
+def reference_orica_wa(data, rule='W', block_update=True, block=50, lambda_0=0.995, forgetfac='cooling', numpass=1):
+    '''ORICA_W / ORICA_A / ORICA_W_block / ORICA_A_block update loops before the consolidation onto ORICACore
+    (pre-whitening, supergaussian sources, no regularization). Returns the unmixing matrix.
+
+    The 'adaptive' forgetting factor raised an error before the consolidation: it is computed here as in ORICA, from
+    the leaky average of the block fitness, with the forgetting factors of orica_adaptive_ff (see benchmark_ff).'''
+    nChs, nPts = data.shape
+    sphere = 2.0 * la.inv(sqrtm(np.cov(data)))
+    data_w = np.matmul(sphere, data)
+    weights = np.eye(nChs)
+    kurtsign = np.ones((nChs, 1))
+    counter = 1
+    lambda_k = 0.1 * np.ones(block)
+    Rn = None
+    minNonStatIdx = -1
+
+    def adaptive_gain(ratioOfNormRn):
+        return 1e-3 * 0.5 * (1 + np.tanh((ratioOfNormRn - 5) / 1))
+
+    def orthogonalize(weights):
+        D, V = eigh(np.matmul(weights, weights.T))
+        return np.matmul(np.matmul(la.solve(np.diag((np.sqrt(np.abs(D)) * np.sign(D))).T, V.T).T, V.T), weights)
+
+    if block_update:
+        numBlock = int(np.floor(nPts / block))
+        for it in range(numpass):
+            for bi in range(numBlock):
+                dataRange = np.arange(int(np.floor(bi * nPts / numBlock)),
+                                      int(np.min([nPts, np.floor((bi + 1) * nPts / numBlock)])))
+                v = data_w[:, dataRange]
+                W = weights if rule == 'W' else weights.T
+                y = np.matmul(W, v)
+                f = np.zeros((nChs, len(dataRange)))
+                f[np.where(kurtsign == 1), :] = -2 * np.tanh(y[np.where(kurtsign == 1), :])
+                f[np.where(kurtsign == 0), :] = 2 * np.tanh(y[np.where(kurtsign == 0), :])
+                if forgetfac == 'cooling':
+                    lambda_k = lambda_0 / ((counter + dataRange) ** 0.6)
+                    counter = counter + len(dataRange)
+                elif forgetfac == 'constant':
+                    lambda_k = np.arange(len(dataRange)) * lambda_0
+                else:
+                    modelFitness = np.eye(nChs) + np.matmul(y, f.T) / len(dataRange)
+                    Rn = modelFitness if Rn is None else (1 - 0.01) * Rn + 0.01 * modelFitness
+                    nonStatIdx = la.norm(Rn)
+                    if minNonStatIdx == -1:
+                        minNonStatIdx = nonStatIdx
+                    minNonStatIdx = np.max([np.min([minNonStatIdx, nonStatIdx]), 1])
+                    lambda_k = orica.orica_adaptive_ff(lambda_k[-1], len(dataRange),
+                                                       adaptive_gain(nonStatIdx / minNonStatIdx), 0.02)
+                coeff = np.append(1, lambda_k) * np.append(1, np.cumprod(1 - lambda_k[::-1]))[::-1]
+                if rule == 'W':
+                    weights = coeff[0] * weights + np.matmul(f * coeff[1:], v.T)
+                else:
+                    weights = coeff[0] * weights + np.matmul(v * coeff[1:], f.T)
+                weights = orthogonalize(weights)
+    else:
+        if forgetfac == 'cooling':
+            lambda_k = lambda_0 / ((counter + np.arange(nPts)) ** 0.6)
+        elif forgetfac == 'constant':
+            lambda_k = np.arange(nPts) * lambda_0
+        else:
+            # no non-stationarity index before the per-sample updates
+            lambda_k = orica.orica_adaptive_ff(lambda_k[-1], nPts, adaptive_gain(1.), 0.02)
+        for it in range(numpass):
+            for bi in range(nPts):
+                W = weights if rule == 'W' else weights.T
+                v = np.expand_dims(data_w[:, bi], axis=1)
+                y = np.expand_dims(np.matmul(W, data_w[:, bi]), axis=1)
+                f = np.zeros((nChs, 1))
+                f[np.where(kurtsign == 1)] = -2 * np.tanh(y[np.where(kurtsign == 1)])
+                f[np.where(kurtsign == 0)] = 2 * np.tanh(y[np.where(kurtsign == 0)])
+                if rule == 'W':
+                    u = np.matmul(f, v.T)
+                else:
+                    u = np.matmul(v, f.T)
+                weights = (1 - lambda_k[bi]) * weights + lambda_k[bi] * u
+                if not np.mod(bi, block):
+                    weights = orthogonalize(weights)
+
+    if rule == 'W':
+        return np.matmul(weights, sphere)
+    return np.matmul(la.pinv(weights), sphere)
+
+
+class LoopFFORICA(orica.ORICA):
+    '''ORICA with the per-sample adaptive forgetting factor loop'''
+    def genAdaptiveFF(self, dataRange, lambda_in, ratioOfNormRn):
+        gainForErrors = self.adaptiveFF['upperBoundBeta'] * 0.5 * \
+                        (1 + np.tanh((ratioOfNormRn - self.adaptiveFF['transBandCenter']) /
+                                     self.adaptiveFF['transBandWidthGamma']))
+        return loop_adaptive_ff(lambda_in[-1], len(dataRange), gainForErrors, self.adaptiveFF['decayRateAlpha'])
+
+
+def benchmark_kernel(n_chans_list=(32, 128, 384), block=1000, n_blocks=20):
+    '''
+    Blocks/sec of the ORICA weight update: dense diagonal product (before) vs in-place column scaling (after).
+
+    Parameters
+    ----------
+    n_chans_list: channel counts to benchmark
+    block: block size (in samples)
+    n_blocks: number of blocks to time
+
+    Returns
+    -------
+    results: list of (n_chans, blocks/sec before, blocks/sec after, max abs difference)
+
+    '''
+    print('Kernel benchmark - block size: ', block)
+    print('n_chans\tbefore (blocks/s)\tafter (blocks/s)\tspeedup\tmax diff')
+    results = []
+    for n_chans in n_chans_list:
+        rng = np.random.RandomState(n_chans)
+        data = rng.laplace(size=(n_chans, block * n_blocks)) / np.sqrt(2)
+        kurtsign = np.ones((n_chans, 1))
+        nlsign = np.where(kurtsign == 1, -2., 2.)
+        lambda_k = 0.995 / (np.arange(1, block + 1) + 1000.) ** 0.6
+        icaweights = np.eye(n_chans)
+        buffers = orica.BlockBuffers()
+
+        t_start = time.time()
+        for bi in range(n_blocks):
+            w_before = dense_orica_update(icaweights, data[:, bi * block:(bi + 1) * block], lambda_k, kurtsign)
+        t_before = time.time() - t_start
+
+        t_start = time.time()
+        for bi in range(n_blocks):
+            y, f = orica.orica_sources(icaweights, data[:, bi * block:(bi + 1) * block], nlsign, buffers)
+            w_after = orica.orica_weight_update(icaweights, y, f, lambda_k, buffers)
+        t_after = time.time() - t_start
+
+        max_diff = np.max(np.abs(w_before - w_after))
+        results.append((n_chans, n_blocks / t_before, n_blocks / t_after, max_diff))
+        print(n_chans, '\t', round(n_blocks / t_before, 2), '\t\t\t', round(n_blocks / t_after, 2), '\t\t\t',
+              round(t_before / t_after, 2), '\t', max_diff)
+
+    return results
+
+
+def benchmark_whitening(n_chans=128, block_list=(4, 8, 16, 32, 64, 128, 512), n_blocks=200, lambda_avg=0.995):
+    '''
+    Blocks/sec of the online RLS whitening update: before (v v^T computed three times, n x n x n product) vs
+    rls_whitening_update without (evalconverg off) and with (evalconverg on) the whitening fitness.
+
+    Parameters
+    ----------
+    n_chans: number of channels
+    block_list: block sizes (in samples)
+    n_blocks: number of blocks to time
+    lambda_avg: block forgetting factor (1 - lambda)
+
+    Returns
+    -------
+    results: list of (block, blocks/sec before, blocks/sec after, blocks/sec after with fitness, max abs difference)
+
+    '''
+    print('Whitening benchmark - channels: ', n_chans)
+    print('block\tbefore (blocks/s)\tafter (blocks/s)\tafter + fitness (blocks/s)\tmax diff')
+    results = []
+    for block in block_list:
+        rng = np.random.RandomState(block)
+        data = rng.randn(n_chans, block * n_blocks)
+
+        sphere_before = np.eye(n_chans)
+        t_start = time.time()
+        for bi in range(n_blocks):
+            sphere_before, _ = dense_whitening_update(sphere_before, data[:, bi * block:(bi + 1) * block],
+                                                      lambda_avg)
+        t_before = time.time() - t_start
+
+        sphere_after = np.eye(n_chans)
+        t_start = time.time()
+        for bi in range(n_blocks):
+            v = np.matmul(sphere_after, data[:, bi * block:(bi + 1) * block])
+            sphere_after = orica.rls_whitening_update(sphere_after, v, lambda_avg)
+        t_after = time.time() - t_start
+
+        sphere_fit = np.eye(n_chans)
+        t_start = time.time()
+        for bi in range(n_blocks):
+            v = np.matmul(sphere_fit, data[:, bi * block:(bi + 1) * block])
+            cov = np.matmul(v, v.T)
+            modelFitness = np.eye(n_chans) - cov / block
+            sphere_fit = orica.rls_whitening_update(sphere_fit, v, lambda_avg, cov)
+        t_fit = time.time() - t_start
+
+        max_diff = np.max([np.max(np.abs(sphere_before - sphere_after)), np.max(np.abs(sphere_before - sphere_fit))])
+        results.append((block, n_blocks / t_before, n_blocks / t_after, n_blocks / t_fit, max_diff))
+        print(block, '\t', round(n_blocks / t_before, 2), '\t\t\t', round(n_blocks / t_after, 2), '\t\t\t',
+              round(n_blocks / t_fit, 2), '\t\t\t', max_diff)
+
+    return results
+
+
+def benchmark_core(datasets, block=50, n_samples_sample=20000,
+                   forgetfacs=(('cooling', 0.995), ('constant', 1e-5), ('adaptive', 0.995)), tol=1e-10):
+    '''
+    Throughput of ORICA_W, ORICA_A, ORICA_W_block and ORICA_A_block (ORICACore) and max abs difference of the
+    unmixing matrix from the update loops before the consolidation (reference_orica_wa). Fails if the difference
+    relative to the largest reference entry exceeds tol.
+
+    Parameters
+    ----------
+    datasets: list of (name, recordings, mixing) (see load_recordings)
+    block: block size (in samples) of the block updates and orthogonalization interval of the per-sample updates
+    n_samples_sample: number of samples used for the per-sample variants
+    forgetfacs: (forgetting factor profile, lambda_0) pairs (lambda_0 is not used by 'adaptive')
+    tol: tolerance on the relative max difference
+
+    Returns
+    -------
+    results: list of (name, variant, forgetfac, samples/s before, samples/s after, max abs difference, PI)
+
+    '''
+    variants = [('ORICA_W', orica.ORICA_W, 'W', False), ('ORICA_A', orica.ORICA_A, 'A', False),
+                ('ORICA_W_block', orica.ORICA_W_block, 'W', True), ('ORICA_A_block', orica.ORICA_A_block, 'A', True)]
+    results = []
+    for (name, recordings, mixing) in datasets:
+        print('Core benchmark - ', name, ' block size: ', block)
+        print('variant\t\tforgetfac\tbefore (samples/s)\tafter (samples/s)\tmax diff\tPI')
+        for (variant, cls, rule, block_update) in variants:
+            if block_update:
+                data = recordings
+            else:
+                data = recordings[:, :n_samples_sample]
+            for (ff, lambda_0) in forgetfacs:
+                t_start = time.time()
+                unmixing_ref = reference_orica_wa(data, rule, block_update, block, lambda_0, ff)
+                t_before = time.time() - t_start
+
+                t_start = time.time()
+                ori = cls(data, sphering='offline', forgetfac=ff, lambda_0=lambda_0, block_white=block,
+                          block_ica=block, evalconverg=False)
+                t_after = time.time() - t_start
+
+                max_diff = np.max(np.abs(ori.unmixing - unmixing_ref))
+                PI, _ = evaluate_PI(ori.unmixing, mixing)
+                n_samples = data.shape[1]
+                results.append((name, variant, ff, n_samples / t_before, n_samples / t_after, max_diff, PI))
+                print(variant, '\t', ff, '\t', round(n_samples / t_before), '\t\t\t', round(n_samples / t_after),
+                      '\t\t\t', max_diff, '\t', round(PI, 4))
+                assert max_diff <= tol * np.max(np.abs(unmixing_ref)), \
+                    variant + ' ' + ff + ': max difference ' + str(max_diff) + ' from the reference'
+
+    return results
+
+
+def benchmark_ortho(datasets, block=1000, every_list=(1, 2, 5, 10), newton_iter=5):
+    '''
+    Accuracy vs throughput of the ORICA orthogonalization options against the exact eigh path at every block.
+
+    Parameters
+    ----------
+    datasets: list of (name, recordings, mixing) (see load_recordings)
+    block: block size (in samples)
+    every_list: orthogonalization intervals (in blocks) to test with the eigh path
+    newton_iter: maximum number of Newton-Schulz iterations
+
+    Returns
+    -------
+    results: list of (name, config, blocks/sec, PI, max abs difference of unmixing from the reference)
+
+    '''
+    configs = [('eigh-' + str(k), {'ortho_mode': 'eigh', 'ortho_every': k}) for k in every_list]
+    configs.append(('newton-' + str(newton_iter), {'ortho_mode': 'newton', 'ortho_iter': newton_iter}))
+
+    results = []
+    for (name, recordings, mixing) in datasets:
+        n_blocks = int(recordings.shape[1] / block)
+        print('Orthogonalization benchmark - ', name, ' block size: ', block)
+        print('config\tblocks/s\tPI\tmax diff from eigh-1')
+        unmixing_ref = None
+        for (config, kwargs) in configs:
+            t_start = time.time()
+            ori = orica.ORICA(recordings, block_white=block, block_ica=block, evalconverg=False, **kwargs)
+            proc_time = time.time() - t_start
+            PI, _ = evaluate_PI(ori.unmixing, mixing)
+            if unmixing_ref is None:
+                unmixing_ref = ori.unmixing
+            max_diff = np.max(np.abs(ori.unmixing - unmixing_ref))
+            results.append((name, config, n_blocks / proc_time, PI, max_diff))
+            print(config, '\t', round(n_blocks / proc_time, 2), '\t', round(PI, 4), '\t', max_diff)
+
+    return results
+
+
+def benchmark_ff(block_list=(8, 64, 500, 1000, 4000), n_chans=32, duration=60, fs=32000, block=1000, n_rep=200):
+    '''
+    Adaptive forgetting factor: per-sample loop (before) vs orica_adaptive_ff (after), for single blocks and for
+    a whole ORICA run with the 'adaptive' profile on a synthetic recording.
+
+    Parameters
+    ----------
+    block_list: block sizes for the generator benchmark
+    n_chans: number of channels of the recording
+    duration: duration of the recording (in seconds)
+    fs: sampling frequency
+    block: block size of the ORICA run
+    n_rep: number of repetitions for the generator benchmark
+
+    Returns
+    -------
+    results: list of (block size, us/block before, us/block after, max relative difference)
+
+    '''
+    print('Adaptive forgetting factor benchmark')
+    print('block\tbefore (us)\tafter (us)\tmax rel diff')
+    results = []
+    gain, alpha = 1e-3, 0.02
+    for n_samples in block_list:
+        t_start = time.time()
+        for r in range(n_rep):
+            lambda_before = loop_adaptive_ff(0.1, n_samples, gain, alpha)
+        t_before = (time.time() - t_start) / n_rep * 1e6
+        t_start = time.time()
+        for r in range(n_rep):
+            lambda_after = orica.orica_adaptive_ff(0.1, n_samples, gain, alpha)
+        t_after = (time.time() - t_start) / n_rep * 1e6
+        max_diff = np.max(np.abs(lambda_before - lambda_after) / lambda_before)
+        results.append((n_samples, t_before, t_after, max_diff))
+        print(n_samples, '\t', round(t_before, 1), '\t\t', round(t_after, 1), '\t\t', max_diff)
+
+    recordings, mixing, _ = generate_synthetic_recording(n_chans, int(duration * fs), seed=n_chans)
+    print('ORICA adaptive - ', n_chans, ' chans ', duration, ' s, block size: ', block)
+    for (name, orica_class) in [('before', LoopFFORICA), ('after', orica.ORICA)]:
+        t_start = time.time()
+        ori = orica_class(recordings, forgetfac='adaptive', block_white=block, block_ica=block)
+        proc_time = time.time() - t_start
+        PI, _ = evaluate_PI(ori.unmixing, mixing)
+        print(name, '\t', round(proc_time, 2), ' s\tPI: ', round(PI, 4))
+
+    return results
+
+
+def benchmark_sweep(datasets, block=1000, cooling_lambdas=(0.995, 0.5, 0.1, 0.01),
+                    constant_lambdas=(1e-5, 1e-6, 1e-7, 1e-8)):
+    '''
+    Time of a forgetting factor x lambda_0 sweep: one ORICA run per configuration vs a single ORICASweep pass.
+
+    Parameters
+    ----------
+    datasets: list of (name, recordings, mixing) (see load_recordings)
+    block: block size (in samples)
+    cooling_lambdas: lambda_0 values for the cooling forgetting factor
+    constant_lambdas: lambda_0 values for the constant forgetting factor
+
+    Returns
+    -------
+    results: list of (name, number of configurations, time sequential, time sweep, max abs difference)
+
+    '''
+    configs = [{'forgetfac': 'cooling', 'lambda_0': l} for l in cooling_lambdas] + \
+              [{'forgetfac': 'constant', 'lambda_0': l} for l in constant_lambdas]
+    results = []
+    print('Sweep benchmark - ', len(configs), ' configurations, block size: ', block)
+    print('recording\tsequential (s)\tsweep (s)\tspeedup\tmax diff')
+    for (name, recordings, mixing) in datasets:
+        t_start = time.time()
+        unmixing = []
+        for config in configs:
+            ori = orica.ORICA(recordings, block_white=block, block_ica=block, evalconverg=False, **config)
+            unmixing.append(ori.unmixing)
+        t_seq = time.time() - t_start
+
+        t_start = time.time()
+        sweep = orica.ORICASweep(recordings, configs, block=block)
+        t_sweep = time.time() - t_start
+
+        max_diff = np.max(np.abs(np.array(unmixing) - sweep.unmixing))
+        results.append((name, len(configs), t_seq, t_sweep, max_diff))
+        print(name, '\t', round(t_seq, 2), '\t\t', round(t_sweep, 2), '\t\t', round(t_seq / t_sweep, 2), '\t', max_diff)
+
+    return results
+
+
+def benchmark_pipeline(datasets, block=1000, fs=32000, queue_size=4):
+    '''
+    Throughput of onlineORICAss with sequential vs pipelined (whitening / ICA / selection threads) block processing.
+    The speedup depends on the number of cores available to the BLAS calls of each stage.
+
+    Parameters
+    ----------
+    datasets: list of (name, recordings, mixing) (see load_recordings)
+    block: block size (in samples)
+    fs: sampling frequency
+    queue_size: maximum number of blocks waiting between two pipeline stages
+
+    Returns
+    -------
+    results: list of (name, samples/s sequential, samples/s pipelined, max abs difference of unmixing)
+
+    '''
+    kwargs = {'fs': fs, 'block': block, 'onlineWhitening': True, 'calibratePCA': False, 'pca_window': 0,
+              'ica_window': 0, 'skew_window': 0.5, 'step_size': 0.5, 'onlineDetection': False}
+    results = []
+    print('Pipeline benchmark - block size: ', block, ' queue size: ', queue_size)
+    print('recording	sequential (samples/s)	pipelined (samples/s)	speedup	max diff')
+    for (name, recordings, mixing) in datasets:
+        n_samples = recordings.shape[1]
+        t_start = time.time()
+        ori_seq = orica.onlineORICAss(recordings, **kwargs)
+        t_seq = time.time() - t_start
+        t_start = time.time()
+        ori_pip = orica.onlineORICAss(recordings, pipeline=True, queue_size=queue_size, **kwargs)
+        t_pip = time.time() - t_start
+
+        max_diff = np.max(np.abs(np.asarray(ori_seq.unmixing) - np.asarray(ori_pip.unmixing)))
+        results.append((name, n_samples / t_seq, n_samples / t_pip, max_diff))
+        print(name, '\t', int(n_samples / t_seq), '\t\t\t', int(n_samples / t_pip), '\t\t\t',
+              round(t_seq / t_pip, 2), '\t', max_diff)
+
+    return results
+
+
+def benchmark_dtype(datasets, block=1000, fs=32000):
+    '''
+    Separation quality and time of the ORICA variants in float64 vs float32. Recordings are cast to the working
+    precision before the run (as when loaded with dtype control).
+
+    Parameters
+    ----------
+    datasets: list of (name, recordings, mixing) (see load_recordings)
+    block: block size (in samples)
+    fs: sampling frequency (onlineORICAss)
+
+    Returns
+    -------
+    results: list of (name, variant, dtype, time, PI, C_gt) where C_gt is the average absolute correlation between
+             ground-truth and estimated mixing columns (matched with matcorr)
+
+    '''
+    variants = [('ORICA', lambda rec, dtype: orica.ORICA(rec, block_white=block, block_ica=block, dtype=dtype)),
+                ('ORICA online', lambda rec, dtype: orica.ORICA(rec, block_white=block, block_ica=block,
+                                                                onlineWhitening=True, dtype=dtype)),
+                ('W_block', lambda rec, dtype: orica.ORICA_W_block(rec, block_white=block, block_ica=block,
+                                                                   verbose=True, dtype=dtype)),
+                ('A_block', lambda rec, dtype: orica.ORICA_A_block(rec, block_white=block, block_ica=block,
+                                                                   verbose=True, dtype=dtype)),
+                ('onlineORICAss', lambda rec, dtype: orica.onlineORICAss(rec, fs=fs, block=block, pca_window=0,
+                                                                         ica_window=0, skew_window=0.5, step_size=0.5,
+                                                                         onlineWhitening=False, calibratePCA=False,
+                                                                         onlineDetection=False, dtype=dtype))]
+    results = []
+    for (name, recordings, mixing) in datasets:
+        print('Precision benchmark - ', name, ' block size: ', block)
+        print('variant\t\tdtype\ttime (s)\tPI\tC_gt')
+        for (variant, run) in variants:
+            for dtype in [np.float64, np.float32]:
+                rec = recordings.astype(dtype)
+                t_start = time.time()
+                ori = run(rec, dtype)
+                proc_time = time.time() - t_start
+                unmixing = ori.unmixing[-1] if ori.unmixing.ndim == 3 else ori.unmixing
+                PI, _ = evaluate_PI(unmixing, mixing)
+                correlation, _, _, _ = matcorr(mixing.T, np.linalg.pinv(unmixing).T)
+                C_gt = np.mean(np.abs(correlation))
+                results.append((name, variant, np.dtype(dtype).name, proc_time, PI, C_gt))
+                print(variant, '\t', np.dtype(dtype).name, '\t', round(proc_time, 2), '\t\t', round(PI, 4), '\t',
+                      round(C_gt, 4))
+
+    return results
+
+
+def time_stages(ori, stages):
+    '''
+    Replaces stage methods of an onlineORICAss instance with timed wrappers (the class is left untouched).
+
+    Parameters
+    ----------
+    ori: onlineORICAss instance
+    stages: names of the methods to time
+
+    Returns
+    -------
+    elapsed: dict {method name: accumulated time (s)} (reset by the caller before each block)
+
+    '''
+    timer = getattr(time, 'perf_counter', time.time)
+    elapsed = dict((stage, 0.) for stage in stages)
+
+    def timed(stage, method):
+        def wrapper(*args, **kwargs):
+            t_start = timer()
+            out = method(*args, **kwargs)
+            elapsed[stage] += timer() - t_start
+            return out
+        return wrapper
+
+    for stage in stages:
+        setattr(ori, stage, timed(stage, getattr(ori, stage)))
+
+    return elapsed
+
+
+def benchmark_latency(datasets, block_list=(8, 64, 500, 1000, 4000), fs=32000, realtime=False,
+                      percentiles=(50, 95, 99)):
+    '''
+    Per-block latency of the onlineORICAss stages when a recording is replayed block by block with partial_fit, as
+    from an acquisition system. Each block must be processed before the next one is acquired (deadline = block / fs).
+
+    Stages: mean (running mean), whitening (online whitening and sphering, without the mean), ica (ORICA update),
+    projection (online sources and source history/skewness bookkeeping), skew (source selection), detection (online
+    spike detection). Skew and detection only run at every step (step_size).
+
+    Parameters
+    ----------
+    datasets: list of (name, recordings, mixing) (see load_recordings)
+    block_list: block sizes (in samples)
+    fs: sampling frequency
+    realtime: if True blocks are released at wall-clock acquisition pace and the block latency is measured from the
+              end of its acquisition (a late block delays the following ones), otherwise blocks are processed as fast
+              as possible
+    percentiles: latency percentiles to report (the maximum is always reported)
+
+    Returns
+    -------
+    results: list of (name, block, latencies, real-time factor, deadline misses) where latencies is a dict
+             {stage: (n_blocks,) latencies in s} (including 'total') and the real-time factor is the processing time
+             over the duration of the replayed signal (< 1 keeps up with acquisition)
+
+    '''
+    timer = getattr(time, 'perf_counter', time.time)
+    stages = ['mean', 'whitening', 'ica', 'projection', 'skew', 'detection', 'total']
+    methods = ['onlineMean', 'whitenBlock', 'icaBlock', 'selectBlock', 'computeSkew', 'detectSpikes']
+    # step_size (0.5 s) is a multiple of the block sizes so that selection and detection run at every step
+    kwargs = {'fs': fs, 'onlineWhitening': True, 'calibratePCA': False, 'pca_window': 0, 'ica_window': 0,
+              'skew_window': 0.5, 'step_size': 0.5, 'onlineDetection': True, 'source_history': 'window'}
+    results = []
+    for (name, recordings, mixing) in datasets:
+        n_chans, n_samples = recordings.shape
+        print('Latency benchmark - ', name, ' fs: ', fs, ' realtime: ', realtime)
+        print('block\tdeadline (ms)\tstage\t\t' + '\t'.join(['p' + str(p) for p in percentiles]) + '\tmax (ms)')
+        for block in block_list:
+            n_blocks = int(n_samples // block)
+            deadline = float(block) / fs
+            ori = orica.onlineORICAss(n_chans=n_chans, n_samples=n_blocks * block, block=block, **kwargs)
+            elapsed = time_stages(ori, methods)
+            latencies = dict((stage, np.zeros(n_blocks)) for stage in stages)
+            response = np.zeros(n_blocks)
+
+            t_zero = timer()
+            for bi in range(n_blocks):
+                if realtime:
+                    # block bi is available once its last sample is acquired
+                    t_avail = t_zero + (bi + 1) * deadline
+                    time.sleep(np.max([0., t_avail - timer()]))
+                for method in methods:
+                    elapsed[method] = 0.
+                t_start = timer()
+                ori.partial_fit(recordings[:, bi * block:(bi + 1) * block])
+                t_end = timer()
+                response[bi] = t_end - (t_avail if realtime else t_start)
+
+                latencies['total'][bi] = t_end - t_start
+                latencies['mean'][bi] = elapsed['onlineMean']
+                latencies['whitening'][bi] = elapsed['whitenBlock'] - elapsed['onlineMean']
+                latencies['ica'][bi] = elapsed['icaBlock']
+                latencies['skew'][bi] = elapsed['computeSkew']
+                latencies['detection'][bi] = elapsed['detectSpikes']
+                latencies['projection'][bi] = elapsed['selectBlock'] - elapsed['computeSkew'] - \
+                                              elapsed['detectSpikes']
+
+            rtf = np.sum(latencies['total']) / (n_blocks * deadline)
+            n_misses = int(np.sum(response > deadline))
+            results.append((name, block, latencies, rtf, n_misses))
+            for stage in stages:
+                print(block, '\t', round(1000 * deadline, 3), '\t\t', stage, '\t' if len(stage) > 6 else '\t\t',
+                      '\t'.join([str(round(1000 * np.percentile(latencies[stage], p), 3)) for p in percentiles]),
+                      '\t', round(1000 * np.max(latencies[stage]), 3))
+            print(block, '\t', 'real-time factor: ', round(rtf, 3), '\tdeadline misses: ', n_misses, '/', n_blocks)
+
+    return results
+
+
+def benchmark_segica(datasets, n_segments=4, max_iter=200):
+    '''
+    Fit time of the segment-wise FastICA (ICA.segICA) with warm-started and random initialization of the segments,
+    compared to the one-shot FastICA on the whole recording (ICA.instICA).
+
+    Parameters
+    ----------
+    datasets: list of (name, recordings, mixing) (see load_recordings)
+    n_segments: number of time segments
+    max_iter: maximum number of FastICA iterations per segment
+
+    Returns
+    -------
+    results: list of (name, method, time, total FastICA iterations, PI, average tracking correlation) where PI is
+             computed on the (last segment) unmixing matrix
+
+    '''
+    import ICA as ica
+
+    results = []
+    for (name, recordings, mixing) in datasets:
+        print('Segment-wise ICA benchmark - ', name, ' segments: ', n_segments)
+        print('method\t\ttime (s)\titerations\tPI\ttracking corr')
+        t_start = time.time()
+        _, _, W = ica.instICA(recordings)
+        proc_time = time.time() - t_start
+        PI, _ = evaluate_PI(W, mixing)
+        results.append((name, 'one-shot', proc_time, np.nan, PI, np.nan))
+        print('one-shot\t', round(proc_time, 2), '\t\t-\t\t', round(PI, 4), '\t-')
+
+        for (method, warm_start) in [('segments warm', True), ('segments cold', False)]:
+            t_start = time.time()
+            _, _, W, info = ica.segICA(recordings, n_segments=n_segments, warm_start=warm_start, max_iter=max_iter,
+                                       seed=0, verbose=False)
+            proc_time = time.time() - t_start
+            PI, _ = evaluate_PI(W, mixing)
+            n_iter = int(np.sum(info['n_iter']))
+            corr = np.mean(info['corr'][1:]) if n_segments > 1 else 1.
+            results.append((name, method, proc_time, n_iter, PI, corr))
+            print(method, '\t', round(proc_time, 2), '\t\t', n_iter, '\t\t', round(PI, 4), '\t', round(corr, 3))
+
+    return results
+
+
+def benchmark_budget(datasets, budgets=(0.5, 1, 2, 5), chunk_duration=0.05, fs=32000, methods=('fastica', 'orica'),
+                     seed=0):
+    '''
+    Speed/accuracy of instICA (FastICA: ICA.instICA, ORICA: orICA.instICA) fit on a budget of samples selected
+    uniformly ('random') or around threshold crossings ('activity', see tools.select_chunks), compared to the fit on
+    the whole recording. Sources of the whole recording are projected in both cases.
+
+    Parameters
+    ----------
+    datasets: list of (name, recordings, mixing) (see load_recordings)
+    budgets: sample budgets (in s)
+    chunk_duration: duration of the chunks (in s)
+    fs: sampling frequency
+    methods: ['fastica'|'orica'] instICA implementations
+    seed: random seed of the chunk selection
+
+    Returns
+    -------
+    results: list of (name, method, chunk mode, budget (s), time, PI, C_gt) where C_gt is the average absolute
+             correlation between ground-truth and estimated mixing columns (matched with matcorr)
+
+    '''
+    import ICA as ica
+
+    chunk_size = int(chunk_duration * fs)
+    fit = {'fastica': lambda rec, **kwargs: ica.instICA(rec, **kwargs),
+           'orica': lambda rec, **kwargs: orica.instICA(rec, **kwargs)}
+    results = []
+    for (name, recordings, mixing) in datasets:
+        duration = float(recordings.shape[1]) / fs
+        print('Budget benchmark - ', name, ' duration: ', round(duration, 2), ' s chunk: ', chunk_duration, ' s')
+        print('method\tchunks\t\tbudget (s)\ttime (s)\tPI\tC_gt')
+        for method in methods:
+            configs = [('full', duration)] + [(chunk_mode, budget) for budget in budgets if budget < duration
+                                              for chunk_mode in ['random', 'activity']]
+            for (chunk_mode, budget) in configs:
+                if chunk_mode == 'full':
+                    kwargs = {}
+                else:
+                    kwargs = {'n_chunks': int(np.max([2, budget * fs // chunk_size])), 'chunk_size': chunk_size,
+                              'chunk_mode': chunk_mode, 'seed': seed}
+                t_start = time.time()
+                _, _, W = fit[method](recordings, **kwargs)
+                proc_time = time.time() - t_start
+                PI, _ = evaluate_PI(W, mixing)
+                correlation, _, _, _ = matcorr(mixing.T, np.linalg.pinv(W).T)
+                C_gt = np.mean(np.abs(correlation))
+                results.append((name, method, chunk_mode, budget, proc_time, PI, C_gt))
+                print(method, '\t', chunk_mode, '\t' if len(chunk_mode) > 6 else '\t\t', round(budget, 2), '\t\t',
+                      round(proc_time, 2), '\t\t', round(PI, 4), '\t', round(C_gt, 4))
+
+    return results
+
+
+if __name__ == '__main__':
+    if '-bench' in sys.argv:
+        pos = sys.argv.index('-bench')
+        bench = sys.argv[pos + 1]
+    else:
+        bench = 'kernel'
+    if '-block' in sys.argv:
+        pos = sys.argv.index('-block')
+        block_size = int(sys.argv[pos + 1])
+    else:
+        block_size = 1000
+    if '-chans' in sys.argv:
+        pos = sys.argv.index('-chans')
+        n_chans_list = [int(n) for n in sys.argv[pos + 1].split(',')]
+    else:
+        n_chans_list = [32, 128, 384]
+    if '-nblocks' in sys.argv:
+        pos = sys.argv.index('-nblocks')
+        n_blocks = int(sys.argv[pos + 1])
+    else:
+        n_blocks = 20
+    if '-blocks' in sys.argv:
+        pos = sys.argv.index('-blocks')
+        block_list = [int(b) for b in sys.argv[pos + 1].split(',')]
+    else:
+        block_list = [8, 64, 500, 1000, 4000]
+    realtime = '-realtime' in sys.argv
+    if '-nseg' in sys.argv:
+        pos = sys.argv.index('-nseg')
+        n_segments = int(sys.argv[pos + 1])
+    else:
+        n_segments = 4
+    if '-r' in sys.argv:
+        pos = sys.argv.index('-r')
+        folders = sys.argv[pos + 1].split(',')
+    else:
+        folders = []
+
+    if bench == 'kernel':
+        benchmark_kernel(n_chans_list, block=block_size, n_blocks=n_blocks)
+    elif bench == 'ff':
+        benchmark_ff(block=block_size)
+    elif bench == 'sweep':
+        benchmark_sweep(load_recordings(folders, n_chans_list), block=block_size)
+    elif bench == 'dtype':
+        benchmark_dtype(load_recordings(folders, n_chans_list), block=block_size)
+    elif bench == 'pipeline':
+        benchmark_pipeline(load_recordings(folders, n_chans_list), block=block_size)
+    elif bench == 'core':
+        benchmark_core(load_recordings(folders, n_chans_list), block=block_size)
+    elif bench == 'whitening':
+        for n_chans in n_chans_list:
+            benchmark_whitening(n_chans, n_blocks=n_blocks)
+    elif bench == 'ortho':
+        benchmark_ortho(load_recordings(folders, n_chans_list), block=block_size)
+    elif bench == 'latency':
+        benchmark_latency(load_recordings(folders, n_chans_list), block_list=block_list, realtime=realtime)
+    elif bench == 'segica':
+        benchmark_segica(load_recordings(folders, n_chans_list), n_segments=n_segments)
+    elif bench == 'budget':
+        benchmark_budget(load_recordings(folders, n_chans_list))
+    else:
+        raise Exception('Unknown benchmark: ' + bench)
@@ -127,6 +127,17 @@ if __name__ == '__main__':
         onlinesphering = False
         return_evolution = False
 
+    if '-stop' in sys.argv:
+        pos = sys.argv.index('-stop')
+        early_stopping = sys.argv[pos + 1]
+    else:
+        early_stopping = None
+    if '-patience' in sys.argv:
+        pos = sys.argv.index('-patience')
+        patience = int(sys.argv[pos + 1])
+    else:
+        patience = 50
+
     if '-resfile' in sys.argv:
         pos = sys.argv.index('-resfile')
         resfile = sys.argv[pos + 1]
@@ -138,7 +149,8 @@ if __name__ == '__main__':
     if len(sys.argv) == 1 and not debug:
         print 'Evaluate ICA for spike sorting:\n   -r recording folder\n   -mod orica-ica\n   \nblock block size' \
               '\n   -ff constant-cooling\n   -mu smoothing\n   -lambda lambda_0' \
-              '\n   -oricamod  original - A - W - A_block - W_block\n   -npass numpass\n'
+              '\n   -oricamod  original - A - W - A_block - W_block\n   -npass numpass' \
+              '\n   -stop nsi - weights (early stopping)\n   -patience blocks\n'
         # raise Exception('Indicate recording folder -r')
         folder = 'recordings/recording_eeg_16chan_ica.mat'
         block_size = 10
@@ -199,7 +211,8 @@ if __name__ == '__main__':
         if orica_type == 'original':
             ori = orica.ORICA(recordings, onlineWhitening=onlinesphering, forgetfac=ff, lambda_0=lambda_val,
                               mu=mu, verbose=True, numpass=npass, block_white=block_size, block_ica=block_size,
-                              adjacency=adj_graph, whiten=whiten, ortho=ortho, ndim=ndim, white_mode='pca')
+                              adjacency=adj_graph, whiten=whiten, ortho=ortho, ndim=ndim, white_mode='pca',
+                              early_stopping=early_stopping, stop_patience=patience)
         elif orica_type == 'W':
             ori = orica.ORICA_W(recordings, sphering='offline', forgetfac=ff, lambda_0=lambda_val,
                                 mu=mu, verbose=True, numpass=1, block_white=block_size, block_ica=block_size,
@@ -246,6 +259,11 @@ if __name__ == '__main__':
 
     proc_time = time.time() - t_start
     print 'Processing time: ', proc_time
+    if mod == 'orica' and orica_type == 'original':
+        n_blocks = ori.n_blocks
+        print 'Processed blocks: ', n_blocks
+    else:
+        n_blocks = '-'
 
     if 'eeg' not in folder:
         # Skewness
@@ -349,6 +367,7 @@ if __name__ == '__main__':
         if not os.path.isfile(join(folder, resfile)):
             df = pd.DataFrame({'mu': [mu], 'numpass': [npass], 'reg': [reg], 'oricamode': [oricamod], 'mod': [mod],
                                'block': [block_size], 'ff': [ff], 'lambda': [lambda_v], 'time': [proc_time],
+                               'n_blocks': [n_blocks], 'stop': [early_stopping],
                                'CC_mix': [mix_CC_mean], 'CC_source': [sources_CC_mean], 'n_sk': [n_high_sk],
                                'n_ku': [n_high_ku]})
             print 'Saving to ', join(folder, resfile)
@@ -360,6 +379,7 @@ if __name__ == '__main__':
             with open(join(folder, resfile), 'a') as f:
                 df = pd.DataFrame({'mu': [mu], 'numpass': [npass], 'reg': [reg], 'oricamode': [oricamod], 'mod': [mod],
                                    'block': [block_size], 'ff': [ff], 'lambda': [lambda_v], 'time': [proc_time],
+                                   'n_blocks': [n_blocks], 'stop': [early_stopping],
                                    'CC_mix': [mix_CC_mean], 'CC_source': [sources_CC_mean], 'n_sk': [n_high_sk],
                                    'n_ku': [n_high_ku]}, index=[new_index])
                 print 'Appending to ', join(folder, resfile)
@@ -4,14 +4,22 @@ import numpy as np
 from numpy import linalg as la
 import time
 import warnings
+import threading
+from collections import OrderedDict
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import matplotlib.pylab as plt
 import quantities as pq
 from scipy import stats
 from scipy.linalg import sqrtm
 from scipy.linalg import eigh
 from scipy.linalg import LinAlgError
+from scipy import sparse
 from sklearn.decomposition import PCA
-from tools import whiten_data
+from tools import whiten_data, RunningMoments, evaluate_PI, matcorr, delay_embedding, embedding_stats, \
+    select_chunks
 
 
 def gha_step(lambd, U, x, gamma, q='all', center=False, sort=True):
@@ -44,17 +52,893 @@ class State():
         self.nonStatIdx = nonStatIdx
         self.kurtsign = kurtsign
 
-class ORICA():
-    def __init__(self, data, numpass=1, weights=None, onlineWhitening=False, ndim='all', lambda_0=0.995, block_white=8,
-                 block_ica=8, nsub=0, white_mode='pca', pcaonly=False,
+def check_dtype(dtype):
+    '''Returns the floating point type of the ORICA computations (float32 or float64, None -> float64).'''
+    if dtype is None:
+        return np.dtype(np.float64)
+    dtype = np.dtype(dtype)
+    if dtype not in [np.float32, np.float64]:
+        raise AttributeError('ORICA supports float32 and float64 dtypes, not ' + str(dtype))
+    return dtype
+
+
+class BlockBuffers():
+    def __init__(self, names=('y', 'f', 'scratch'), size=0, dtype=float):
+        '''Preallocated work arrays reused across ORICA block updates.
+
+        Buffers are flat and sliced/reshaped to (chans x samples), so blocks of varying length share the same
+        memory and views stay contiguous. Buffers are only reallocated when a larger block comes in.
+        '''
+        self.names = names
+        self.dtype = dtype
+        self.size = 0
+        self.buffers = {}
+        self.allocate(size)
+
+    def allocate(self, size):
+        self.size = size
+        self.buffers = {name: np.empty(size, dtype=self.dtype) for name in self.names}
+
+    def get(self, name, nChs, nPts):
+        if nChs * nPts > self.size:
+            self.allocate(nChs * nPts)
+        return self.buffers[name][:nChs * nPts].reshape(nChs, nPts)
+
+
+class SourceHistory():
+    def __init__(self, n_sources, n_samples=0, window=None, filename=None, dtype=float):
+        '''Storage of the online source activations (sources-by-samples).
+
+        Parameters
+        ----------
+        n_sources:  number of sources
+        n_samples:  expected number of samples (full history is grown by doubling beyond it)
+        window:     if not None, only the last window samples are kept in a ring buffer, so memory does not
+                    depend on the recording length
+        filename:   if not None (and window is None), the full history is spilled to a memmap on disk. Samples
+                    are stored column-wise (Fortran order) so the file can be extended in place
+        dtype:      floating point type of the stored sources
+        '''
+        self.n_sources = n_sources
+        self.dtype = np.dtype(dtype)
+        self.window = window
+        self.filename = filename
+        # number of samples written (the next block starts at n)
+        self.n = 0
+
+        if window is not None:
+            self.data = np.zeros((n_sources, int(window)), dtype=self.dtype)
+        elif filename is not None:
+            self.data = np.memmap(filename, dtype=self.dtype, mode='w+',
+                                  shape=(n_sources, int(np.max([1, n_samples]))), order='F')
+        else:
+            self.data = np.zeros((n_sources, int(n_samples)), dtype=self.dtype)
+
+    def __getstate__(self):
+        # a memmap history stays on disk and is reopened on load
+        state = dict(self.__dict__)
+        if self.filename is not None and self.window is None:
+            self.data.flush()
+            state['data'] = None
+            state['shape'] = self.data.shape
+        return state
+
+    def __setstate__(self, state):
+        shape = state.pop('shape', None)
+        self.__dict__.update(state)
+        if shape is not None:
+            self.data = np.memmap(self.filename, dtype=self.dtype, mode='r+', shape=shape, order='F')
+
+    def grow(self, n_samples):
+        n_samples = int(np.max([n_samples, 2 * self.data.shape[1]]))
+        if self.filename is not None:
+            self.data.flush()
+            del self.data
+            with open(self.filename, 'r+b') as f:
+                f.truncate(self.n_sources * n_samples * self.dtype.itemsize)
+            self.data = np.memmap(self.filename, dtype=self.dtype, mode='r+', shape=(self.n_sources, n_samples),
+                                  order='F')
+        else:
+            self.data = np.concatenate((self.data, np.zeros((self.n_sources, n_samples - self.data.shape[1]),
+                                                            dtype=self.dtype)), axis=1)
+
+    def append(self, block, start):
+        '''Stores a block of sources starting at sample start.'''
+        nPts = block.shape[1]
+        end = start + nPts
+        if self.window is None:
+            if end > self.data.shape[1]:
+                self.grow(end)
+            self.data[:, start:end] = block
+        else:
+            size = self.data.shape[1]
+            if nPts >= size:
+                block = block[:, nPts - size:]
+                start = end - size
+                nPts = size
+            i_start = start % size
+            n_first = np.min([nPts, size - i_start])
+            self.data[:, i_start:i_start + n_first] = block[:, :n_first]
+            self.data[:, :nPts - n_first] = block[:, n_first:]
+        self.n = end
+
+    def last(self, n_samples, end=None):
+        '''Returns the (chronologically ordered) sources in the n_samples samples before end (default -> n).'''
+        if end is None:
+            end = self.n
+        start = int(np.max([0, end - n_samples]))
+        if self.window is None:
+            return self.data[:, start:end]
+        size = self.data.shape[1]
+        if end - start > size:
+            raise Exception('Only the last ' + str(size) + ' samples are kept in the source history')
+        i_start = start % size
+        i_end = i_start + end - start
+        if i_end <= size:
+            return self.data[:, i_start:i_end]
+        return np.concatenate((self.data[:, i_start:], self.data[:, :i_end - size]), axis=1)
+
+    def get(self):
+        '''Returns the full history or, for the ring buffer, the last window samples.'''
+        if self.window is None:
+            return self.data
+        return self.last(self.data.shape[1])
+
+
+class MatrixHistory():
+    def __init__(self, every=1, cache_size=16, dtype=float):
+        '''Checkpoints of the ORICA weights and sphere of an online run.
+
+        Only the (weights, sphere) pairs are stored: unmixing (weights x sphere), mixing (pinv of unmixing,
+        transposed) and sphere matrices are computed on access (see MatrixHistoryView) and the last cache_size
+        results are cached. Spheres equal to the previous one (e.g. pre-whitening) are stored once.
+
+        Parameters
+        ----------
+        every:      decimation (keep every every-th step as a checkpoint). The last step is always kept
+        cache_size: number of computed matrices kept in memory
+        dtype:      floating point type of the stored weights and spheres
+        '''
+        self.every = int(np.max([1, every]))
+        self.cache_size = cache_size
+        self.dtype = np.dtype(dtype)
+        self.weights = []
+        self.spheres = []
+        # index in spheres and step number of each stored checkpoint
+        self.sphere_idx = []
+        self.steps = []
+        # number of stored checkpoints using each sphere
+        self.sphere_refs = []
+        self.n_steps = 0
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def append(self, weights, sphere):
+        '''Stores the weights and sphere of a new step. A step which is not a checkpoint replaces the previous
+        one if that was not a checkpoint either, so that the latest step is always available.'''
+        weights = np.asarray(weights, dtype=self.dtype)
+        sphere = np.asarray(sphere, dtype=self.dtype)
+        with self.lock:
+            if len(self.steps) > 0 and np.mod(self.steps[-1], self.every):
+                self.weights.pop()
+                self.steps.pop()
+                self.sphere_idx.pop()
+                self.sphere_refs[-1] -= 1
+                if self.sphere_refs[-1] == 0:
+                    self.spheres.pop()
+                    self.sphere_refs.pop()
+                for kind in ['unmixing', 'mixing']:
+                    self.cache.pop((kind, len(self.weights)), None)
+            if len(self.spheres) == 0 or not (sphere is self.spheres[-1] or
+                                              np.array_equal(sphere, self.spheres[-1])):
+                self.spheres.append(sphere)
+                self.sphere_refs.append(0)
+            self.weights.append(weights)
+            self.sphere_idx.append(len(self.spheres) - 1)
+            self.sphere_refs[-1] += 1
+            self.steps.append(self.n_steps)
+            self.n_steps += 1
+
+    def __getstate__(self):
+        # the lock is not picklable and cached matrices are recomputed on access
+        state = dict(self.__dict__)
+        del state['lock']
+        state['cache'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        if 'sphere_refs' not in state:
+            # checkpoints saved before the reference counts were kept
+            self.sphere_refs = np.bincount(self.sphere_idx, minlength=len(self.spheres)).astype(int).tolist()
+
+    def __len__(self):
+        return len(self.weights)
+
+    def compute(self, kind, i):
+        '''Returns the kind ['unmixing'|'mixing'|'sphere'|'weights'] matrix of checkpoint i.'''
+        if kind == 'weights':
+            return self.weights[i]
+        if kind == 'sphere':
+            return self.spheres[self.sphere_idx[i]]
+        key = (kind, i)
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+        if kind == 'unmixing':
+            matrix = np.matmul(self.weights[i], self.spheres[self.sphere_idx[i]])
+        elif kind == 'mixing':
+            matrix = la.pinv(self.compute('unmixing', i)).T
+        else:
+            raise AttributeError('Unknown matrix: ' + str(kind))
+        with self.lock:
+            self.cache[key] = matrix
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return matrix
+
+    def view(self, kind):
+        return MatrixHistoryView(self, kind)
+
+
+class MatrixHistoryView():
+    def __init__(self, history, kind):
+        '''Read-only, array-like (steps-by-rows-by-columns) access to the kind matrices of a MatrixHistory.
+
+        view[i] computes (or retrieves from the cache) one matrix, view[i, ...] indexes into it, slices and
+        lists of steps return stacked arrays, and np.asarray(view) materializes the whole history.
+        '''
+        self.history = history
+        self.kind = kind
+
+    def __len__(self):
+        return len(self.history)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple):
+            steps, rest = item[0], item[1:]
+        else:
+            steps, rest = item, ()
+        if isinstance(steps, (int, np.integer)):
+            if steps < 0:
+                steps += len(self)
+            if steps < 0 or steps >= len(self):
+                raise IndexError('Step out of range')
+            matrix = self.history.compute(self.kind, int(steps))
+        else:
+            idxs = np.arange(len(self))[steps]
+            matrix = np.array([self.history.compute(self.kind, int(i)) for i in np.atleast_1d(idxs)])
+            if len(rest) > 0:
+                rest = (slice(None),) + rest
+        if len(rest) > 0:
+            return matrix[rest]
+        return matrix
+
+    def __array__(self, dtype=None, copy=None):
+        matrices = np.array([self.history.compute(self.kind, i) for i in range(len(self))])
+        if dtype is not None:
+            return matrices.astype(dtype)
+        return matrices
+
+    @property
+    def shape(self):
+        if len(self) == 0:
+            return (0,)
+        return (len(self),) + self.history.compute(self.kind, len(self) - 1).shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+
+class Diagnostics():
+    def __init__(self, enabled=True, every=1, chunk=4096):
+        '''Recorder of the ORICA diagnostic traces (e.g. lambdas, NSI, WI).
+
+        Values are written in preallocated chunks of chunk rows, so recording costs O(1) per block instead of
+        re-allocating the whole trace. Only every every-th call of record() is stored for each trace, and
+        nothing is stored if enabled is False.
+
+        Parameters
+        ----------
+        enabled:    record traces
+        every:      decimation (record every every-th block)
+        chunk:      number of rows per allocated chunk
+        '''
+        self.enabled = enabled
+        self.every = every
+        self.chunk = chunk
+        self.traces = {}
+        self.counts = {}
+        self.calls = {}
+        # traces can be recorded from different pipeline stages (threads)
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # the lock is not picklable and the unused rows of the last chunks are not saved
+        state = dict(self.__dict__)
+        del state['lock']
+        state['traces'] = dict((name, chunks[:-1] + [chunks[-1][:self.counts[name]]])
+                               for (name, chunks) in self.traces.items())
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def record(self, name, value, samples=False):
+        '''Stores value as a new row of trace name. If samples is True, value is a sequence of rows (e.g. the
+        per-sample forgetting factors of a block).'''
+        if not self.enabled:
+            return
+        with self.lock:
+            self._record(name, value, samples)
+
+    def _record(self, name, value, samples):
+        n_calls = self.calls.get(name, 0)
+        self.calls[name] = n_calls + 1
+        if np.mod(n_calls, self.every):
+            return
+
+        rows = np.asarray(value)
+        if not samples:
+            rows = rows[np.newaxis]
+        if name not in self.traces:
+            self.traces[name] = [np.empty((np.max([self.chunk, len(rows)]),) + rows.shape[1:])]
+            self.counts[name] = 0
+
+        while len(rows) > 0:
+            last = self.traces[name][-1]
+            if self.counts[name] == len(last):
+                last = np.empty((np.max([self.chunk, len(rows)]),) + rows.shape[1:])
+                self.traces[name].append(last)
+                self.counts[name] = 0
+            n_rows = np.min([len(rows), len(last) - self.counts[name]])
+            last[self.counts[name]:self.counts[name] + n_rows] = rows[:n_rows]
+            self.counts[name] += n_rows
+            rows = rows[n_rows:]
+
+    def get(self, name):
+        '''Returns trace name as an array (empty if nothing was recorded).'''
+        if name not in self.traces:
+            return np.array([])
+        chunks = self.traces[name][:-1] + [self.traces[name][-1][:self.counts[name]]]
+        return np.concatenate(chunks)
+
+
+class SpikeDetector():
+    def __init__(self, n_sources, thresh=8, noise='std', memory=np.inf, refractory=0, size=4096):
+        '''Online threshold detector of negative peaks on sources processed in consecutive steps.
+
+        A spike is the onset of a threshold crossing (first sample below -thresh * noise level). The detector keeps
+        per-source state between steps (last sample, noise estimate, last onset), so crossings straddling step
+        boundaries are detected once and each step costs O(n_sources x step). Events are written in a
+        preallocated buffer (grown by doubling) as (sample index, source) pairs.
+
+        Parameters
+        ----------
+        n_sources:  number of sources
+        thresh:     threshold in units of the noise level
+        noise:      ['std'|'mad'] noise level: standard deviation from exponentially forgotten power sums or
+                    average of median(|y|) / 0.6745 of each step, weighted with the same forgetting
+        memory:     time constant (in samples) of the noise estimate (np.inf -> all past samples)
+        refractory: minimum distance (in samples) between two onsets of the same source. Onsets closer than
+                    refractory to the previous crossing onset are discarded (the countdown restarts at every
+                    crossing)
+        size:       initial size of the event buffer
+        '''
+        self.n_sources = n_sources
+        self.thresh = thresh
+        self.noise = noise
+        self.memory = memory
+        self.refractory = refractory
+        if noise not in ['std', 'mad']:
+            raise AttributeError('Unknown noise estimate: ' + str(noise))
+
+        self.power_sums = np.zeros((3, n_sources))
+        self.sigma = np.zeros(n_sources)
+        self.last_sample = np.zeros(n_sources)
+        self.last_onset = -refractory * np.ones(n_sources, dtype=int)
+        # sample following the last processed step
+        self.end = 0
+
+        self.times = np.zeros(size, dtype=int)
+        self.sources = np.zeros(size, dtype=int)
+        self.n_events = 0
+
+    def update(self, y, start, selected=None, polarity=None):
+        '''Processes the sources of a new step.
+
+        Parameters
+        ----------
+        y:          (n_sources x n_samples) sources of the step
+        start:      sample index of the first sample of the step
+        selected:   indices of the sources on which events are emitted (default -> all). The state of all the
+                    sources is updated, so a source can be selected at any step
+        polarity:   per-source sign (e.g. -1 for positively skewed sources) so that spikes are negative peaks
+
+        Returns
+        -------
+        n_new:      number of new events
+        '''
+        n_samples = y.shape[1]
+        if n_samples == 0:
+            return 0
+        # noise level (sign invariant, computed on the sources as they are)
+        self.power_sums *= np.exp(-n_samples / float(self.memory))
+        self.power_sums[0] += n_samples
+        if self.noise == 'std':
+            self.power_sums[1] += np.sum(y, axis=1)
+            self.power_sums[2] += np.einsum('ij,ij->i', y, y)
+            mean = self.power_sums[1] / self.power_sums[0]
+            self.sigma = np.sqrt(np.maximum(self.power_sums[2] / self.power_sums[0] - mean ** 2, 0))
+        else:
+            # average of the step estimates weighted by their (forgotten) number of samples
+            mad = np.median(np.abs(y), axis=1) / 0.6745
+            self.sigma += n_samples / self.power_sums[0] * (mad - self.sigma)
+        thresholds = -self.thresh * self.sigma
+
+        last_sample = self.last_sample
+        self.last_sample = y[:, -1].copy()
+        if polarity is not None and np.any(polarity < 0):
+            y = y * polarity[:, np.newaxis]
+            last_sample = last_sample * polarity
+
+        # onsets of threshold crossings: samples below threshold whose previous sample (carried over from the last
+        # step for the first one) is not
+        idx = np.flatnonzero(y < thresholds[:, np.newaxis])
+        src, t = np.divmod(idx, n_samples)
+        onset = np.empty(len(idx), dtype=bool)
+        onset[1:] = idx[1:] - idx[:-1] != 1
+        onset[:1] = True
+        first = t == 0
+        onset[first] = ~(last_sample[src[first]] < thresholds[src[first]])
+        src, t = src[onset], t[onset] + start
+
+        # refractory countdown: distance from the previous onset of the same source (src is sorted)
+        if len(src) != 0:
+            t_prev = np.empty(len(t), dtype=int)
+            t_prev[1:] = t[:-1]
+            new_src = np.ones(len(src), dtype=bool)
+            new_src[1:] = src[1:] != src[:-1]
+            t_prev[new_src] = self.last_onset[src[new_src]]
+            keep = t - t_prev >= self.refractory
+            is_last = np.ones(len(src), dtype=bool)
+            is_last[:-1] = src[:-1] != src[1:]
+            self.last_onset[src[is_last]] = t[is_last]
+            if selected is not None:
+                mask = np.zeros(self.n_sources, dtype=bool)
+                mask[selected] = True
+                keep &= mask[src]
+            src, t = src[keep], t[keep]
+
+        self.end = start + n_samples
+
+        # event buffer
+        n_new = len(t)
+        if self.n_events + n_new > len(self.times):
+            size = int(np.max([self.n_events + n_new, 2 * len(self.times)]))
+            self.times = np.concatenate((self.times, np.zeros(size - len(self.times), dtype=int)))
+            self.sources = np.concatenate((self.sources, np.zeros(size - len(self.sources), dtype=int)))
+        order = np.argsort(t, kind='mergesort')
+        self.times[self.n_events:self.n_events + n_new] = t[order]
+        self.sources[self.n_events:self.n_events + n_new] = src[order]
+        self.n_events += n_new
+
+        return n_new
+
+    def events(self):
+        '''Returns (sample indices, sources) of the detected events in chronological order.'''
+        return self.times[:self.n_events], self.sources[:self.n_events]
+
+    def spike_trains(self):
+        '''Returns a dict {source: spike sample indices}.'''
+        times, sources = self.events()
+        return {int(s): times[sources == s] for s in np.unique(sources)}
+
+
+def orica_sources(icaweights, blockdata, nlsign, buffers, nlfunc=None):
+    '''Computes ORICA source activations y = W x and nonlinearity f(y) in preallocated buffers.
+
+    Parameters
+    ----------
+    icaweights: unmixing matrix W
+    blockdata:  whitened block (chans-by-samples)
+    nlsign:     (n x 1) signs of the nonlinearity (-2: supergaussian, 2: subgaussian)
+    buffers:    BlockBuffers
+    nlfunc:     custom nonlinear function (default -> nlsign * tanh(y))
+
+    Returns
+    -------
+    y, f
+
+    '''
+    nPts = blockdata.shape[1]
+    y = buffers.get('y', icaweights.shape[0], nPts)
+    np.matmul(icaweights, blockdata, out=y)
+    if nlfunc is None:
+        f = buffers.get('f', icaweights.shape[0], nPts)
+        np.tanh(y, out=f)
+        f *= nlsign
+    else:
+        f = nlfunc(y)
+    return y, f
+
+
+def orica_weight_update(icaweights, y, f, lambda_k, buffers, reg=None):
+    '''ORICA block update rule: W <- prod(1 / (1 - lambda_k)) * (W - y diag(lambda_k / Q) f^T W - reg)
+
+    The diagonal is applied as a column scaling of y, so no (block x block) matrix is built and the cost is
+    O(n^2 block + n^3) instead of O(n block^2).
+    '''
+    nChs, nPts = y.shape
+    lambda_prod = np.prod(1. / (1. - lambda_k))
+    Q = 1 + lambda_k * (np.einsum('ij,ij->j', f, y) - 1)
+
+    y_scaled = buffers.get('scratch', nChs, nPts)
+    np.multiply(y, lambda_k / Q, out=y_scaled)
+    icaweights_new = icaweights - np.matmul(np.matmul(y_scaled, f.T), icaweights)
+    if reg is not None:
+        icaweights_new -= reg
+    # prod(1 / (1 - lambda_k)) is a global scale, removed by the orthogonalization (or normalization) that follows
+    # every update. It can exceed 1e19 in the first blocks and overflow W W^T in float32, so it is only applied
+    # in float64
+    if icaweights_new.dtype == np.float64:
+        icaweights_new *= lambda_prod
+
+    return icaweights_new
+
+
+def rls_whitening_update(icasphere, v, lambda_avg, cov=None):
+    '''
+    RLS whitening block update: M <- (M - v v^T M / (nPts Q)) / lambda, with Q = lambda / (1 - lambda) + tr(v v^T) / nPts
+
+    Parameters
+    ----------
+    icasphere: sphering matrix M (chans-by-chans)
+    v: pre-whitened block (M x)
+    lambda_avg: block forgetting factor
+    cov: v v^T if already computed (e.g. for the whitening fitness)
+
+    Returns
+    -------
+    icasphere: updated sphering matrix
+
+    The correction has rank nPts: for blocks shorter than the number of channels it is applied as v (v^T M)
+    (2 nPts n^2 flops) instead of (v v^T) M (n^3 flops).
+    '''
+    nChs, nPts = v.shape
+    QWhite = lambda_avg / (1 - lambda_avg) + np.einsum('ij,ij->', v, v) / nPts
+    if nPts < nChs and (cov is None or 2 * nPts < nChs):
+        update = np.matmul(v, np.matmul(v.T, icasphere))
+    else:
+        if cov is None:
+            cov = np.matmul(v, v.T)
+        update = np.matmul(cov, icasphere)
+    return (icasphere - update / (nPts * QWhite)) / lambda_avg
+
+
+def orica_orthogonalize(icaweights, mode='eigh', n_iter=5, tol=10, WWt=None):
+    '''Symmetric orthogonalization of the weight matrix: W <- (W W^T)^(-1/2) W
+
+    Parameters
+    ----------
+    icaweights: weight matrix W
+    mode:       'eigh' - exact, through the eigendecomposition of W W^T
+                'newton' - Newton-Schulz iterations W <- 1.5 W - 0.5 W W^T W seeded from the current (nearly
+                orthogonal) W. Falls back to 'eigh' if W is not close enough to orthogonal for the iterations
+                to converge (||W W^T - I||_F >= 1) or if max|W W^T - I| > tol after n_iter iterations
+    n_iter:     maximum number of Newton-Schulz iterations (they stop once the residual is below tol)
+    tol:        tolerance on the orthogonality residual for 'newton', in units of sqrt(n) eps (eps: machine
+                precision of the dtype of W), so that it can be reached in float32 as well as in float64
+    WWt:        precomputed W W^T (optional)
+
+    Returns
+    -------
+    icaweights: orthogonalized weight matrix (same dtype as the input weights)
+
+    '''
+    dtype = icaweights.dtype
+    if WWt is None:
+        WWt = np.matmul(icaweights, icaweights.T)
+
+    if mode == 'newton':
+        n = icaweights.shape[0]
+        tol = tol * np.sqrt(n) * np.finfo(dtype).eps
+        # a global scale does not change the orthogonalized matrix: normalize to unit row norm on average
+        scale = np.sqrt(n / np.trace(WWt)).astype(dtype)
+        W = icaweights * scale
+        WWt = WWt * scale ** 2
+        eye = np.eye(n, dtype=dtype)
+        for it in range(n_iter + 1):
+            residual = WWt - eye
+            if np.max(np.abs(residual)) < tol:
+                return W
+            if it == n_iter or np.linalg.norm(residual) >= 1:
+                break
+            W = 1.5 * W - 0.5 * np.matmul(WWt, W)
+            WWt = np.matmul(W, W.T)
+        icaweights = W
+    elif mode != 'eigh':
+        raise AttributeError('Unknown orthogonalization mode: ' + str(mode))
+
+    try:
+        D, V = eigh(WWt)
+    except LinAlgError as e:
+        raise LinAlgError('Orthogonalization of the ORICA weights failed (eigendecomposition of W W^T): ' + str(e))
+
+    return np.matmul(V * (1. / (np.sqrt(np.abs(D)) * np.sign(D))), np.matmul(V.T, icaweights)).astype(dtype,
+                                                                                                      copy=False)
+
+
+def adjacency_operator(adjacency, n_chans=None):
+    '''Compiles an adjacency graph into a sparse row-normalized smoothing operator.
+
+    Parameters
+    ----------
+    adjacency:  list of neighbor lists, one per channel (e.g. from tools.extract_adjacency)
+    n_chans:    number of channels (default -> len(adjacency))
+
+    Returns
+    -------
+    A: (n_chans x n_chans) csr matrix with A[j, k] = 1/len(adjacency[j]) for k in adjacency[j], so that the
+       neighbor average of each row of W (W_s[i, j] = mean(W[i, adjacency[j]])) is W A^T. Channels without
+       neighbors are averaged on themselves.
+
+    '''
+    if n_chans is None:
+        n_chans = len(adjacency)
+    rows, cols, vals = [], [], []
+    for j, adj in enumerate(adjacency):
+        if len(adj) == 0:
+            adj = [j]
+        rows.extend([j] * len(adj))
+        cols.extend(adj)
+        vals.extend([1. / len(adj)] * len(adj))
+
+    return sparse.csr_matrix((vals, (rows, cols)), shape=(n_chans, n_chans))
+
+
+def block_ranges(n_samples, n_blocks, numpass=1, shuffle=False, seed=None):
+    '''Yields (pass, block index, dataRange) for numpass passes over n_samples samples split in n_blocks blocks.
+
+    Passes are virtual: block indices wrap around the recording, so no copy of the data is made and blocks can be
+    read one at a time (e.g. from a memmap). If shuffle is True, the order of the blocks is shuffled at every pass.
+    '''
+    rng = np.random.RandomState(seed)
+    for it in range(numpass):
+        order = np.arange(n_blocks)
+        if shuffle:
+            rng.shuffle(order)
+        for bi in order:
+            yield it, bi, np.arange(int(np.floor(bi * n_samples / n_blocks)),
+                                    int(np.min([n_samples, np.floor((bi + 1) * n_samples / n_blocks)])))
+
+
+def run_pipeline(items, stages, queue_size=4):
+    '''Runs items through a chain of stages, each stage on its own thread, connected by bounded queues.
+
+    The first stage is applied to every item in the calling thread; every following stage receives the output
+    tuple of the previous one as arguments, so stage k can process item i while stage k-1 processes item i+1.
+    Stages must not share mutable state other than through their outputs. NumPy releases the GIL in BLAS calls,
+    so matmul/eigh heavy stages overlap on multicore machines. An exception in any stage stops the pipeline and is
+    re-raised in the calling thread.
+
+    Parameters
+    ----------
+    items:      iterable of arguments (tuples) for the first stage
+    stages:     list of functions
+    queue_size: maximum number of items waiting between two stages (bounds memory and latency)
+
+    '''
+    errors = []
+
+    def worker(func, q_in, q_out):
+        while True:
+            args = q_in.get()
+            if args is None:
+                break
+            if len(errors) != 0:
+                # drain the queue so that upstream stages are not blocked
+                continue
+            try:
+                out = func(*args)
+            except Exception as e:
+                errors.append(e)
+                continue
+            if q_out is not None:
+                q_out.put(out)
+        if q_out is not None:
+            q_out.put(None)
+
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages[1:]]
+    threads = []
+    for i, func in enumerate(stages[1:]):
+        q_out = queues[i + 1] if i + 1 < len(queues) else None
+        thread = threading.Thread(target=worker, args=(func, queues[i], q_out))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    try:
+        for args in items:
+            if len(errors) != 0:
+                break
+            out = stages[0](*args)
+            if len(queues) != 0:
+                queues[0].put(out)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        if len(queues) != 0:
+            queues[0].put(None)
+        for thread in threads:
+            thread.join()
+
+    if len(errors) != 0:
+        raise errors[0]
+
+
+def orica_adaptive_ff(lambda_pr, n_samples, gain, decay_rate_alpha, n_loop=1024, n_correct=8, tol=1e-8):
+    '''Adaptive forgetting factors of a block: lambda_i = (1 + gain) lambda_{i-1} - alpha lambda_{i-1}^2.
+
+    Short blocks (n_samples <= n_loop) run the recurrence on python floats. Longer blocks start from the closed form
+    of the Beverton-Holt map lambda_i = r lambda_{i-1} / (1 + alpha / r lambda_{i-1}) (r = 1 + gain), which agrees
+    with the recurrence up to O((alpha lambda)^2) per sample, and apply corrections obtained by solving the
+    recurrence linearized around the current sequence (a linear recurrence, solved with cumprod/cumsum).
+    Each correction squares the relative error, so corrections stop once the relative correction is below tol
+    (the result then matches the recurrence to rounding error). If that does not happen within n_correct
+    corrections, the plain recurrence is used.
+
+    Parameters
+    ----------
+    lambda_pr:          last forgetting factor of the previous block
+    n_samples:          number of samples in the block
+    gain:               gain for errors (from the non-stationarity index)
+    decay_rate_alpha:   decay rate
+    n_loop:             longest block computed with the plain recurrence
+    n_correct:          maximum number of corrections of the closed form (0 -> plain recurrence)
+    tol:                relative correction below which the sequence is converged
+
+    Returns
+    -------
+    lambda_: (n_samples) forgetting factors
+
+    '''
+    r = 1. + float(gain)
+    alpha = float(decay_rate_alpha)
+    lam = float(lambda_pr)
+
+    if n_samples <= n_loop or n_correct == 0:
+        lambda_ = np.zeros(n_samples)
+        for i in range(n_samples):
+            lam = lam * (r - alpha * lam)
+            lambda_[i] = lam
+        return lambda_
+
+    k = np.arange(1, n_samples + 1)
+    # 1 / lambda_k is linear for the Beverton-Holt map: 1/lambda_k = r^-k / lambda_pr + alpha / r^2 sum_j<k r^-j
+    if gain > 0:
+        r_k = np.exp(-k * np.log1p(gain))
+        geom = -np.expm1(-k * np.log1p(gain)) / gain * r
+    else:
+        r_k = np.ones(n_samples)
+        geom = k.astype(float)
+    lambda_ = 1. / (r_k / lam + alpha / r ** 2 * geom)
+
+    for it in range(n_correct):
+        lambda_prev = np.concatenate(([lam], lambda_[:-1]))
+        # residual and derivative of the recurrence: e_i = a_i e_{i-1} + d_i, e_0 = 0
+        d = lambda_prev * (r - alpha * lambda_prev) - lambda_
+        a = r - 2 * alpha * lambda_prev
+        a[0] = 1.
+        a_prod = np.cumprod(a)
+        correction = a_prod * np.cumsum(d / a_prod)
+        lambda_ += correction
+        if np.max(np.abs(correction) / lambda_) < tol:
+            return lambda_
+
+    return orica_adaptive_ff(lambda_pr, n_samples, gain, decay_rate_alpha, n_loop, 0)
+
+
+class ORICABase():
+    '''Forgetting factor profiles (parameters in self.adaptiveFF), partial_fit() buffering and checkpointing shared
+    by the ORICA classes.'''
+    # references to the input data and sources of the whole recording, not saved in checkpoints
+    transient = ['data', 'y', '_y']
+
+    def splitChunk(self, chunk, block):
+        '''Returns the blocks of exactly block samples of the samples left over from the previous call followed by
+        chunk. The remaining (less than block) samples are kept in self.pending for the next call (see flush()).'''
+        if self.pending is not None and self.pending.shape[1] > 0:
+            chunk = np.concatenate((self.pending, chunk), axis=1)
+        n_blocks = chunk.shape[1] // block
+        self.pending = chunk[:, n_blocks * block:].copy()
+        return [chunk[:, bi * block:(bi + 1) * block] for bi in range(n_blocks)]
+
+    def save(self, filename):
+        '''Saves the full state (weights, sphere, forgetting factors, counters, non-stationarity, histories,
+        diagnostics...) to filename, so that the separation can be resumed with load() and partial_fit().
+        The input data and the sources of the whole recording (y) are not saved.'''
+        import pickle
+
+        state = dict(self.__dict__)
+        for name in self.transient:
+            if name in state:
+                state[name] = None
+        with open(filename, 'wb') as f:
+            pickle.dump({'class': self.__class__, 'state': state}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(filename):
+        '''Returns the ORICA/onlineORICAss object saved in filename (see save()). Data can be fed with
+        partial_fit() to resume the separation.'''
+        import pickle
+
+        with open(filename, 'rb') as f:
+            saved = pickle.load(f)
+        obj = saved['class'].__new__(saved['class'])
+        obj.__dict__.update(saved['state'])
+        obj.restoreTransient()
+        return obj
+
+    def restoreTransient(self):
+        '''Rebuilds attributes dropped by save() that can be derived from the saved state.'''
+        pass
+
+    def genCoolingFF(self, t, gamma, lambda_0, min_lambda=0):
+        lambda_ = lambda_0 / (t ** gamma)
+        if min_lambda != 0:
+            lambda_[lambda_<min_lambda] = min_lambda
+        return lambda_
+
+    def blockCoolingFF(self, t, min_lambda=0):
+        '''Cooling forgetting factors of the samples t, replaced by the constant lambda_const once they fall below
+        it.'''
+        lambda_ = self.genCoolingFF(t, self.adaptiveFF['gamma'], self.adaptiveFF['lambda_0'], min_lambda)
+        if lambda_[0] < self.adaptiveFF['lambda_const']:
+            lambda_ = np.squeeze(np.tile(self.adaptiveFF['lambda_const'], (1, len(t))))
+        return lambda_
+
+    def leakyFitness(self, average, modelFitness):
+        '''Leaky average of the model fitness (Rn, Vn) whose norm gives the non-stationarity (whitening) index.
+        The average restarts from modelFitness if it is empty or changed size.'''
+        if len(average) == 0 or average.shape != modelFitness.shape:
+            return modelFitness
+        delta = self.evalConvergence['leakyAvgDelta']
+        #!!! this does not account for block update!
+        return (1 - delta) * average + delta * modelFitness
+
+    def genAdaptiveFF(self, dataRange, lambda_in, ratioOfNormRn):
+        decayRateAlpha = self.adaptiveFF['decayRateAlpha']
+        upperBoundBeta = self.adaptiveFF['upperBoundBeta']
+        transBandWidthGamma = self.adaptiveFF['transBandWidthGamma']
+        transBandCenter = self.adaptiveFF['transBandCenter']
+
+        gainForErrors = upperBoundBeta * 0.5 * (1 + np.tanh((ratioOfNormRn - transBandCenter) / transBandWidthGamma))
+
+        return orica_adaptive_ff(lambda_in[-1], len(dataRange), gainForErrors, decayRateAlpha)
+
+
+class ORICA(ORICABase):
+    def __init__(self, data=None, numpass=1, weights=None, onlineWhitening=False, ndim='all', lambda_0=0.995,
+                 block_white=8, block_ica=8, nsub=0, white_mode='pca', pcaonly=False,
                  forgetfac='cooling', localstat=np.inf, ffdecayrate=0.6, evalconverg=True, verbose=False, mu=0, eta=0,
-                 adjacency=None, whiten=True, ortho=True):
+                 adjacency=None, whiten=True, ortho=True, n_chans=None, sphere=None, ortho_every=1,
+                 ortho_mode='eigh', ortho_iter=5, record_diagnostics=True, diagnostics_every=1, shuffle=False,
+                 seed=None, early_stopping=None, stop_tol=3e-2, stop_patience=50, dtype=np.float64):
         '''
 
         Parameters
         ----------
-        data:          np.array - input data (chans-by-samples)
-        numpass:       number of passes through the data
+        data:          np.array - input data (chans-by-samples). If None, ORICA is initialized for streaming and
+                       data blocks are fed with partial_fit()
+        numpass:       number of passes through the data (blocks are re-read, data are not copied)
         weights:       initial weight matrix     (default -> eye())
         sphering:      ['offline' | 'online'] use online RLS whitening method or pre-whitening
         block_white:   block size for online whitening (in samples)
@@ -73,6 +957,23 @@ class ORICA():
         mu:            coefficient for spatial smothing
         eta:           coefficient for temporal smoothing (when convolutive)
         adjacency:     adjavency matrix (if mu not 0)
+        n_chans:       number of channels (required when data is None)
+        sphere:        sphering matrix used with pre-whitening when data is None (default -> eye())
+        ortho_every:   orthogonalize weights every ortho_every blocks (default -> 1)
+        ortho_mode:    ['eigh'|'newton'] exact symmetric orthogonalization or Newton-Schulz iterations
+        ortho_iter:    maximum number of Newton-Schulz iterations (if ortho_mode is 'newton')
+        record_diagnostics: record lambdas, NSI and WI traces
+        diagnostics_every:  record diagnostic traces every diagnostics_every blocks (default -> 1)
+        shuffle:       shuffle the order of the blocks at every pass
+        seed:          random seed for shuffle
+        early_stopping: [None|'nsi'|'weights'] stop the passes through the data when the Non-Stationarity Index
+                       (requires evalconverg) or the weights plateau: they stay within stop_tol (relative change)
+                       for stop_patience consecutive blocks. The number of blocks processed is stored in n_blocks
+        stop_tol:      tolerance on the relative change for early stopping
+        stop_patience: number of consecutive blocks below stop_tol to stop
+        dtype:         [np.float64|np.float32] floating point type of data blocks, weights and sources (float32
+                       halves memory and memory bandwidth). Online whitening, means and convergence indices are
+                       accumulated in float64
 
         Reference:
           [1] S.-H. Hsu, T. Mullen, T.-P Jung, and G. Cauwenberghs, "Real-time
@@ -93,29 +994,61 @@ class ORICA():
                shh078@ucsd.edu
         '''
 
-        nChs, nPts = data.shape
+        if data is not None:
+            nChs, nPts = data.shape
+        elif n_chans is not None:
+            nChs = int(n_chans)
+        else:
+            raise AttributeError('Provide either data or n_chans')
+
         self.count = 0
+        self.dtype = check_dtype(dtype)
         self.whiten = whiten
         self.ortho = ortho
+        self.ortho_every = ortho_every
+        self.ortho_mode = ortho_mode
+        self.ortho_iter = ortho_iter
         self.ndim = ndim
         self.tracking = True
+        self.onlineWhitening = onlineWhitening
+        self.pcaonly = pcaonly
+        self.verbose = verbose
+
+        if early_stopping not in [None, 'nsi', 'weights']:
+            raise AttributeError('Unknown early stopping criterion: ' + str(early_stopping))
+        if early_stopping == 'nsi' and not evalconverg:
+            raise AttributeError("early_stopping='nsi' requires evalconverg")
+        self.early_stopping = early_stopping
+        self.stop_tol = stop_tol
+        self.stop_patience = stop_patience
+        self.n_blocks = 0
+        self.n_plateau = 0
+        self.converged = False
+        self.ref_criterion = None
 
         numPass = numpass
         verbose = verbose
 
         # Parameters for data whitening
+        self.block_white = block_white
+        self.block_ica = block_ica
         blockSizeWhite = block_white
         blockSizeICA = block_ica
         numSubgaussian = nsub
 
-        self.adaptiveFF = {'profile': forgetfac, 'tau_const': np.inf, 'gamma': 0.6, 'lambda_0': lambda_0, 'decayRateAlpha': 0.02,
+        self.adaptiveFF = {'profile': forgetfac, 'tau_const': np.inf, 'gamma': ffdecayrate, 'lambda_0': lambda_0, 'decayRateAlpha': 0.02,
                       'upperBoundBeta': 1e-3, 'transBandWidthGamma': 1, 'transBandCenter': 5, 'lambdaInitial': 0.1}
         self.evalConvergence = {'profile': evalconverg, 'leakyAvgDelta': 0.01, 'leakyAvgDeltaVar': 1e-3}
 
         self.adjacency = adjacency
         self.mu = mu
         self.eta = eta
+        if self.mu != 0:
+            if adjacency is None:
+                raise AttributeError('Provide adjacency for spatial smoothing (mu not 0)')
+            self.smoothing_operator = adjacency_operator(adjacency)
 
+        self.diagnostics = Diagnostics(record_diagnostics, diagnostics_every)
         self.lambdas = np.array([])
 
 
@@ -124,17 +1057,21 @@ class ORICA():
         ##############################
         if weights is None:
             if self.ndim == 'all':
-                icaweights = np.eye(nChs)
+                icaweights = np.eye(nChs, dtype=self.dtype)
             else:
-                icaweights = np.eye(self.ndim, self.ndim)
+                icaweights = np.eye(self.ndim, self.ndim, dtype=self.dtype)
+        else:
+            icaweights = np.asarray(weights, dtype=self.dtype)
 
-        if onlineWhitening:
-            if self.ndim == 'all':
-                icasphere = np.eye(nChs)
-            else:
-                icasphere = np.eye(self.ndim, nChs)
+        if self.ndim == 'all':
+            icasphere = np.eye(nChs)
+        else:
+            icasphere = np.eye(self.ndim, nChs)
 
         self.counter       = 1
+        # number of samples fed with partial_fit() and samples waiting for a complete block
+        self.n_seen = 0
+        self.pending = None
 
         if self.adaptiveFF['profile'] == 'cooling' or  self.adaptiveFF['profile'] == 'constant':
             self.adaptiveFF['lambda_const']  = 1-np.exp(-1 / (self.adaptiveFF['tau_const']))
@@ -156,51 +1093,56 @@ class ORICA():
             self.kurtsign = np.ones((self.ndim, 1))
         if numSubgaussian != 0:
             self.kurtsign[:numSubgaussian] = 0
+        # nonlinearity sign per component: -2 * tanh (supergaussian), 2 * tanh (subgaussian)
+        self.nlsign = np.where(self.kurtsign == 1, -2., 2.)
+        self.buffers = BlockBuffers(dtype=self.dtype)
 
 
         ######################
         # sphere-whiten data #
         ######################
+        # channel means removed before sphering (PCA whitening centers the data)
+        self.means = np.zeros((nChs, 1))
         if not onlineWhitening: # pre - whitening
             if verbose:
                 print('Use pre-whitening method.')
-            if self.whiten:
+            if data is None:
+                if sphere is not None:
+                    icasphere = sphere
+            elif self.whiten:
                 if self.ndim == 'all':
                     if white_mode == 'pca':
                         print('PCA whitening')
-                        data_w, eigvecs, eigvals, sphere = whiten_data(data)
+                        _, eigvecs, eigvals, sphere = whiten_data(data)
                         icasphere = sphere
+                        self.means = np.mean(data, axis=1, keepdims=True, dtype=np.float64)
                     elif white_mode == 'zca':
                         print('ZCA whitening')
                         # TODO use SVD and compute ZCA VS PCA
                         icasphere = la.inv(sqrtm(np.cov(data)))
-                        data_w = np.matmul(icasphere, data)
                 else:
-                    # data_w = np.matmul(icasphere, data)
-                    data_w, eigvecs, eigvals, sphere = whiten_data(data, self.ndim)
+                    _, eigvecs, eigvals, sphere = whiten_data(data, self.ndim)
                     icasphere = sphere
+                    self.means = np.mean(data, axis=1, keepdims=True, dtype=np.float64)
             else:
                 print('Initializing weights to sphering matrix')
-                data_w = np.zeros_like(data, dtype=dtype)
-                icaweights = icasphere
+                if self.ndim == 'all':
+                    _, eigvecs, eigvals, sphere = whiten_data(data)
+                else:
+                    _, eigvecs, eigvals, sphere = whiten_data(data, self.ndim)
+                icaweights = sphere.astype(self.dtype)
         else: # Online RLS Whitening
             if verbose:
                 print('Use online whitening method.')
-            if self.ndim == 'all':
-                data_w = np.zeros_like(data)
+            if self.ndim == 'all' and data is not None:
                 n_samples = int(0.1 * 32000)
 
                 print('initializing eigenvectors and values')
                 data_init = data[:, :n_samples]
                 _, eigvecs, eigvals, sphere = whiten_data(data_init)
 
-                self.eigvecs = eigenvecs
-                self.eigvals = eigenvals
-            else:
-                data_w = np.zeros((self.ndim, nPts))
-
-
-        # whiten / sphere the data
+                self.eigvecs = eigvecs
+                self.eigvals = eigvals
 
 
         # self.state = State(icaweights, icasphere, lambda_k, minNonStatIdx, counter, Rn, nonStatIdx, kurtsign)
@@ -208,6 +1150,12 @@ class ORICA():
         self.icasphere = icasphere
         self.icasphere_1 = la.pinv(self.icasphere)
 
+        self.NSI = np.array([])
+        self.WI = np.array([])
+
+        if data is None:
+            return
+
         #########
         # ORICA #
         #########
@@ -215,9 +1163,6 @@ class ORICA():
         # divide data into blocks for online block update
         numBlock = int(np.floor(nPts / np.min([blockSizeICA, blockSizeWhite])))
 
-        self.NSI = []
-        self.WI = []
-
         if verbose:
             printflag = 0
             if self.adaptiveFF['profile'] == 'cooling':
@@ -228,91 +1173,160 @@ class ORICA():
                 print('Running ORICA with adaptive forgetting factor...')
         t_start = time.time()
 
-        for it in range(numPass):
-            for bi in range(numBlock):
-                dataRange = np.arange(int(np.floor(bi * nPts / numBlock)),
-                                  int(np.min([nPts, np.floor((bi + 1) * nPts / numBlock)])))
-                if onlineWhitening:
-                    self.dynamicWhitening(data[:, dataRange], dataRange)
-                    #self.dynamicPCA(data[:, dataRange], dataRange)
-                    data_w[:, dataRange] = np.matmul(self.icasphere, data[:, dataRange])
-
-                if not pcaonly:
-                    self.dynamicOrica(data_w[:, dataRange], dataRange)
+        for i_block, (it, bi, dataRange) in enumerate(block_ranges(nPts, numBlock, numPass, shuffle, seed)):
+            self.updateBlock(data[:, dataRange], dataRange)
 
+            if verbose:
+                if printflag < np.floor(10 * i_block / numPass / numBlock):
+                    printflag = printflag + 1
+                    print(10 * printflag, '%')
+            if self.converged:
                 if verbose:
-                    if printflag < np.floor(10 * (it * numBlock + bi) / numPass / numBlock):
-                        printflag = printflag + 1
-                        print(10 * printflag, '%')
+                    print('Converged after ', self.n_blocks, ' blocks (pass ', it + 1, ')')
+                break
+        self.n_seen = nPts
 
         if verbose:
             processing_time = time.time() - t_start
             print('ORICA Finished. Elapsed time: ', processing_time, ' sec.')
 
         # output weights and sphere matrices
-        self.sphere = self.icasphere
+        self.updateOutputs()
         if not pcaonly:
+            self.y = self.transform(data)
+
+
+    def partial_fit(self, chunk):
+        '''Updates the ORICA state with a new chunk of data (chans-by-samples).
+
+        Blocks of exactly min(block_ica, block_white) samples are processed, so acquisition buffers of any length
+        can be fed directly: samples left over at the end of a chunk are processed with the next chunk (or by
+        flush()). State is carried over between calls.
+        '''
+        for blockdata in self.splitChunk(chunk, int(np.min([self.block_ica, self.block_white]))):
+            nPts = blockdata.shape[1]
+            self.updateBlock(blockdata, self.n_seen + np.arange(nPts))
+            self.n_seen += nPts
+
+        return self
+
+
+    def flush(self):
+        '''Processes the samples left over by partial_fit() as a last (shorter) block.'''
+        if self.pending is not None and self.pending.shape[1] > 0:
+            nPts = self.pending.shape[1]
+            self.updateBlock(self.pending, self.n_seen + np.arange(nPts))
+            self.n_seen += nPts
+            self.pending = self.pending[:, :0]
+
+        return self
+
+
+    def transform(self, chunk):
+        '''Projects a chunk of data (chans-by-samples) on the current sources.'''
+        if self.whiten:
+            unmixing = np.matmul(self.icaweights, self.icasphere)
+        else:
+            unmixing = self.icaweights
+        return np.matmul(unmixing.astype(self.dtype, copy=False), chunk.astype(self.dtype, copy=False))
+
+
+    def updateOutputs(self):
+        '''Computes sphere, unmixing and mixing matrices from the current state.'''
+        self.lambdas = self.diagnostics.get('lambdas')
+        self.NSI = self.diagnostics.get('NSI')
+        self.WI = self.diagnostics.get('WI')
+        self.sphere = self.icasphere
+        if not self.pcaonly:
+            # outputs are computed in the working precision, like the sources
             if self.whiten:
-                self.unmixing = np.matmul(self.icaweights, self.sphere)
+                self.unmixing = np.matmul(self.icaweights, self.sphere.astype(self.dtype, copy=False))
             else:
-                self.unmixing = self.icaweights
+                self.unmixing = self.icaweights.astype(self.dtype, copy=False)
             self.mixing = la.pinv(self.unmixing).T
-            self.y = np.matmul(self.unmixing, data)
+
+
+    def updateBlock(self, blockdata, dataRange):
+        blockdata = blockdata.astype(self.dtype, copy=False)
+        if self.onlineWhitening:
+            self.dynamicWhitening(blockdata, dataRange)
+            #self.dynamicPCA(blockdata, dataRange)
+
+        if not self.pcaonly:
+            if self.whiten:
+                # the (float64) online sphere and means are applied in the working precision
+                blockdata_w = np.matmul(self.icasphere.astype(self.dtype, copy=False),
+                                        blockdata - self.means.astype(self.dtype, copy=False))
+            else:
+                blockdata_w = blockdata
+            self.dynamicOrica(blockdata_w, dataRange)
+        self.n_blocks += 1
+
+        if self.early_stopping is not None and not self.pcaonly:
+            self.checkConvergence()
+
+
+    def checkConvergence(self):
+        '''Counts consecutive blocks in which the early stopping criterion stays within stop_tol (relative) of its
+        value at the start of the plateau. The plateau restarts from the current value when it drifts further.'''
+        if self.early_stopping == 'nsi':
+            criterion = self.nonStatIdx
+        else:
+            criterion = self.icaweights
+
+        if self.ref_criterion is not None:
+            change = la.norm(criterion - self.ref_criterion) / la.norm(self.ref_criterion)
+            if change < self.stop_tol:
+                self.n_plateau += 1
+            else:
+                self.n_plateau = 0
+        if self.n_plateau == 0:
+            self.ref_criterion = np.copy(criterion)
+        self.converged = self.n_plateau >= self.stop_patience
 
 
     def dynamicWhitening(self, blockdata, dataRange):
         nChs, nPts = blockdata.shape
 
         if self.adaptiveFF['profile'] == 'cooling':
-            lambda_ = self.genCoolingFF(self.counter+dataRange, self.adaptiveFF['gamma'], self.adaptiveFF['lambda_0'])
-            if lambda_[0] < self.adaptiveFF['lambda_const']:
-                lambda_ = np.squeeze(np.tile(self.adaptiveFF['lambda_const'], (1, nPts)))
+            lambda_ = self.blockCoolingFF(self.counter + dataRange)
         elif self.adaptiveFF['profile'] == 'constant':
             lambda_ = np.squeeze(np.tile(self.adaptiveFF['lambda_const'], (1, nPts)))
         elif self.adaptiveFF['profile'] == 'adaptive':
             lambda_ = np.squeeze(np.tile(self.lambda_k[-1], (1, nPts)))
 
         v = np.matmul(self.icasphere, blockdata) # pre - whitened data
+        cov = None
 
         if self.evalConvergence['profile']:
-            modelFitness = np.eye(nChs) + np.matmul(v, v.T)/nPts
-            if len(self.Vn) == 0:
-                self.Vn = modelFitness
-            else:
-                self.Vn = (1 - self.evalConvergence['leakyAvgDelta']) * self.Vn + \
-                                self.evalConvergence['leakyAvgDelta'] * modelFitness
-                #!!! this does not account for block update!
+            cov = np.matmul(v, v.T)
+            modelFitness = np.eye(nChs) + cov/nPts
+            self.Vn = self.leakyFitness(self.Vn, modelFitness)
             self.whiteIdx = la.norm(self.Vn)
-            self.WI.append(self.whiteIdx)
+            self.diagnostics.record('WI', self.whiteIdx)
 
         lambda_avg = 1 - lambda_[int(np.ceil((len(lambda_)-1) / 2))] # median lambda
-        QWhite = lambda_avg / (1-lambda_avg) + np.trace(np.matmul(v, v.T)) / nPts
-        self.icasphere = 1 / lambda_avg * (self.icasphere - np.matmul(np.matmul(v, v.T) / nPts / QWhite, self.icasphere))
+        self.icasphere = rls_whitening_update(self.icasphere, v, lambda_avg, cov)
 
     def dynamicPCA(self, blockdata, dataRange, method='gha'):
         nChs, nPts = blockdata.shape
 
         if self.adaptiveFF['profile'] == 'cooling':
-            lambda_ = self.genCoolingFF(self.counter+dataRange, self.adaptiveFF['gamma'], self.adaptiveFF['lambda_0'])
-            if lambda_[0] < self.adaptiveFF['lambda_const']:
-                lambda_ = np.squeeze(np.tile(self.adaptiveFF['lambda_const'], (1, nPts)))
+            lambda_ = self.blockCoolingFF(self.counter + dataRange)
         elif self.adaptiveFF['profile'] == 'constant':
             lambda_ = np.squeeze(np.tile(self.adaptiveFF['lambda_const'], (1, nPts)))
         elif self.adaptiveFF['profile'] == 'adaptive':
             lambda_ = np.squeeze(np.tile(self.lambda_k[-1], (1, nPts)))
 
         v = np.matmul(self.icasphere, blockdata) # pre - whitened data
+        cov = None
 
         if self.evalConvergence['profile']:
-            modelFitness = np.eye(nChs) + np.matmul(v, v.T)/nPts
-            if len(self.Vn) == 0:
-                self.Vn = modelFitness
-            else:
-                self.Vn = (1 - self.evalConvergence['leakyAvgDelta']) * self.Vn + \
-                                self.evalConvergence['leakyAvgDelta'] * modelFitness
-                #!!! this does not account for block update!
+            cov = np.matmul(v, v.T)
+            modelFitness = np.eye(nChs) + cov/nPts
+            self.Vn = self.leakyFitness(self.Vn, modelFitness)
             self.whiteIdx = la.norm(self.Vn)
-            self.WI.append(self.whiteIdx)
+            self.diagnostics.record('WI', self.whiteIdx)
 
         if method == 'gha':
             U = self.eigvecs
@@ -328,38 +1342,21 @@ class ORICA():
 
         # initialize
         nChs, nPts = blockdata.shape
-        f = np.zeros((nChs, nPts))
-        # compute source activation using previous weight matrix
-        y = np.matmul(self.icaweights, blockdata)
-
-        # raise Exception()
-
+        # compute source activation using previous weight matrix and
         # choose nonlinear functions for super- vs. sub-gaussian
-        if nlfunc is None:
-            f[np.where(self.kurtsign==1), :]  = -2 * np.tanh(y[np.where(self.kurtsign==1), :])  # Supergaussian
-            f[np.where(self.kurtsign==0), :] = 2 * np.tanh(y[np.where(self.kurtsign==0), :])  # Subgaussian
-        else:
-            f = nlfunc(y);
+        y, f = orica_sources(self.icaweights, blockdata, self.nlsign, self.buffers, nlfunc)
 
         # compute Non-Stationarity Index (nonStatIdx) and variance of source dynamics (Var)
         if self.evalConvergence['profile']:
             # modelFitness = np.eye(nChs) + np.matmul(y, f.T)/nPts
             modelFitness = np.eye(nChs) + np.matmul(y, f.T)/nPts
-            if len(self.Rn) == 0:
-                self.Rn = modelFitness
-            else:
-                self.Rn = (1 - self.evalConvergence['leakyAvgDelta']) * self.Rn + \
-                                self.evalConvergence['leakyAvgDelta'] * modelFitness
-                #!!! this does not account for block update!
+            self.Rn = self.leakyFitness(self.Rn, modelFitness)
             self.nonStatIdx = la.norm(self.Rn)
-            self.NSI.append(self.nonStatIdx)
+            self.diagnostics.record('NSI', self.nonStatIdx)
 
 
         if self.adaptiveFF['profile'] == 'cooling':
-            self.lambda_k = self.genCoolingFF(self.counter + dataRange, self.adaptiveFF['gamma'],
-                                                    self.adaptiveFF['lambda_0'])
-            if self.lambda_k[0] < self.adaptiveFF['lambda_const']:
-                self.lambda_k = np.squeeze(np.tile(self.adaptiveFF['lambda_const'], (1, nPts)))
+            self.lambda_k = self.blockCoolingFF(self.counter + dataRange)
             self.counter = self.counter + nPts
         elif self.adaptiveFF['profile'] == 'constant':
             self.lambda_k = np.arange(nPts) * self.adaptiveFF['lambda_0']
@@ -370,77 +1367,206 @@ class ORICA():
             ratioOfNormRn = self.nonStatIdx / self.minNonStatIdx
             self.lambda_k = self.genAdaptiveFF(dataRange, self.lambda_k, ratioOfNormRn)
 
-        self.lambdas = np.concatenate((self.lambdas, self.lambda_k))
+        self.diagnostics.record('lambdas', self.lambda_k, samples=True)
 
         # update weight matrix using online recursive ICA block update rule
-        lambda_prod = np.prod(1. / (1.-self.lambda_k))
-        # Q = 1 + self.lambda_k * (np.einsum('km,km->m', f, y)-1);
-        Q = 1 + self.lambda_k * (np.sum(f * y, axis=0) - 1);
-        curr_state = self.icaweights
-
         self.count += 1
 
         # Compute smoothing factor
         if self.mu != 0:
-            smoothing_matrix = np.zeros(self.icaweights.shape)
-            for i, comp in enumerate(smoothing_matrix):
-                for adj in self.adjacency:
-                    smoothing_matrix[i] = 1./len(adj)*np.sum(self.icaweights[i, adj])
-
-            self.icaweights = lambda_prod * ((self.icaweights -
-                                                   np.matmul(np.matmul(np.matmul(y,  np.diag(self.lambda_k / Q)),
-                                                             f.T), self.icaweights)) -
-                                                   self.mu*(self.icaweights - smoothing_matrix)) #- eta*())
+            # neighbor average of the weights: W A^T
+            smoothing_matrix = self.smoothing_operator.dot(self.icaweights.T).T
+
+            self.icaweights = orica_weight_update(self.icaweights, y, f, self.lambda_k, self.buffers,
+                                                  reg=self.mu*(self.icaweights - smoothing_matrix)) #- eta*())
         else:
-            self.icaweights = lambda_prod * (self.icaweights -
-                                                   np.matmul(np.matmul(np.matmul(y, np.diag(self.lambda_k / Q)),
-                                                                    f.T), self.icaweights))
+            self.icaweights = orica_weight_update(self.icaweights, y, f, self.lambda_k, self.buffers)
 
 
         # orthogonalize weight matrix
         if self.ortho:
-            try:
-                D, V = eigh(np.matmul(self.icaweights, self.icaweights.T))
-            except LinAlgError:
-                raise Exception()
-
-            # curr_state = self.icaweights
-            self.icaweights = np.matmul(np.matmul(la.solve(np.diag((np.sqrt(np.abs(D)) * np.sign(D))).T, V.T).T,
-                                                        V.T), self.icaweights)
+            if not np.mod(self.count, self.ortho_every):
+                self.icaweights = orica_orthogonalize(self.icaweights, mode=self.ortho_mode, n_iter=self.ortho_iter)
+            else:
+                # keep unit row norm on average between orthogonalizations
+                self.icaweights = self.icaweights * np.sqrt(self.icaweights.shape[0] /
+                                                            np.sum(self.icaweights ** 2))
         else:
             self.icaweights = self.icaweights / np.max(np.abs(self.icaweights))
 
-    def genCoolingFF(self, t, gamma, lambda_0):
-        lambda_ = lambda_0 / (t ** gamma)
-        return lambda_
 
-    def genAdaptiveFF(self, dataRange, lambda_in, ratioOfNormRn):
-        decayRateAlpha = self.adaptiveFF['decayRateAlpha']
-        upperBoundBeta = self.adaptiveFF['upperBoundBeta']
-        transBandWidthGamma = self.adaptiveFF['transBandWidthGamma']
-        transBandCenter = self.adaptiveFF['transBandCenter']
+class ORICASweep():
+    def __init__(self, data, configs, block=500, numpass=1, ndim='all', nsub=0, adjacency=None, verbose=False,
+                 dtype=np.float64):
+        '''Runs K ORICA configurations in a single pass through the data.
 
-        gainForErrors = upperBoundBeta * 0.5 * (1 + np.tanh((ratioOfNormRn - transBandCenter) / transBandWidthGamma))
-        nrange = np.arange(len(dataRange))
-        lambda_ = np.zeros(len(dataRange))
-        lam_pr = lambda_in[-1]
-        for i in nrange:
-            lam_new = (1 + gainForErrors) * lam_pr - decayRateAlpha * lam_pr **2
-            lambda_[i] = lam_new
-            lam_pr = lam_new
-        return lambda_
+        The recording is pre-whitened once (PCA, as ORICA) and every whitened block is shared by all the
+        configurations: their weights are stacked in a (K x n x n) array and updated with batched matmuls and a
+        batched symmetric orthogonalization. For a given block size, the result of each configuration is the
+        one of ORICA(data, block_white=block, block_ica=block, evalconverg=False, ...) with the same parameters
+        (including ffdecayrate), up to rounding: configurations with forgetting factors close to or above 1 (e.g.
+        cooling lambda_0 > 1, constant lambda_0 > 1e-3) amplify rounding differences to O(1), in ORICA as well.
+        A configuration whose weights become non-finite (e.g. constant forgetting factor with a large lambda_0) is
+        frozen and reported as diverged (NaN unmixing, mixing and performance), the others are not affected.
+
+        Parameters
+        ----------
+        data:       np.array - input data (chans-by-samples)
+        configs:    list of dicts with keys:
+                    'forgetfac': ['cooling'|'constant'] forgetting factor profile (default -> 'cooling')
+                    'lambda_0': initial forgetting factor (default -> 0.995)
+                    'ffdecayrate': decay rate of the cooling forgetting factor (default -> 0.6)
+                    'mu': coefficient for spatial smoothing (default -> 0, requires adjacency)
+                    'numpass': number of passes through the data (default -> numpass)
+        block:      block size (in samples)
+        numpass:    default number of passes
+        ndim:       number of dimensions after PCA whitening (default -> 'all')
+        nsub:       number of subgaussian sources
+        adjacency:  adjacency graph (if any mu not 0)
+        verbose:    bool - give ascii messages
+        dtype:      [np.float64|np.float32] floating point type of whitened blocks and weights
+
+        '''
+        nChs, nPts = data.shape
+        self.dtype = check_dtype(dtype)
+        self.configs = configs
+        self.block = block
+        K = len(configs)
+
+        forgetfac = [c.get('forgetfac', 'cooling') for c in configs]
+        for ff in forgetfac:
+            if ff not in ['cooling', 'constant']:
+                raise AttributeError('Sweep supports cooling and constant forgetting factors, not ' + str(ff))
+        self.cooling = np.array([ff == 'cooling' for ff in forgetfac])
+        self.lambda_0 = np.array([float(c.get('lambda_0', 0.995)) for c in configs])
+        self.gamma = np.array([float(c.get('ffdecayrate', 0.6)) for c in configs])
+        self.mu = np.array([float(c.get('mu', 0)) for c in configs])
+        self.numpass = np.array([int(c.get('numpass', numpass)) for c in configs])
+        if np.any(self.mu != 0):
+            if adjacency is None:
+                raise AttributeError('Provide adjacency for spatial smoothing (mu not 0)')
+            smoothing = adjacency_operator(adjacency, nChs).T.toarray().astype(self.dtype)
+
+        # shared PCA whitening
+        if ndim == 'all':
+            _, eigvecs, eigvals, sphere = whiten_data(data)
+        else:
+            _, eigvecs, eigvals, sphere = whiten_data(data, ndim)
+        self.sphere = sphere
+        self.means = np.mean(data, axis=1, keepdims=True, dtype=np.float64)
+        sphere = sphere.astype(self.dtype)
+        means = self.means.astype(self.dtype)
+        n = sphere.shape[0]
+        if np.any(self.mu != 0) and n != nChs:
+            raise AttributeError('Spatial smoothing requires ndim=all')
+
+        kurtsign = np.ones((n, 1))
+        if nsub != 0:
+            kurtsign[:nsub] = 0
+        nlsign = np.where(kurtsign == 1, -2., 2.)
+
+        self.icaweights = np.tile(np.eye(n, dtype=self.dtype), (K, 1, 1))
+        self.final_weights = np.zeros((K, n, n), dtype=self.dtype)
+        self.counter = 1
+        # configurations with non-finite weights before their last pass (frozen) and finished configurations
+        self.diverged = np.zeros(K, dtype=bool)
+        finished = np.zeros(K, dtype=bool)
+
+        numBlock = int(np.floor(nPts / block))
+        t_start = time.time()
+        for (it, bi, dataRange) in block_ranges(nPts, numBlock, np.max(self.numpass)):
+            blockdata_w = np.matmul(sphere, data[:, dataRange].astype(self.dtype, copy=False) - means)
+            nB = len(dataRange)
+
+            # (K x n x block) sources and nonlinearities
+            y = np.matmul(self.icaweights, blockdata_w)
+            f = np.tanh(y)
+            f *= nlsign
+
+            # (K x block) forgetting factors
+            lambda_k = np.where(self.cooling[:, np.newaxis],
+                                self.lambda_0[:, np.newaxis] / (self.counter + dataRange) ** self.gamma[:, np.newaxis],
+                                np.arange(nB) * self.lambda_0[:, np.newaxis])
+            self.counter += nB
+
+            with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+                lambda_prod = np.prod(1. / (1. - lambda_k), axis=1)
+                Q = 1 + lambda_k * (np.einsum('kij,kij->kj', f, y) - 1)
+                y *= (lambda_k / Q)[:, np.newaxis, :]
+                W = self.icaweights - np.matmul(np.matmul(y, f.transpose(0, 2, 1)), self.icaweights)
+                if np.any(self.mu != 0):
+                    W -= self.mu[:, np.newaxis, np.newaxis] * (self.icaweights -
+                                                               np.matmul(self.icaweights, smoothing))
+                if self.dtype == np.float64:
+                    # global scale, removed by the orthogonalization (see orica_weight_update)
+                    W *= lambda_prod[:, np.newaxis, np.newaxis]
+                # non-finite weights are replaced by the identity so that the batched eigh never fails
+                bad = ~np.all(np.isfinite(W), axis=(1, 2))
+                W[bad] = np.eye(n)
+
+                # batched symmetric orthogonalization
+                D, V = np.linalg.eigh(np.matmul(W, W.transpose(0, 2, 1)))
+                self.icaweights = np.matmul(V / (np.sqrt(np.abs(D)) * np.sign(D))[:, np.newaxis, :],
+                                            np.matmul(V.transpose(0, 2, 1), W))
+            bad_ortho = ~np.all(np.isfinite(self.icaweights), axis=(1, 2))
+            self.icaweights[bad_ortho] = np.eye(n)
+            new_diverged = (bad | bad_ortho) & ~finished & ~self.diverged
+            if np.any(new_diverged) and verbose:
+                print('Diverged configurations: ', [self.configs[k] for k in np.where(new_diverged)[0]])
+            self.diverged |= new_diverged
+
+            if bi == numBlock - 1:
+                done = self.numpass == it + 1
+                self.final_weights[done] = self.icaweights[done]
+                finished |= done
 
+        if verbose:
+            print('ORICA sweep (', K, ' configurations) finished. Elapsed time: ', time.time() - t_start, ' sec.')
+
+        self.final_weights[self.diverged] = np.nan
+        self.unmixing = np.matmul(self.final_weights, self.sphere)
+        self.mixing = np.full(self.unmixing.shape, np.nan)
+        converged = ~self.diverged
+        if np.any(converged):
+            self.mixing[converged] = np.linalg.pinv(self.unmixing[converged]).transpose(0, 2, 1)
+
+
+    def evaluate(self, mixing):
+        '''Returns, for each configuration, a dict with its parameters, the performance index (PI) and the average
+        absolute correlation between ground-truth and estimated mixing columns (matched with matcorr). PI and CC_mix
+        are NaN for diverged configurations.'''
+        results = []
+        for (config, unmixing, a, diverged) in zip(self.configs, self.unmixing, self.mixing, self.diverged):
+            res = dict(config)
+            if diverged:
+                res.update({'PI': np.nan, 'CC_mix': np.nan, 'diverged': True})
+            else:
+                PI, _ = evaluate_PI(unmixing, mixing)
+                correlation, idx_truth, idx_orica, _ = matcorr(mixing.T, a)
+                res.update({'PI': PI, 'CC_mix': np.mean(np.abs(correlation)), 'diverged': False})
+            results.append(res)
+        return results
+
+
+class onlineORICAss(ORICABase):
+    # y_on refers to the source history (a memmap history is saved as a file reference)
+    transient = ORICABase.transient + ['y_on']
 
-class onlineORICAss():
-    def __init__(self, data, fs, ndim='all', onlineWhitening=True, calibratePCA=True, forgetfac='cooling',
+    def __init__(self, data=None, fs=None, ndim='all', onlineWhitening=True, calibratePCA=True, forgetfac='cooling',
                  skew_thresh=0.5, lambda_0=0.995, min_lambda=0, block=8, nsub=0, ffdecayrate=0.6, verbose=False,
                  pcaweights=[], weights=[], step_size=1, skew_window=20,
-                 pca_window=10, ica_window=0, detect_trheshold=8, onlineDetection=True, evalconverg=True, numpass=1):
+                 pca_window=10, ica_window=0, detect_trheshold=8, onlineDetection=True, evalconverg=True, numpass=1,
+                 n_chans=None, n_samples=None, sphere=None, ortho_every=1, ortho_mode='eigh', ortho_iter=5,
+                 source_history='full', history_file=None, running_skew=True, record_diagnostics=True,
+                 diagnostics_every=1, shuffle=False, seed=None, pipeline=False, queue_size=4, detect_noise='std',
+                 detect_memory=None, refractory=0, dtype=np.float64, history_every=1, history_cache=16,
+                 pca_mode='window'):
         '''
 
         Parameters
         ----------
-        data
+        data           (chans-by-samples) If None, the object is initialized for streaming and data are fed
+                       with partial_fit()
         fs
         forgetfac
         skew_thresh
@@ -453,12 +1579,57 @@ class onlineORICAss():
         steps
         window
         initial_window
+        n_chans        number of channels (required when data is None)
+        n_samples      expected number of samples when streaming (used to preallocate y_on)
+        sphere         sphering matrix used with pre-whitening when data is None (default -> eye())
+        ortho_every    orthogonalize weights every ortho_every blocks (default -> 1)
+        ortho_mode     ['eigh'|'newton'] exact symmetric orthogonalization or Newton-Schulz iterations
+        ortho_iter     maximum number of Newton-Schulz iterations (if ortho_mode is 'newton')
+        source_history ['full'|'window'|'memmap'] online sources (y_on) are kept for the whole recording,
+                       only for the skew window (memory independent of the recording length; y_on is then the
+                       last window), or for the whole recording in a memmap on disk (history_file)
+        history_file   memmap file for source_history='memmap'
+        running_skew   if True, the skewness for source selection is updated per block from running power sums
+                       (resynchronized every skew window), otherwise it is recomputed on the whole skew window
+        record_diagnostics record lambdas, NSI, WI, normNSI and ratios traces
+        diagnostics_every  record diagnostic traces every diagnostics_every blocks (default -> 1)
+        numpass        number of passes through the data (blocks are re-read, data are not copied)
+        shuffle        shuffle the order of the blocks at every pass
+        seed           random seed for shuffle
+        pipeline       if True, mean/whitening, ICA update and source selection/detection run on separate threads
+                       (see run_pipeline), so that whitening of block k+1 overlaps the ICA update of block k and
+                       the detection of block k-1. Results are the same as the sequential processing
+        queue_size     maximum number of blocks waiting between two pipeline stages
+        detect_noise   ['std'|'mad'] noise estimate of the online spike detection (see SpikeDetector)
+        detect_memory  time constant (in s) of the noise estimate (default -> skew_window)
+        refractory     refractory period (in s) of the online spike detection
+        dtype          [np.float64|np.float32] floating point type of data blocks, weights and online sources
+                       (float32 halves memory and memory bandwidth). Online whitening, means, skewness power sums
+                       and convergence indices are accumulated in float64
+        history_every  keep the weights and sphere of every history_every-th step (step_size) as a checkpoint
+                       (the last step is always kept). unmixing, mixing and sphere (steps-by-rows-by-columns)
+                       are computed on access from the checkpoints (see MatrixHistory), as is y
+        history_cache  number of unmixing/mixing matrices cached after being computed
+        pca_mode       ['window'|'incremental'] PCA calibration (calibratePCA=True): PCA on the first pca_window
+                       seconds (whitening and ICA are stalled until the window is complete) or incremental PCA of
+                       the ndim principal components updated from the first block with constant cost per block
+                       (see streamingPCA). With 'incremental', pca_window is the memory (time constant) of the
+                       covariance estimate and the sphere is given by the principal components (no RLS whitening)
         '''
 
-        if numpass > 1:
-            data = np.tile(data, numpass)
+        if fs is None:
+            raise AttributeError('Provide sampling frequency fs')
 
-        nChs, nPts = data.shape
+        if data is not None:
+            nChs, nPts = data.shape
+        elif n_chans is not None:
+            nChs = int(n_chans)
+            if n_samples is not None:
+                nPts = int(n_samples)
+            else:
+                nPts = 0
+        else:
+            raise AttributeError('Provide either data or n_chans')
         verbose = verbose
 
         if isinstance(fs, pq.Quantity):
@@ -476,6 +1647,17 @@ class onlineORICAss():
         self.detect_thresh = detect_trheshold
         self.block = block
         self.ndim = ndim
+        self.online_whitening = onlineWhitening
+        self.pca_calibration = calibratePCA
+        self.online_detection = onlineDetection
+        self.verbose = verbose
+        self.count = 0
+        self.ortho_every = ortho_every
+        self.ortho_mode = ortho_mode
+        self.ortho_iter = ortho_iter
+        self.pipeline = pipeline
+        self.queue_size = queue_size
+        self.dtype = check_dtype(dtype)
 
         # Parameters for data whitening
         # onlineWhitening = True
@@ -492,11 +1674,11 @@ class onlineORICAss():
         ##############################
         if len(weights) == 0:
             if self.ndim == 'all':
-                icaweights = np.eye(nChs)
+                icaweights = np.eye(nChs, dtype=self.dtype)
             else:
-                icaweights = np.eye(self.ndim, self.ndim)
+                icaweights = np.eye(self.ndim, self.ndim, dtype=self.dtype)
         else:
-            icaweights = weights
+            icaweights = np.asarray(weights, dtype=self.dtype)
 
         # if len(pcaweights) == 0:
         # if onlineWhitening:
@@ -516,6 +1698,8 @@ class onlineORICAss():
             self.Vn=[]
             self.whiteIdx=[]
         self.counter       = 1
+        # cooling counter seen by the whitening stage (self.counter is advanced by the ICA stage)
+        self.white_counter = 1
 
         if self.adaptiveFF['profile'] == 'cooling' or  self.adaptiveFF['profile'] == 'constant':
             self.adaptiveFF['lambda_const']  = 1-np.exp(-1 / (self.adaptiveFF['tau_const']))
@@ -527,9 +1711,14 @@ class onlineORICAss():
             self.kurtsign = np.ones((self.ndim, 1))
         if numSubgaussian != 0:
             self.kurtsign[:numSubgaussian] = 0
+        # nonlinearity sign per component: -2 * tanh (supergaussian), 2 * tanh (subgaussian)
+        self.nlsign = np.where(self.kurtsign == 1, -2., 2.)
+        self.buffers = BlockBuffers(dtype=self.dtype)
 
         # online estimation
         self.N = 0
+        # samples fed with partial_fit() waiting for a complete block
+        self.pending = None
         self.mus = []
         self.vars = []
         self.sigmas = []
@@ -542,7 +1731,10 @@ class onlineORICAss():
             if not onlineWhitening:  # pre - whitening
                 if verbose:
                     print('Use pre-whitening method.')
-                if self.ndim == 'all':
+                if data is None:
+                    if sphere is not None:
+                        icasphere = sphere
+                elif self.ndim == 'all':
                     _, eigvecs, eigvals, sphere = whiten_data(data)
                     icasphere = sphere
                 else:
@@ -553,29 +1745,63 @@ class onlineORICAss():
             else:  # Online RLS Whitening
                 if verbose:
                     print('Use online whitening method.')
-        else:
+        elif pca_mode == 'incremental':
+            if verbose:
+                print('Use incremental PCA method.')
+            if self.ndim == 'all':
+                n_comp = nChs
+            else:
+                n_comp = self.ndim
+            self.pca_cov = np.zeros((nChs, nChs))
+            self.eigvecs = np.eye(nChs, n_comp)
+            self.eigvals = np.ones(n_comp)
+            self.pca_blocks = 0
+            self.n_pca_memory = np.max([self.n_pca_window, block])
+            self.n_pca_window = 0
+            self.pca_calibrated = True
+        elif pca_mode == 'window':
             if verbose:
                 print('Use initial PCA calibration method.')
             self.pca_calibrated = False
+            # raw samples buffered until the PCA calibration window is complete
+            self.pca_buffer = []
+        else:
+            raise AttributeError('Unknown PCA mode: ' + str(pca_mode))
+        self.pca_mode = pca_mode
 
         self.icaweights = icaweights
         self.icasphere = icasphere
         self.icasphere_1 = la.pinv(self.icasphere)
         self.skew_thresh = skew_thresh
         if self.ndim == 'all':
-            self.y_on = np.zeros_like(data, dtype=float)
+            n_sources = nChs
         else:
-            self.y_on = np.zeros((self.ndim, nPts), dtype=float)
+            n_sources = self.ndim
+        if source_history == 'full':
+            self.source_history = SourceHistory(n_sources, nPts * numpass, dtype=self.dtype)
+        elif source_history == 'window':
+            self.source_history = SourceHistory(n_sources, window=np.max([self.n_window, self.n_step_size]),
+                                                dtype=self.dtype)
+        elif source_history == 'memmap':
+            if history_file is None:
+                raise AttributeError('Provide history_file for memmap source history')
+            self.source_history = SourceHistory(n_sources, nPts * numpass, filename=history_file, dtype=self.dtype)
+        else:
+            raise AttributeError('Unknown source history: ' + str(source_history))
+        self.y_on = self.source_history.get()
+        self.running_skew = running_skew
+        self.skew_moments = RunningMoments(n_sources)
+        self.n_since_resync = np.inf
 
         #########
         # ORICA #
         #########
 
-        # divide data into blocks for online block update
-        numBlock = int(np.floor(nPts / block))
-
-        self.w = []
-        self.m = []
+        self.history = MatrixHistory(history_every, history_cache, dtype=self.dtype)
+        self.w = self.history.view('weights')
+        self.m = self.history.view('sphere')
+        self.data = data
+        self._y = None
         self.idx_sources = []
         self.means = np.zeros(nChs)
         self.sumx = np.zeros(nChs)
@@ -584,1140 +1810,422 @@ class onlineORICAss():
         self.iter = 0
         self.tracking_iter = 0
 
-        if verbose:
-            printflag = 0
-            if self.adaptiveFF['profile'] == 'cooling':
-                print('Running ORICA with cooling forgetting factor...')
-            elif self.adaptiveFF['profile'] == 'constant':
-                print('Running ORICA with constant forgetting factor...')
-            elif self.adaptiveFF['profile'] == 'adaptive':
-                print('Running ORICA with adaptive forgetting factor...')
-
-        t_start = time.time()
-        self.init = False
+        if detect_memory is None:
+            detect_memory = skew_window
+        self.detector = SpikeDetector(n_sources, detect_trheshold, noise=detect_noise, memory=fs * detect_memory,
+                                      refractory=int(fs * refractory))
         self.spikes = {}
         self.all_sources = np.array([])
         self.nskews = []
-        self.NSI = []
-        self.WI = []
+        self.diagnostics = Diagnostics(record_diagnostics, diagnostics_every)
+        self.NSI = np.array([])
+        self.WI = np.array([])
         self.lambdas = np.array([])
         self.ratios = np.array([])
         self.normNSI = np.array([])
+        self.nsinorm = 0
         self.NSImean = 0
         self.NSIvar = 0
 
-        for bi in range(numBlock):
-            dataRange = np.arange(int(np.floor(bi * nPts / numBlock)),
-                              int(np.min([nPts, np.floor((bi + 1) * nPts / numBlock)])))
-            self.N += len(dataRange)
-            self.onlineMean(data[:, dataRange])
+        if data is None:
+            return
 
-            if calibratePCA:
-                self.calibratePCA(data)
+        # divide data into blocks for online block update
+        numBlock = int(np.floor(nPts / block))
 
-            if onlineWhitening:
-                self.dynamicWhitening(data[:, dataRange], dataRange)
-            else:
-                # compute WI
-                data_cent = data[:, dataRange] - self.means
-                self.dynamicWhitening(data_cent, dataRange, whitening=False)
-
-            if self.N > self.n_pca_window:
-                data_cent = data[:, dataRange] - self.means
-                if self.ndim != 'all':
-                    data_white = np.matmul(self.icasphere[:self.ndim], data_cent)
-                else:
-                    data_white = np.matmul(self.icasphere, data_cent)
-                self.dynamicOrica(data_white, dataRange)
-
-            if self.N > self.n_pca_window + self.n_ica_window:
-                # online sources
-                self.y_on[:, dataRange] = np.matmul(self.icaweights, np.matmul(self.icasphere, data_cent))
-
-            # select sources
-            if not np.mod(self.N, self.n_step_size):
-                if self.N > self.n_pca_window + self.n_ica_window:
-                    self.computeSkew()
-                    idx_sources = np.where(np.abs(self.skew) > self.skew_thresh)
-                    self.w.append(self.icaweights)
-                    if self.ndim != 'all':
-                        self.m.append(self.icasphere[:self.ndim])
-                    else:
-                        self.m.append(self.icasphere)
-
-                    if len(idx_sources) != 0:
-                        self.idx_sources.append(idx_sources[0])
-                        self.nskews.append(len(idx_sources[0]))
-
-                        self.all_sources = np.concatenate((self.all_sources, idx_sources[0]))
-                        self.all_sources = np.sort(np.unique(self.all_sources)).astype('int')
-                        if onlineDetection:
-                            self.detectSpikes(idx_sources)
-                    else:
-                        self.idx_sources.append([])
-                else:
-                    idx_sources = []
-                    self.w.append(self.icaweights)
-                    if self.ndim != 'all':
-                        self.m.append(self.icasphere[:self.ndim])
-                    else:
-                        self.m.append(self.icasphere)
-                    self.idx_sources.append([])
+        if verbose:
+            printflag = 0
+            if self.adaptiveFF['profile'] == 'cooling':
+                print('Running ORICA with cooling forgetting factor...')
+            elif self.adaptiveFF['profile'] == 'constant':
+                print('Running ORICA with constant forgetting factor...')
+            elif self.adaptiveFF['profile'] == 'adaptive':
+                print('Running ORICA with adaptive forgetting factor...')
 
-            if verbose:
-                if printflag < np.floor(10 * bi / numBlock):
-                    printflag = printflag + 1
-                    print(10 * printflag, '%')
-                    if self.N > self.n_pca_window + self.n_ica_window and len(self.idx_sources) != 0:
-                        print('Sources: ', self.idx_sources[-1])
+        def blocks():
+            printflag = 0
+            for i_block, (it, bi, dataRange) in enumerate(block_ranges(nPts, numBlock, numpass, shuffle, seed)):
+                yield (data[:, dataRange],)
 
+                if verbose:
+                    if printflag < np.floor(10 * i_block / numpass / numBlock):
+                        printflag = printflag + 1
+                        print(10 * printflag, '%')
+                        if self.N > self.n_pca_window + self.n_ica_window and len(self.idx_sources) != 0:
+                            print('Sources: ', self.idx_sources[-1])
+
+        t_start = time.time()
+
+        self.runBlocks(blocks())
 
         if verbose:
             processing_time = time.time() - t_start
             print('ORICA Finished. Elapsed time: ', processing_time, ' sec.')
 
         # output weights and sphere matrices
-        self.sphere = self.m
-        self.unmixing = []
-        self.mixing = []
-        self.source_idx = self.idx_sources
+        self.updateOutputs()
 
         if not onlineDetection:
             self.spikes = []
 
-        for (w, m) in zip(self.w, self.m):
-            unmixing = np.matmul(w, m)
-            mixing = la.pinv(unmixing).T
-            self.unmixing.append(unmixing)
-            self.mixing.append(mixing)
-
-        self.unmixing = np.array(self.unmixing)
-        self.mixing = np.array(self.mixing)
-        self.sphere = np.array(self.sphere)
-        self.y = np.matmul(self.unmixing[-1], data)
-
         print('Done')
 
 
-    def computeSkew(self):
-        if self.N < self.n_window:
-            y = self.y_on[:, :self.N]
-            # skewness for source selection
-            self.skew = stats.skew(y, axis=1)
-            # self.sigma = np.std(y, axis=1)
-        else:
-            # skewness for source selection
-            y = self.y_on[:, self.N-self.n_window:self.N]
-            self.skew = stats.skew(y, axis=1)
-            # self.sigma = np.std(self.y, axis=1)
-        self.skews.append(self.skew)
-
-
-    def detectSpikes(self, idx_sources):
-
-        self.y[self.skew > 0] = -self.y[self.skew > 0]
-        if self.init:
-            # first time detect spikes on all past signals
-            sources = self.y[self.idx_sources[-1]]
-        else:
-            # then append spikes from single blocks
-            sources = self.y[self.idx_sources[-1], -self.n_step_size:]
-
-        for i, (s, s_idx) in enumerate(zip(sources, self.idx_sources[-1])):
-            if s_idx in self.spikes.keys():
-                times = self.spikes[s_idx]
-            else:
-                times = np.array([])
-
-            sp_times = []
-            # thresh = -self.detect_thresh * np.median(np.abs(s) / 0.6745)
-            thresh = -self.detect_thresh * np.std(s)
-            # print s_idx, thresh
-            idx_spikes = np.where(s < thresh)
-            if len(idx_spikes[0]) != 0:
-                idx_spikes = idx_spikes[0]
-                for t, idx in enumerate(idx_spikes):
-                    # find single waveforms crossing thresholds
-                    if t == 0:
-                        if self.init:
-                            if self.N < self.n_window:
-                                sp_times.append(idx)
-                            else:
-                                sp_times.append(idx)
-                        else:
-                            sp_times.append(self.N - self.n_step_size + idx)
-                    elif idx - idx_spikes[t - 1] > 1: # or t == len(idx_spike) - 2:  # single spike
-                        # append crossing time
-                        if self.init:
-                            if self.N < self.n_window:
-                                sp_times.append(idx)
-                            else:
-                                sp_times.append(idx)
-                        else:
-                            sp_times.append(self.N - self.n_step_size + idx)
-                self.spikes.update({s_idx: np.concatenate((times, np.array(sp_times)))})
-
-        if self.init:
-            self.init = False
-
-
-    def onlineMean(self, blockdata):
-        self.means = 1. / self.N * (self.sumx[:, np.newaxis] + np.sum(blockdata, axis=1, keepdims=True))
-        self.sumx += np.sum(blockdata, axis=1)
-
-    def onlineNSIUpdate(self, newNSI, ff=None):
-        if ff == None:
-            if self.iter > 1:
-                ff = 1. /(self.iter - 1)
-            else:
-                ff = 1.
-
-        if self.iter > 1:
-            self.NSImean = (1 - ff) * self.NSImean + ff * newNSI
-            self.NSIvar = (1 - ff) * self.NSIvar + ff * (1 - ff) * (newNSI - self.NSImean) ** 2
-        else:
-            self.NSImean = newNSI
-            self.NSIvar = 1.
-
-        normNSI = (newNSI - self.NSImean) / np.sqrt(self.NSIvar)
-        # if normNSI > self.adaptiveFF['transBandCenter']:
-        #     self.tracking = True
-        # else:
-        #     if self.tracking:
-        #         self.tracking = False
-        #         self.tracking_iter = 0
-        #         print('STOP TRACKING')
-
-        return normNSI
+    def restoreTransient(self):
+        self.y_on = self.source_history.get()
 
 
-    def calibratePCA(self, data):
-        if self.N >= self.n_pca_window and not self.pca_calibrated:
-            data_init = data[:, :self.n_pca_window]
-            print('PCA calibration')
-            if self.ndim == 'all':
-                _, eigvecs, eigvals, sphere = whiten_data(data_init)
+    @property
+    def y(self):
+        '''Sources of the whole recording with the last unmixing matrix (computed on first access).'''
+        if self._y is None and self.data is not None:
+            if len(self.history) > 0:
+                unmixing = self.unmixing[-1]
             else:
-                _, eigvecs, eigvals, sphere = whiten_data(data_init, self.ndim)
-            self.icasphere = sphere
-            self.pca_calibrated = True
+                unmixing = np.matmul(self.icaweights, self.icasphere)
+            self._y = np.matmul(unmixing, self.data.astype(self.dtype, copy=False))
+        return self._y
 
 
-    def dynamicWhitening(self, blockdata, dataRange, whitening=True):
-        nChs, nPts = blockdata.shape
-
-        v = np.matmul(self.icasphere, blockdata) # pre - whitened data
+    def partial_fit(self, chunk):
+        '''Updates the online ORICA state with a new chunk of data (chans-by-samples).
 
-        if self.evalConvergence['profile']:
-            modelFitness = np.eye(self.icaweights.shape[0]) - np.matmul(v, v.T)/nPts
-            if len(self.Vn) == 0:
-                self.Vn = modelFitness
-            else:
-                self.Vn = (1 - self.evalConvergence['leakyAvgDelta']) * self.Vn + \
-                                self.evalConvergence['leakyAvgDelta'] * modelFitness
-                #!!! this does not account for block update!
-            self.whiteIdx = la.norm(self.Vn)
-            self.WI.append(self.whiteIdx)
+        Blocks of exactly block samples are processed, so acquisition buffers of any length can be fed directly:
+        samples left over at the end of a chunk are processed with the next chunk (or by flush()). State is
+        carried over between calls.
+        '''
+        blocks = ((blockdata,) for blockdata in self.splitChunk(chunk, self.block))
+        self.runBlocks(blocks)
 
-        if whitening:
-            if self.adaptiveFF['profile'] == 'cooling':
-                lambda_ = self.genCoolingFF(self.counter + dataRange, self.adaptiveFF['gamma'],
-                                            self.adaptiveFF['lambda_0'],
-                                            self.adaptiveFF['min_lambda'])
-                if lambda_[0] < self.adaptiveFF['lambda_const']:
-                    lambda_ = np.squeeze(np.tile(self.adaptiveFF['lambda_const'], (1, nPts)))
-            elif self.adaptiveFF['profile'] == 'constant':
-                lambda_ = np.ones(nPts) * self.adaptiveFF['lambda_0']
+        return self
 
-            lambda_avg = 1 - lambda_[int(np.ceil(len(lambda_) / 2))] # median lambda
-            QWhite = lambda_avg / (1-lambda_avg) + np.trace(np.matmul(v, v.T)) / nPts
-            self.icasphere = 1 / lambda_avg * (self.icasphere - np.matmul(np.matmul(v, v.T) / nPts
-                                                / QWhite,self.icasphere))
 
+    def flush(self):
+        '''Processes the samples left over by partial_fit() as a last (shorter) block.'''
+        if self.pending is not None and self.pending.shape[1] > 0:
+            pending, self.pending = self.pending, self.pending[:, :0]
+            self.runBlocks([(pending,)])
 
-    def dynamicOrica(self, blockdata, dataRange, nlfunc=None):
+        return self
 
-        # initialize
-        nChs, nPts = blockdata.shape
-        f = np.zeros((nChs, nPts))
-        # compute source activation using previous weight matrix
-        y = np.matmul(self.icaweights, blockdata)
 
-        # choose nonlinear functions for super- vs. sub-gaussian
-        if nlfunc is None:
-            f[np.where(self.kurtsign==1), :]  = -2 * np.tanh(y[np.where(self.kurtsign==1), :])  # Supergaussian
-            f[np.where(self.kurtsign==0), :] = 2 * np.tanh(y[np.where(self.kurtsign==0), :])  # Subgaussian
+    def runBlocks(self, blocks):
+        '''Processes an iterable of (blockdata,) sequentially or in the pipeline.'''
+        if self.pipeline:
+            run_pipeline(blocks, [self.whitenBlock, self.icaBlock, self.selectBlock], self.queue_size)
         else:
-            f = nlfunc(y);
-
-        # compute Non-Stationarity Index (nonStatIdx) and variance of source dynamics (Var)
-        if self.evalConvergence['profile']:
-            modelFitness = np.eye(nChs) - np.matmul(y, f.T) / nPts
-            # modelFitness = (np.eye(nChs) - np.matmul(y, f.T) / nPts) / nChs
-            # variance = blockdata * blockdata
-            if len(self.Rn) == 0:
-                self.Rn = modelFitness
-            else:
-                self.Rn = (1 - self.evalConvergence['leakyAvgDelta']) * self.Rn + \
-                                self.evalConvergence['leakyAvgDelta'] * modelFitness
-                # !!! this does not account for block update!
-            self.nonStatIdx = la.norm(self.Rn)
-            # self.nonStatIdx = la.norm(modelFitness)
-            self.NSI.append(self.nonStatIdx)
-            if self.N > self.n_pca_window + self.n_ica_window:
-                self.iter += 1
-                nsinorm = self.onlineNSIUpdate(self.nonStatIdx, ff=self.adaptiveFF['ff'])
-                self.normNSI = np.append(self.normNSI, nsinorm)
-            else:
-                self.normNSI= np.append(self.normNSI, 0)
-
-        if self.adaptiveFF['profile'] == 'cooling':
-            self.lambda_k = self.genCoolingFF(self.counter + dataRange, self.adaptiveFF['gamma'],
-                                              self.adaptiveFF['lambda_0'], self.adaptiveFF['min_lambda'])
-            if self.lambda_k[0] < self.adaptiveFF['lambda_const']:
-                self.lambda_k = np.squeeze(np.tile(self.adaptiveFF['lambda_const'], (1, nPts)))
-            self.counter = self.counter + nPts;
-        elif self.adaptiveFF['profile'] == 'constant':
-            self.lambda_k = np.ones(nPts) * self.adaptiveFF['lambda_0']
-        elif self.adaptiveFF['profile'] == 'adaptive':
-            if self.minNonStatIdx == -1:
-                self.minNonStatIdx = self.nonStatIdx
-            self.minNonStatIdx = np.max([np.min([self.minNonStatIdx, self.nonStatIdx]), 1])
-            ratioOfNormRn = self.nonStatIdx / self.minNonStatIdx
-            # self.lambda_k = self.genAdaptiveFF(dataRange, self.lambda_k, ratioOfNormRn)
-            self.lambda_k = self.genAdaptiveFF(dataRange, self.lambda_k, self.normNSI[-1])
-            self.ratios = np.append(self.ratios, ratioOfNormRn)
-
-        self.lambdas = np.concatenate((self.lambdas, self.lambda_k))
-
-
-        # update weight matrix using online recursive ICA block update rule
-        lambda_prod = np.prod(1. / (1.-self.lambda_k))
-        Q = 1 + self.lambda_k * (np.sum(f * y, axis=0) - 1);
-        curr_state = self.icaweights
-
-        self.icaweights = lambda_prod * (self.icaweights -
-                                               np.matmul(np.matmul(np.matmul(y, np.diag(self.lambda_k / Q)),
-                                                                f.T), self.icaweights))
-
-        if np.any(np.isnan(np.matmul(self.icaweights, self.icaweights.T))) or \
-                np.any(np.isinf(np.matmul(self.icaweights, self.icaweights.T))):
-            raise Exception()
-
-        # orthogonalize weight matrix
-        try:
-            D, V = eigh(np.matmul(self.icaweights, self.icaweights.T))
-        except LinAlgError:
-            raise Exception()
-
-        # curr_state = self.icaweights
-        self.icaweights = np.matmul(np.matmul(la.solve(np.diag((np.sqrt(np.abs(D)) * np.sign(D))).T, V.T).T,
-                                                    V.T), self.icaweights)
-
-    def genCoolingFF(self, t, gamma, lambda_0, min_lambda):
-        lambda_ = lambda_0 / (t ** gamma)
-        if min_lambda != 0:
-            lambda_[lambda_<min_lambda] = min_lambda
-        return lambda_
-
-    def genAdaptiveFF(self, dataRange, lambda_in, ratioOfNormRn):
-        decayRateAlpha = self.adaptiveFF['decayRateAlpha']
-        upperBoundBeta = self.adaptiveFF['upperBoundBeta']
-        transBandWidthGamma = self.adaptiveFF['transBandWidthGamma']
-        transBandCenter = self.adaptiveFF['transBandCenter']
-
-        gainForErrors = upperBoundBeta * 0.5 * (1 + np.tanh((ratioOfNormRn - transBandCenter) / transBandWidthGamma))
-        nrange = np.arange(len(dataRange))
-
-        lambda_ = np.zeros(len(dataRange))
-        lam_pr = lambda_in[-1]
-        for i in nrange:
-            lam_new = (1+gainForErrors) * lam_pr - decayRateAlpha * lam_pr ** 2
-            # lam_new = (1./((i+1)**self.adaptiveFF['gamma']) + gainForErrors) * lam_pr
-            lambda_[i] = lam_new
-            lam_pr = lam_new
-
-        return lambda_
+            for (blockdata,) in blocks:
+                self.updateBlock(blockdata)
 
 
+    def transform(self, chunk):
+        '''Projects a chunk of data (chans-by-samples) on the current sources.'''
+        if self.ndim != 'all':
+            unmixing = np.matmul(self.icaweights, self.icasphere[:self.ndim])
+        else:
+            unmixing = np.matmul(self.icaweights, self.icasphere)
+        return np.matmul(unmixing.astype(self.dtype, copy=False), chunk.astype(self.dtype, copy=False))
+
+
+    def updateOutputs(self):
+        '''Sets sphere, unmixing and mixing histories (lazily computed from the stored checkpoints).'''
+        self.y_on = self.source_history.get()
+        for name in ['lambdas', 'NSI', 'WI', 'normNSI', 'ratios']:
+            setattr(self, name, self.diagnostics.get(name))
+        self.spike_times, self.spike_sources = self.detector.events()
+        self.spikes = self.detector.spike_trains()
+        self.sphere = self.history.view('sphere')
+        self.unmixing = self.history.view('unmixing')
+        self.mixing = self.history.view('mixing')
+        self.source_idx = self.idx_sources
+        self._y = None
 
-class ORICA_W():
-    def __init__(self, data, numpass=1, weights=None, sphering='offline', lambda_0=0.995, block_white=8, block_ica=8, nsub=0,
-                 forgetfac='cooling', localstat=np.inf, ffdecayrate=0.6, evalconverg=True, verbose=False, mu=0, eta=0,
-                 adjacency=None):
-        '''
-
-        Parameters
-        ----------
-        data:          np.array - input data (chans-by-samples)
-        numpass:       number of passes through the data
-        weights:       initial weight matrix     (default -> eye())
-        sphering:      ['offline' | 'online'] use online RLS whitening method or pre-whitening
-        block_white:   block size for online whitening (in samples)
-        block_ica:     block size for ORICA (in samples)
-        nsub:          number of subgaussian sources in EEG signal (default -> 0)
-        forgetfac:     ['cooling'|'constant'|'adaptive'] forgetting factor profiles
-                        'cooling': monotonically decreasing, for relatively stationary data
-                        'constant': constant, for online tracking non-stationary data.
-                        See reference [2] for more information.
-        localstat:     local stationarity (in number of samples) corresponding to
-                       constant forgetting factor at steady state
-        ffdecayrate:   [0<f<1] decay rate of (cooling) forgetting factor (default -> 0.6)
-        evalconverg:   [0|1] evaluate convergence such as Non-Stationarity Index
-        verbose:       bool - give ascii messages  (default -> False)
-        mu:            coefficient for spatial smothing
-        eta:           coefficient for temporal smoothing (when convolutive)
-        adjacency:     adjavency matrix (if mu not 0)
 
-        Reference:
-          [1] S.-H. Hsu, T. Mullen, T.-P Jung, and G. Cauwenberghs, "Real-time
-           adaptive EEG source separation using online recursive independent
-           component analysis," IEEE Transactions on Neural Systems and
-           Rehabilitation Engineering, 2016.
+    def updateBlock(self, blockdata):
+        self.selectBlock(*self.icaBlock(*self.whitenBlock(blockdata)))
 
-           [2] S.-H. Hsu, L. Pion-Tanachini, T.-P Jung, and G. Cauwenberghs,
-           "Tracking non-stationary EEG sources using adaptive online
-           recursive independent component analysis," in IEEE EMBS, 2015.
 
-           [3] S.-H. Hsu, T. Mullen, T.-P Jung, and G. Cauwenberghs, "Online
-           recursive independent component analysis for real-time source
-           separation of high-density EEG," in IEEE EMBS, 2014.
+    def whitenBlock(self, blockdata):
+        '''Pipeline stage 1: running mean, PCA calibration and whitening of a block.
 
-         Author:
-               Sheng-Hsiou (Shawn) Hsu, SCCN, UCSD.
-               shh078@ucsd.edu
+        Returns (data_white, sphere, dataRange) for icaBlock (data_white is None during PCA calibration).
         '''
+        blockdata = blockdata.astype(self.dtype, copy=False)
+        nPts = blockdata.shape[1]
+        dataRange = np.arange(self.N, self.N + nPts)
+        self.N += nPts
+        self.onlineMean(blockdata)
 
-        nChs, nPts = data.shape
-
-        numPass = numpass
-        verbose = verbose
+        if self.pca_calibration:
+            if self.pca_mode == 'incremental':
+                self.streamingPCA(blockdata)
+            else:
+                self.calibratePCA(blockdata)
 
-        # Parameters for data whitening
-        if sphering == 'online':
-            onlineWhitening = True
+        if self.online_whitening and not (self.pca_calibration and self.pca_mode == 'incremental'):
+            self.dynamicWhitening(blockdata, dataRange)
         else:
-            onlineWhitening = False
-        blockSizeWhite = block_white
-        blockSizeICA = block_ica
-        numSubgaussian = nsub
-
-        self.adaptiveFF = {'profile': forgetfac, 'tau_const': np.inf, 'gamma': 0.6, 'lambda_0': lambda_0, 'decayRateAlpha': 0.02,
-                      'upperBoundBeta': 1e-3, 'transBandWidthGamma': 1, 'transBandCenter': 5, 'lambdaInitial': 0.1}
-        self.evalConvergence = {'profile': evalconverg, 'leakyAvgDelta': 0.01, 'leakyAvgDeltaVar': 1e-3}
-
-        self.adjacency = adjacency
-        self.mu = mu
-        self.eta = eta
-
-        if weights is None:
-            weights = np.eye(nChs)
-
-        ##############################
-        # initialize state variables #
-        ##############################
-        icaweights = weights
-        if onlineWhitening:
-            icasphere = np.eye(nChs)
-
-        lambda_k = np.zeros((1, blockSizeICA))
-        minNonStatIdx =[]
-        counter       = 1
-
-        if self.adaptiveFF['profile'] == 'cooling' or  self.adaptiveFF['profile'] == 'constant':
-            self.adaptiveFF['lambda_const']  = 1-np.exp(-1 / (self.adaptiveFF['tau_const']))
-
-        if self.evalConvergence['profile']:
-            Rn =[]
-            nonStatIdx =[]
-
-        # sign of kurtosis for each component: true(supergaussian), false(subgaussian)
-        kurtsign = np.ones((nChs, 1))
-        if numSubgaussian != 0:
-            kurtsign[:numSubgaussian] = 0
+            # compute WI
+            data_cent = blockdata - self.means
+            self.dynamicWhitening(data_cent, dataRange, whitening=False)
 
+        # the (float64) sphere and means are applied in the working precision
+        if self.ndim != 'all':
+            sphere = self.icasphere[:self.ndim].astype(self.dtype, copy=False)
+        else:
+            sphere = self.icasphere.astype(self.dtype, copy=False)
 
-        ######################
-        # sphere-whiten data #
-        ######################
-        if not onlineWhitening: # pre - whitening
-            if verbose:
-                print('Use pre-whitening method.')
-                icasphere = 2.0 * la.inv(sqrtm(np.cov(data))) # find the "sphering" matrix = spher()
-        else: # Online RLS Whitening
-            if verbose:
-                print('Use online whitening method.')
-        # whiten / sphere the data
-        data_w = np.matmul(icasphere, data)
+        if self.N > self.n_pca_window:
+            data_cent = blockdata - self.means.astype(self.dtype, copy=False)
+            data_white = np.matmul(sphere, data_cent)
+            if self.adaptiveFF['profile'] == 'cooling':
+                self.white_counter += nPts
+        else:
+            data_white = None
 
-        self.state = State(icaweights, icasphere, lambda_k, minNonStatIdx, counter, Rn, nonStatIdx, kurtsign)
-        self.icasphere_1 = la.inv(self.state.icasphere)
+        return data_white, sphere, dataRange
 
-        #########
-        # ORICA #
-        #########
 
-        # divide data into blocks for online block update
-        numBlock = int(np.floor(nPts))
+    def icaBlock(self, data_white, sphere, dataRange):
+        '''Pipeline stage 2: ORICA update on a whitened block.
 
-        if verbose:
-            printflag = 0
-            if self.adaptiveFF['profile'] == 'cooling':
-                print('Running ORICA with cooling forgetting factor...')
-            elif self.adaptiveFF['profile'] == 'constant':
-                print('Running ORICA with constant forgetting factor...')
-            elif self.adaptiveFF['profile'] == 'adaptive':
-                print('Running ORICA with adaptive forgetting factor...')
-        t_start = time.time()
+        Returns (data_white, sphere, icaweights, dataRange) for selectBlock.
+        '''
+        if data_white is not None:
+            self.dynamicOrica(data_white, dataRange)
+
+        return data_white, sphere, self.icaweights, dataRange
+
+
+    def selectBlock(self, data_white, sphere, icaweights, dataRange):
+        '''Pipeline stage 3: online sources, skewness based source selection and spike detection.'''
+        nPts = len(dataRange)
+        N = dataRange[-1] + 1
+
+        if N > self.n_pca_window + self.n_ica_window:
+            # online sources
+            y_block = np.matmul(icaweights, data_white)
+            resync = self.n_since_resync + nPts >= self.n_window
+            if self.running_skew and not resync:
+                # add block and remove samples leaving the skew window (before they are overwritten)
+                leave_end = N - self.n_window
+                if leave_end > 0:
+                    leaving = self.source_history.last(np.min([nPts, leave_end]), leave_end)
+                else:
+                    leaving = None
+                self.skew_moments.update(y_block, leaving)
+                self.n_since_resync += nPts
+            self.source_history.append(y_block, dataRange[0])
+            if self.running_skew and resync:
+                self.skew_moments.reset(self.source_history.last(self.n_window, N))
+                self.n_since_resync = 0
+            if self.source_history.window is None:
+                self.y_on = self.source_history.data
+
+        # select sources
+        # a step is completed when N crosses a multiple of the step size (blocks need not divide the step)
+        if (N - nPts) // self.n_step_size < N // self.n_step_size:
+            self.history.append(icaweights, sphere)
+            if N > self.n_pca_window + self.n_ica_window:
+                self.computeSkew(N)
+                idx_sources = np.where(np.abs(self.skew) > self.skew_thresh)
+
+                if len(idx_sources) != 0:
+                    self.idx_sources.append(idx_sources[0])
+                    self.nskews.append(len(idx_sources[0]))
+
+                    self.all_sources = np.concatenate((self.all_sources, idx_sources[0]))
+                    self.all_sources = np.sort(np.unique(self.all_sources)).astype('int')
+                    if self.online_detection:
+                        self.detectSpikes(idx_sources, N)
+                else:
+                    self.idx_sources.append([])
+            else:
+                self.idx_sources.append([])
 
-        dataRange = np.arange(nPts)
-        if self.adaptiveFF['profile'] == 'cooling':
-            self.state.lambda_k = self.genCoolingFF(self.state.counter + dataRange, self.adaptiveFF['gamma'],
-                                                    self.adaptiveFF['lambda_0'])
-            if self.state.lambda_k[0] < self.adaptiveFF['lambda_const']:
-                self.state.lambda_k = np.squeeze(np.tile(self.adaptiveFF['lambda_const'], (1, nPts)))
-                print('Whatever')
-            self.state.counter = self.state.counter + nPts;
-        elif self.adaptiveFF['profile'] == 'constant':
-            self.state.lambda_k = np.arange(nPts) * self.adaptiveFF['lambda_0']
-        elif self.adaptiveFF['profile'] == 'adaptive':
-            if len(self.state.minNonStatIdx) != 0:
-                self.state.minNonStatIdx = self.state.nonStatIdx
-            self.state.minNonStatIdx = np.max([np.min(self.state.minNonStatIdx, self.state.nonStatIdx), 1])
-            ratioOfNormRn = self.state.nonStatIdx / self.state.minNonStatIdx
-            self.state.lambda_k = self.genAdaptiveFF(dataRange, self.state.lambda_k, ratioOfNormRn)
 
-        # icaweights is A. Assumption: W is A.T
-        for it in range(numPass):
-            for bi in range(nPts):
-                A = self.state.icaweights.T
-                W = self.state.icaweights
-                v = np.expand_dims(data_w[:, bi], axis=1)
-                y = np.expand_dims(np.matmul(W, data_w[:, bi]), axis=1)
-                f = np.zeros((nChs, 1))
+    def computeSkew(self, N=None):
+        # skewness for source selection on the last n_window samples before N (default -> self.N)
+        if N is None:
+            N = self.N
+        if self.running_skew:
+            self.skew = self.skew_moments.skew()
+        else:
+            y = self.source_history.last(self.n_window, N)
+            self.skew = stats.skew(y, axis=1)
+        # self.sigma = np.std(y, axis=1)
+        self.skews.append(self.skew)
 
-                # choose nonlinear functions for super- vs. sub-gaussian
-                f[np.where(self.state.kurtsign == 1)] = -2 * np.tanh(
-                    y[np.where(self.state.kurtsign == 1)])  # Supergaussian
-                f[np.where(self.state.kurtsign == 0)] = 2 * np.tanh(
-                    y[np.where(self.state.kurtsign == 0)])  # Subgaussian
 
+    def detectSpikes(self, idx_sources, N=None):
+        # detect spikes on the sources of the samples since the last detection (at most one step)
+        if N is None:
+            N = self.N
+        start = int(np.max([N - self.n_step_size, self.detector.end]))
+        y = self.source_history.last(N - start, N)
+        # positively skewed sources are flipped so that spikes are negative peaks
+        polarity = np.where(self.skew > 0, -1., 1.)
+        self.detector.update(y, start, idx_sources[0], polarity)
 
-                # update unmixing matrix using online recursive ICA block update rule
 
-                # # Compute smoothing factor
-                if self.mu != 0:
-                    dS = self.computeSmoothingFactor().T
-                    u = np.matmul(f, v.T) + self.mu * dS
-                else:
-                    u = np.matmul(f, v.T)
-
-                self.state.icaweights = (1 - self.state.lambda_k[bi]) * W + \
-                                        self.state.lambda_k[bi] * u
-
-                # orthogonalize weight matrix
-                if not np.mod(bi, block_ica):
-                    try:
-                        D, V = eigh(np.matmul(self.state.icaweights, self.state.icaweights.T))
-                        # diagonalize matrix (maybe every n steps)
-                        self.state.icaweights = np.matmul(np.matmul(
-                            la.solve(np.diag((np.sqrt(np.abs(D)) * np.sign(D))).T, V.T).T,
-                                      V.T), self.state.icaweights)
-                    except LinAlgError:
-                        raise Exception()
-
-                    if verbose:
-                        if printflag < np.floor(10 * (it * numBlock + bi) / numPass / numBlock):
-                            printflag = printflag + 1
-                            print(10 * printflag, '%')
-
-        if verbose:
-            processing_time = time.time() - t_start
-            print('ORICA Finished. Elapsed time: ', processing_time, ' sec.')
-
-        # output weights and sphere matrices
-        self.sphere = self.state.icasphere
-        self.unmixing = np.matmul(self.state.icaweights, self.sphere)
-        self.mixing = la.pinv(np.matmul(self.unmixing, self.sphere)).T
-        self.y = np.matmul(self.unmixing, data)
-
-
-    def dynamicWhitening(self, blockdata, dataRange):
-        nPts = blockdata.shape[1]
-
-        if self.adaptiveFF['profile'] == 'cooling':
-            lambda_ = self.genCoolingFF(self.state.counter+dataRange, self.adaptiveFF['gamma'], self.adaptiveFF['lambda_0'])
-            if lambda_[0] < self.adaptiveFF['lambda_const']:
-                lambda_ = np.squeeze(np.tile(self.adaptiveFF['lambda_const'], (1, nPts)))
-        elif self.adaptiveFF['profile'] == 'constant':
-            lambda_ = np.squeeze(np.tile(self.adaptiveFF['lambda_const'], (1, nPts)))
-        elif self.adaptiveFF['profile'] == 'adaptive':
-            lambda_ = np.squeeze(np.tile(self.state.lambda_k[-1], (1, nPts)))
-
-
-        v = np.matmul(self.state.icasphere, blockdata) # pre - whitened data
-        lambda_avg = 1 - lambda_[int(np.ceil(len(lambda_) / 2))] # median lambda
-        QWhite = lambda_avg / (1-lambda_avg) + np.trace(np.matmul(v, v.T)) / nPts
-        self.state.icasphere = 1 / lambda_avg * (self.state.icasphere - np.matmul(np.matmul(v, v.T) / nPts
-                                            / QWhite, self.state.icasphere))
-
-    def genCoolingFF(self, t, gamma, lambda_0):
-        lambda_ = lambda_0 / (t ** gamma)
-        return lambda_
-
-    def genAdaptiveFF(self, dataRange, lambda_, ratioOfNormRn):
-        decayRateAlpha = self.adaptiveFF['decayRateAlpha']
-        upperBoundBeta = self.adaptiveFF['upperBoundBeta']
-        transBandWidthGamma = self.adaptiveFF['transBandWidthGamma']
-        transBandCenter = self.adaptiveFF['transBandCenter']
-
-        gainForErrors = upperBoundBeta * 0.5 * (1 + np.tanh((ratioOfNormRn - transBandCenter) / transBandWidthGamma))
-        def f(n):
-            return  (1 + gainForErrors) ** n * lambda_[-1] - decayRateAlpha * ((1 + gainForErrors) ** (2 * n - 1) -
-                                                                               (1 + gainForErrors) ** (n - 1)) / \
-                                                                                gainForErrors * lambda_[-1] **2
-        lambda_ = f(range(len(dataRange)))
-
-        return lambda_
-
-class ORICA_A():
-    def __init__(self, data, numpass=1, weights=None, sphering='offline', lambda_0=0.995, block_white=8, block_ica=8, nsub=0,
-                 forgetfac='cooling', localstat=np.inf, ffdecayrate=0.6, evalconverg=True, verbose=False, mu=0, eta=0,
-                 adjacency=None):
-        '''
-
-        Parameters
-        ----------
-        data:          np.array - input data (chans-by-samples)
-        numpass:       number of passes through the data
-        weights:       initial weight matrix     (default -> eye())
-        sphering:      ['offline' | 'online'] use online RLS whitening method or pre-whitening
-        block_white:   block size for online whitening (in samples)
-        block_ica:     block size for ORICA (in samples)
-        nsub:          number of subgaussian sources in EEG signal (default -> 0)
-        forgetfac:     ['cooling'|'constant'|'adaptive'] forgetting factor profiles
-                        'cooling': monotonically decreasing, for relatively stationary data
-                        'constant': constant, for online tracking non-stationary data.
-                        See reference [2] for more information.
-        localstat:     local stationarity (in number of samples) corresponding to
-                       constant forgetting factor at steady state
-        ffdecayrate:   [0<f<1] decay rate of (cooling) forgetting factor (default -> 0.6)
-        evalconverg:   [0|1] evaluate convergence such as Non-Stationarity Index
-        verbose:       bool - give ascii messages  (default -> False)
-        mu:            coefficient for spatial smothing
-        eta:           coefficient for temporal smoothing (when convolutive)
-        adjacency:     adjavency matrix (if mu not 0)
-
-        Reference:
-          [1] S.-H. Hsu, T. Mullen, T.-P Jung, and G. Cauwenberghs, "Real-time
-           adaptive EEG source separation using online recursive independent
-           component analysis," IEEE Transactions on Neural Systems and
-           Rehabilitation Engineering, 2016.
-
-           [2] S.-H. Hsu, L. Pion-Tanachini, T.-P Jung, and G. Cauwenberghs,
-           "Tracking non-stationary EEG sources using adaptive online
-           recursive independent component analysis," in IEEE EMBS, 2015.
-
-           [3] S.-H. Hsu, T. Mullen, T.-P Jung, and G. Cauwenberghs, "Online
-           recursive independent component analysis for real-time source
-           separation of high-density EEG," in IEEE EMBS, 2014.
-
-         Author:
-               Sheng-Hsiou (Shawn) Hsu, SCCN, UCSD.
-               shh078@ucsd.edu
-        '''
-
-        nChs, nPts = data.shape
-
-        numPass = numpass
-        verbose = verbose
-
-        # Parameters for data whitening
-        if sphering == 'online':
-            onlineWhitening = True
-        else:
-            onlineWhitening = False
-        blockSizeWhite = block_white
-        blockSizeICA = block_ica
-        numSubgaussian = nsub
-
-        self.adaptiveFF = {'profile': forgetfac, 'tau_const': np.inf, 'gamma': 0.6, 'lambda_0': lambda_0, 'decayRateAlpha': 0.02,
-                      'upperBoundBeta': 1e-3, 'transBandWidthGamma': 1, 'transBandCenter': 5, 'lambdaInitial': 0.1}
-        self.evalConvergence = {'profile': evalconverg, 'leakyAvgDelta': 0.01, 'leakyAvgDeltaVar': 1e-3}
-
-        self.adjacency = adjacency
-        self.mu = mu
-        self.eta = eta
-
-        if weights is None:
-            weights = np.eye(nChs)
-
-        ##############################
-        # initialize state variables #
-        ##############################
-        icaweights = weights
-        if onlineWhitening:
-            icasphere = np.eye(nChs)
-
-        lambda_k = np.zeros((1, blockSizeICA))
-        minNonStatIdx =[]
-        counter       = 1
-
-        if self.adaptiveFF['profile'] == 'cooling' or  self.adaptiveFF['profile'] == 'constant':
-            self.adaptiveFF['lambda_const']  = 1-np.exp(-1 / (self.adaptiveFF['tau_const']))
-
-        if self.evalConvergence['profile']:
-            Rn =[]
-            nonStatIdx =[]
-
-        # sign of kurtosis for each component: true(supergaussian), false(subgaussian)
-        kurtsign = np.ones((nChs, 1))
-        if numSubgaussian != 0:
-            kurtsign[:numSubgaussian] = 0
-
-
-        ######################
-        # sphere-whiten data #
-        ######################
-        if not onlineWhitening: # pre - whitening
-            if verbose:
-                print('Use pre-whitening method.')
-                icasphere = 2.0 * la.inv(sqrtm(np.cov(data))) # find the "sphering" matrix = spher()
-        else: # Online RLS Whitening
-            if verbose:
-                print('Use online whitening method.')
-        # whiten / sphere the data
-        data_w = np.matmul(icasphere, data)
-
-        self.state = State(icaweights, icasphere, lambda_k, minNonStatIdx, counter, Rn, nonStatIdx, kurtsign)
-        self.icasphere_1 = la.inv(self.state.icasphere)
-
-        #########
-        # ORICA #
-        #########
-
-        # divide data into blocks for online block update
-        numBlock = int(np.floor(nPts))
-
-        if verbose:
-            printflag = 0
-            if self.adaptiveFF['profile'] == 'cooling':
-                print('Running ORICA with cooling forgetting factor...')
-            elif self.adaptiveFF['profile'] == 'constant':
-                print('Running ORICA with constant forgetting factor...')
-            elif self.adaptiveFF['profile'] == 'adaptive':
-                print('Running ORICA with adaptive forgetting factor...')
-        t_start = time.time()
-
-        dataRange = np.arange(nPts)
-        if self.adaptiveFF['profile'] == 'cooling':
-            self.state.lambda_k = self.genCoolingFF(self.state.counter + dataRange, self.adaptiveFF['gamma'],
-                                                    self.adaptiveFF['lambda_0'])
-            if self.state.lambda_k[0] < self.adaptiveFF['lambda_const']:
-                self.state.lambda_k = np.squeeze(np.tile(self.adaptiveFF['lambda_const'], (1, nPts)))
-                print('Whatever')
-            self.state.counter = self.state.counter + nPts;
-        elif self.adaptiveFF['profile'] == 'constant':
-            self.state.lambda_k = np.arange(nPts) * self.adaptiveFF['lambda_0']
-        elif self.adaptiveFF['profile'] == 'adaptive':
-            if len(self.state.minNonStatIdx) != 0:
-                self.state.minNonStatIdx = self.state.nonStatIdx
-            self.state.minNonStatIdx = np.max([np.min(self.state.minNonStatIdx, self.state.nonStatIdx), 1])
-            ratioOfNormRn = self.state.nonStatIdx / self.state.minNonStatIdx
-            self.state.lambda_k = self.genAdaptiveFF(dataRange, self.state.lambda_k, ratioOfNormRn)
-
-        # icaweights is A. Assumption: W is A.T
-        for it in range(numPass):
-            for bi in range(nPts):
-                A = self.state.icaweights
-                W = self.state.icaweights.T
-                v = np.expand_dims(data_w[:, bi], axis=1)
-                y = np.expand_dims(np.matmul(W, data_w[:, bi]), axis=1)
-                f = np.zeros((nChs, 1))
-
-                # choose nonlinear functions for super- vs. sub-gaussian
-                f[np.where(self.state.kurtsign == 1)] = -2 * np.tanh(
-                    y[np.where(self.state.kurtsign == 1)])  # Supergaussian
-                f[np.where(self.state.kurtsign == 0)] = 2 * np.tanh(
-                    y[np.where(self.state.kurtsign == 0)])  # Subgaussian
-
-
-                # update weight matrix using online recursive ICA block update rule
-
-                # # Compute smoothing factor
-                if self.mu != 0:
-                    dS = computeRegularizationFactor(A, self.icasphere_1, self.neighbor_mask)
-                    u = np.matmul(v, f.T) + self.mu * dS
-                else:
-                    u = np.matmul(v, f.T)
-
-                self.state.icaweights = (1 - self.state.lambda_k[bi]) * A + \
-                                        self.state.lambda_k[bi] * u
-
-                # orthogonalize weight matrix
-                if not np.mod(bi, block_ica):
-                    try:
-                        D, V = eigh(np.matmul(self.state.icaweights, self.state.icaweights.T))
-                    except LinAlgError:
-                        raise Exception()
-
-                    # diagonalize matrix (maybe every n steps)
-                    self.state.icaweights = np.matmul(
-                        np.matmul(la.solve(np.diag((np.sqrt(np.abs(D)) * np.sign(D))).T, V.T).T,
-                                  V.T), self.state.icaweights)
-                    if verbose:
-                        if printflag < np.floor(10 * (it * numBlock + bi) / numPass / numBlock):
-                            printflag = printflag + 1
-                            print(10 * printflag, '%')
-
-        if verbose:
-            processing_time = time.time() - t_start
-            print('ORICA Finished. Elapsed time: ', processing_time, ' sec.')
-
-        # output weights and sphere matrices
-        self.sphere = self.state.icasphere
-        # mixing from data to y
-        self.unmixing = np.matmul(la.pinv(self.state.icaweights), self.sphere)
-        self.mixing = la.pinv(self.unmixing).T
-        self.y = np.matmul(self.unmixing, data)
-
-
-    def dynamicWhitening(self, blockdata, dataRange):
-        nPts = blockdata.shape[1]
-
-        if self.adaptiveFF['profile'] == 'cooling':
-            lambda_ = self.genCoolingFF(self.state.counter+dataRange, self.adaptiveFF['gamma'], self.adaptiveFF['lambda_0'])
-            if lambda_[0] < self.adaptiveFF['lambda_const']:
-                lambda_ = np.squeeze(np.tile(self.adaptiveFF['lambda_const'], (1, nPts)))
-        elif self.adaptiveFF['profile'] == 'constant':
-            lambda_ = np.squeeze(np.tile(self.adaptiveFF['lambda_const'], (1, nPts)))
-        elif self.adaptiveFF['profile'] == 'adaptive':
-            lambda_ = np.squeeze(np.tile(self.state.lambda_k[-1], (1, nPts)))
-
-
-        v = np.matmul(self.state.icasphere, blockdata) # pre - whitened data
-        lambda_avg = 1 - lambda_[int(np.ceil(len(lambda_) / 2))] # median lambda
-        QWhite = lambda_avg / (1-lambda_avg) + np.trace(np.matmul(v, v.T)) / nPts
-        self.state.icasphere = 1 / lambda_avg * (self.state.icasphere - np.matmul(v, v.T) / nPts
-                                            / QWhite * self.state.icasphere)
-
-
-    def genCoolingFF(self, t, gamma, lambda_0):
-        lambda_ = lambda_0 / (t ** gamma)
-        return lambda_
-
-    def genAdaptiveFF(self, dataRange, lambda_, ratioOfNormRn):
-        decayRateAlpha = self.adaptiveFF['decayRateAlpha']
-        upperBoundBeta = self.adaptiveFF['upperBoundBeta']
-        transBandWidthGamma = self.adaptiveFF['transBandWidthGamma']
-        transBandCenter = self.adaptiveFF['transBandCenter']
-
-        gainForErrors = upperBoundBeta * 0.5 * (1 + np.tanh((ratioOfNormRn - transBandCenter) / transBandWidthGamma))
-        def f(n):
-            return  (1 + gainForErrors) ** n * lambda_[-1] - decayRateAlpha * ((1 + gainForErrors) ** (2 * n - 1) -
-                                                                               (1 + gainForErrors) ** (n - 1)) / \
-                                                                                gainForErrors * lambda_[-1] **2
-        lambda_ = f(range(len(dataRange)))
-
-        return lambda_
-
-
-class ORICA_W_block():
-    def __init__(self, data, numpass=1, weights=None, sphering='offline', lambda_0=0.995, block_white=8, block_ica=8, nsub=0,
-                 forgetfac='cooling', localstat=np.inf, ffdecayrate=0.6, evalconverg=True, verbose=False, mu=0, eta=0,
-                 adjacency=None, regmode='L1'):
-        '''
-
-        Parameters
-        ----------
-        data:          np.array - input data (chans-by-samples)
-        numpass:       number of passes through the data
-        weights:       initial weight matrix     (default -> eye())
-        sphering:      ['offline' | 'online'] use online RLS whitening method or pre-whitening
-        block_white:   block size for online whitening (in samples)
-        block_ica:     block size for ORICA (in samples)
-        nsub:          number of subgaussian sources in EEG signal (default -> 0)
-        forgetfac:     ['cooling'|'constant'|'adaptive'] forgetting factor profiles
-                        'cooling': monotonically decreasing, for relatively stationary data
-                        'constant': constant, for online tracking non-stationary data.
-                        See reference [2] for more information.
-        localstat:     local stationarity (in number of samples) corresponding to
-                       constant forgetting factor at steady state
-        ffdecayrate:   [0<f<1] decay rate of (cooling) forgetting factor (default -> 0.6)
-        evalconverg:   [0|1] evaluate convergence such as Non-Stationarity Index
-        verbose:       bool - give ascii messages  (default -> False)
-        mu:            coefficient for spatial smothing
-        eta:           coefficient for temporal smoothing (when convolutive)
-        adjacency:     adjavency matrix (if mu not 0)
-
-        Reference:
-          [1] S.-H. Hsu, T. Mullen, T.-P Jung, and G. Cauwenberghs, "Real-time
-           adaptive EEG source separation using online recursive independent
-           component analysis," IEEE Transactions on Neural Systems and
-           Rehabilitation Engineering, 2016.
-
-           [2] S.-H. Hsu, L. Pion-Tanachini, T.-P Jung, and G. Cauwenberghs,
-           "Tracking non-stationary EEG sources using adaptive online
-           recursive independent component analysis," in IEEE EMBS, 2015.
-
-           [3] S.-H. Hsu, T. Mullen, T.-P Jung, and G. Cauwenberghs, "Online
-           recursive independent component analysis for real-time source
-           separation of high-density EEG," in IEEE EMBS, 2014.
-
-         Author:
-               Sheng-Hsiou (Shawn) Hsu, SCCN, UCSD.
-               shh078@ucsd.edu
-        '''
-
-        nChs, nPts = data.shape
-
-        numPass = numpass
-        verbose = verbose
-
-        # Parameters for data whitening
-        if sphering == 'online':
-            onlineWhitening = True
-        else:
-            onlineWhitening = False
-        blockSizeWhite = block_white
-        blockSizeICA = block_ica
-        numSubgaussian = nsub
-
-        self.adaptiveFF = {'profile': forgetfac, 'tau_const': np.inf, 'gamma': 0.6, 'lambda_0': lambda_0, 'decayRateAlpha': 0.02,
-                      'upperBoundBeta': 1e-3, 'transBandWidthGamma': 1, 'transBandCenter': 5, 'lambdaInitial': 0.1}
-        self.evalConvergence = {'profile': evalconverg, 'leakyAvgDelta': 0.01, 'leakyAvgDeltaVar': 1e-3}
-
-        self.adjacency = adjacency
-        self.mu = mu
-        self.eta = eta
-        self.smooth_count = 0
-        self.reg = []
-        self.regmode = regmode
-        self.lambdas = np.array([])
-
-
-        if weights is None:
-            weights = np.eye(nChs)
-
-        if self.mu != 0:
-            self.neighbor_masks = []
-            for i in range(weights.shape[0]):
-                for j in range(weights.shape[1]):
-                    mask = []
-                    for k in range(weights.shape[0]):
-                        for l in range(weights.shape[1]):
-                            for n in adjacency[l]:
-                                if l == i or n == i:
-                                    mask.append([i, j, k, l, n])
-                    self.neighbor_masks.append(mask)
-
-        ##############################
-        # initialize state variables #
-        ##############################
-        icaweights = weights
-        if onlineWhitening:
-            icasphere = np.eye(nChs)
-
-        lambda_k = np.zeros((1, blockSizeICA))
-        minNonStatIdx =[]
-        counter       = 1
-
-        if self.adaptiveFF['profile'] == 'cooling' or  self.adaptiveFF['profile'] == 'constant':
-            self.adaptiveFF['lambda_const']  = 1-np.exp(-1 / (self.adaptiveFF['tau_const']))
-
-        if self.evalConvergence['profile']:
-            Rn =[]
-            nonStatIdx =[]
-
-        # sign of kurtosis for each component: true(supergaussian), false(subgaussian)
-        kurtsign = np.ones((nChs, 1))
-        if numSubgaussian != 0:
-            kurtsign[:numSubgaussian] = 0
+    def onlineMean(self, blockdata):
+        block_sum = np.sum(blockdata, axis=1, dtype=np.float64)
+        self.means = 1. / self.N * (self.sumx + block_sum)[:, np.newaxis]
+        self.sumx += block_sum
 
+    def onlineNSIUpdate(self, newNSI, ff=None):
+        if ff == None:
+            if self.iter > 1:
+                ff = 1. /(self.iter - 1)
+            else:
+                ff = 1.
 
-        ######################
-        # sphere-whiten data #
-        ######################
-        if not onlineWhitening: # pre - whitening
-            if verbose:
-                print('Use pre-whitening method.')
-                icasphere = 2.0 * la.inv(sqrtm(np.cov(data))) # find the "sphering" matrix = spher()
-        else: # Online RLS Whitening
-            if verbose:
-                print('Use online whitening method.')
-        # whiten / sphere the data
-        data_w = np.matmul(icasphere, data)
+        if self.iter > 1:
+            self.NSImean = (1 - ff) * self.NSImean + ff * newNSI
+            self.NSIvar = (1 - ff) * self.NSIvar + ff * (1 - ff) * (newNSI - self.NSImean) ** 2
+        else:
+            self.NSImean = newNSI
+            self.NSIvar = 1.
 
-        self.state = State(icaweights, icasphere, lambda_k, minNonStatIdx, counter, Rn, nonStatIdx, kurtsign)
-        self.icasphere_1 = la.inv(self.state.icasphere)
+        normNSI = (newNSI - self.NSImean) / np.sqrt(self.NSIvar)
+        # if normNSI > self.adaptiveFF['transBandCenter']:
+        #     self.tracking = True
+        # else:
+        #     if self.tracking:
+        #         self.tracking = False
+        #         self.tracking_iter = 0
+        #         print('STOP TRACKING')
 
-        #########
-        # ORICA #
-        #########
+        return normNSI
 
-        # divide data into blocks for online block update
-        numBlock = int(np.floor(nPts / np.min([blockSizeICA, blockSizeWhite])))
 
-        if verbose:
-            printflag = 0
-            if self.adaptiveFF['profile'] == 'cooling':
-                print('Running ORICA with cooling forgetting factor...')
-            elif self.adaptiveFF['profile'] == 'constant':
-                print('Running ORICA with constant forgetting factor...')
-            elif self.adaptiveFF['profile'] == 'adaptive':
-                print('Running ORICA with adaptive forgetting factor...')
-        t_start = time.time()
+    def calibratePCA(self, blockdata):
+        if not self.pca_calibrated:
+            self.pca_buffer.append(blockdata)
+        if self.N >= self.n_pca_window and not self.pca_calibrated:
+            data_init = np.concatenate(self.pca_buffer, axis=1)[:, :self.n_pca_window]
+            print('PCA calibration')
+            if self.ndim == 'all':
+                _, eigvecs, eigvals, sphere = whiten_data(data_init)
+            else:
+                _, eigvecs, eigvals, sphere = whiten_data(data_init, self.ndim)
+            self.icasphere = sphere
+            self.pca_calibrated = True
+            self.pca_buffer = []
 
-        self.glob_count = 0
 
-        for it in range(numPass):
-            for bi in range(numBlock):
-                dataRange = np.arange(int(np.floor(bi * nPts / numBlock)),
-                                  int(np.min([nPts, np.floor((bi + 1) * nPts / numBlock)])))
-                if onlineWhitening:
-                    self.dynamicWhitening(data_w[:, dataRange], dataRange)
-                    data_w[:, dataRange] = np.matmul(self.state.icasphere, data_w[:, dataRange])
+    def streamingPCA(self, blockdata):
+        '''Incremental PCA: exponentially weighted covariance update with a (mean removed) block, one subspace
+        iteration of the principal components and sphere from the components.
 
-                # if np.any(np.isnan(data[:, dataRange])):
-                #     raise Exception()
-                self.dynamicOrica(data_w[:, dataRange], dataRange)
+        The covariance weight of the new block is 1 / (number of blocks) until it reaches block / pca_window
+        (memory of pca_window seconds). Component signs are kept consistent between blocks.
+        '''
+        data_cent = blockdata - self.means
+        nPts = data_cent.shape[1]
+        self.pca_blocks += 1
+        rate = np.max([1. / self.pca_blocks, float(nPts) / self.n_pca_memory])
+        self.pca_cov *= 1 - rate
+        self.pca_cov += rate / nPts * np.matmul(data_cent, data_cent.T)
 
-                if verbose:
-                    if printflag < np.floor(10 * (it * numBlock + bi) / numPass / numBlock):
-                        printflag = printflag + 1
-                        print(10 * printflag, '%')
+        eigvecs, _ = la.qr(np.matmul(self.pca_cov, self.eigvecs))
+        eigvecs *= np.where(np.sum(eigvecs * self.eigvecs, axis=0) < 0, -1., 1.)
+        self.eigvecs = eigvecs
+        self.eigvals = np.maximum(np.sum(eigvecs * np.matmul(self.pca_cov, eigvecs), axis=0), np.finfo(float).eps)
+        self.icasphere = np.matmul(np.diag(1. / np.sqrt(self.eigvals)), self.eigvecs.T)
 
-        if verbose:
-            processing_time = time.time() - t_start
-            print('ORICA Finished. Elapsed time: ', processing_time, ' sec.')
 
-        # output weights and sphere matrices
-        self.sphere = self.state.icasphere
-        self.unmixing = np.matmul(self.state.icaweights, self.sphere)
-        self.mixing = la.pinv(np.matmul(self.unmixing, self.sphere)).T
-        self.y = np.matmul(self.unmixing, data)
-        self.reg = np.array(self.reg)
+    def dynamicWhitening(self, blockdata, dataRange, whitening=True):
+        nChs, nPts = blockdata.shape
 
+        if not whitening and not self.evalConvergence['profile']:
+            return
 
-    def dynamicWhitening(self, blockdata, dataRange):
-        nPts = blockdata.shape[1]
+        v = np.matmul(self.icasphere, blockdata) # pre - whitened data
+        cov = None
 
-        if self.adaptiveFF['profile'] == 'cooling':
-            lambda_ = self.genCoolingFF(self.state.counter+dataRange, self.adaptiveFF['gamma'], self.adaptiveFF['lambda_0'])
-            if lambda_[0] < self.adaptiveFF['lambda_const']:
-                lambda_ = np.squeeze(np.tile(self.adaptiveFF['lambda_const'], (1, nPts)))
-        elif self.adaptiveFF['profile'] == 'constant':
-            lambda_ = np.squeeze(np.tile(self.adaptiveFF['lambda_const'], (1, nPts)))
-        elif self.adaptiveFF['profile'] == 'adaptive':
-            lambda_ = np.squeeze(np.tile(self.state.lambda_k[-1], (1, nPts)))
+        if self.evalConvergence['profile']:
+            cov = np.matmul(v, v.T)
+            modelFitness = np.eye(len(v)) - cov/nPts
+            # the sphere changes size after the PCA calibration
+            self.Vn = self.leakyFitness(self.Vn, modelFitness)
+            self.whiteIdx = la.norm(self.Vn)
+            self.diagnostics.record('WI', self.whiteIdx)
 
+        if whitening:
+            if self.adaptiveFF['profile'] == 'cooling':
+                lambda_ = self.blockCoolingFF(self.white_counter + dataRange, self.adaptiveFF['min_lambda'])
+            elif self.adaptiveFF['profile'] == 'constant':
+                lambda_ = np.ones(nPts) * self.adaptiveFF['lambda_0']
 
-        v = np.matmul(self.state.icasphere, blockdata) # pre - whitened data
-        lambda_avg = 1 - lambda_[int(np.ceil(len(lambda_) / 2))] # median lambda
-        QWhite = lambda_avg / (1-lambda_avg) + np.trace(np.matmul(v, v.T)) / nPts
-        self.state.icasphere = 1 / lambda_avg * (self.state.icasphere - np.matmul(v, v.T) / nPts
-                                            / QWhite * self.state.icasphere)
+            lambda_avg = 1 - lambda_[int(np.ceil(len(lambda_) / 2))] # median lambda
+            self.icasphere = rls_whitening_update(self.icasphere, v, lambda_avg, cov)
 
 
     def dynamicOrica(self, blockdata, dataRange, nlfunc=None):
 
         # initialize
         nChs, nPts = blockdata.shape
-        f = np.zeros((nChs, nPts))
-        A = self.state.icaweights.T
-        W = self.state.icaweights
-        # compute source activation using previous weight matrix
-        y = np.matmul(self.state.icaweights, blockdata)
-        v = blockdata
-
+        # compute source activation using previous weight matrix and
         # choose nonlinear functions for super- vs. sub-gaussian
-        if nlfunc is None:
-            f[np.where(self.state.kurtsign==1), :]  = -2 * np.tanh(y[np.where(self.state.kurtsign==1), :])  # Supergaussian
-            f[np.where(self.state.kurtsign==0), :] = 2 * np.tanh(y[np.where(self.state.kurtsign==0), :])  # Subgaussian
-        else:
-            f = nlfunc(y);
+        y, f = orica_sources(self.icaweights, blockdata, self.nlsign, self.buffers, nlfunc)
 
         # compute Non-Stationarity Index (nonStatIdx) and variance of source dynamics (Var)
         if self.evalConvergence['profile']:
-            modelFitness = np.eye(nChs) + np.matmul(y, f.T)/nPts
-            variance = blockdata * blockdata
-            if len(self.state.Rn) == 0:
-                self.state.Rn = modelFitness
+            modelFitness = np.eye(nChs) - np.matmul(y, f.T) / nPts
+            # modelFitness = (np.eye(nChs) - np.matmul(y, f.T) / nPts) / nChs
+            # variance = blockdata * blockdata
+            self.Rn = self.leakyFitness(self.Rn, modelFitness)
+            self.nonStatIdx = la.norm(self.Rn)
+            # self.nonStatIdx = la.norm(modelFitness)
+            self.diagnostics.record('NSI', self.nonStatIdx)
+            if dataRange[-1] + 1 > self.n_pca_window + self.n_ica_window:
+                self.iter += 1
+                self.nsinorm = self.onlineNSIUpdate(self.nonStatIdx, ff=self.adaptiveFF['ff'])
             else:
-                self.state.Rn = (1 - self.evalConvergence['leakyAvgDelta']) * self.state.Rn + \
-                                self.evalConvergence['leakyAvgDelta'] * modelFitness
-                #!!! this does not account for block update!
-            self.state.nonStatIdx = la.norm(self.state.Rn)
-
+                self.nsinorm = 0
+            self.diagnostics.record('normNSI', self.nsinorm)
 
         if self.adaptiveFF['profile'] == 'cooling':
-            self.state.lambda_k = self.genCoolingFF(self.state.counter + dataRange, self.adaptiveFF['gamma'],
-                                                    self.adaptiveFF['lambda_0'])
-            if self.state.lambda_k[0] < self.adaptiveFF['lambda_const']:
-                self.state.lambda_k = np.squeeze(np.tile(self.adaptiveFF['lambda_const'], (1, nPts)))
-            self.state.counter = self.state.counter + nPts;
+            self.lambda_k = self.blockCoolingFF(self.counter + dataRange, self.adaptiveFF['min_lambda'])
+            self.counter = self.counter + nPts
         elif self.adaptiveFF['profile'] == 'constant':
-            self.state.lambda_k = np.arange(nPts) * self.adaptiveFF['lambda_0']
+            self.lambda_k = np.ones(nPts) * self.adaptiveFF['lambda_0']
         elif self.adaptiveFF['profile'] == 'adaptive':
-            if len(self.state.minNonStatIdx) != 0:
-                self.state.minNonStatIdx = self.state.nonStatIdx
-            self.state.minNonStatIdx = np.max([np.min(self.state.minNonStatIdx, self.state.nonStatIdx), 1])
-            ratioOfNormRn = self.state.nonStatIdx / self.state.minNonStatIdx
-            self.state.lambda_k = self.genAdaptiveFF(dataRange, self.state.lambda_k, ratioOfNormRn)
+            if self.minNonStatIdx == -1:
+                self.minNonStatIdx = self.nonStatIdx
+            self.minNonStatIdx = np.max([np.min([self.minNonStatIdx, self.nonStatIdx]), 1])
+            ratioOfNormRn = self.nonStatIdx / self.minNonStatIdx
+            # self.lambda_k = self.genAdaptiveFF(dataRange, self.lambda_k, ratioOfNormRn)
+            self.lambda_k = self.genAdaptiveFF(dataRange, self.lambda_k, self.nsinorm)
+            self.diagnostics.record('ratios', ratioOfNormRn)
 
-        self.lambdas = np.concatenate((self.lambdas, self.state.lambda_k))
+        self.diagnostics.record('lambdas', self.lambda_k, samples=True)
 
 
-        coeff = np.append(1, self.state.lambda_k) * np.append(1,np.cumprod(1 - self.state.lambda_k[::-1]))[::-1]
+        # update weight matrix using online recursive ICA block update rule
+        self.icaweights = orica_weight_update(self.icaweights, y, f, self.lambda_k, self.buffers)
 
-        # Compute smoothing factor
-        if self.mu != 0:
-            self.smooth_count += 1
-
-            dS, S = computeRegularizationFactor(W, M_1 = self.icasphere_1, mode=self.regmode, adj_graph=self.adjacency)
-            self.smooth_count = 0
-            self.glob_count += 1
-            self.reg.append(S)
-            self.state.icaweights = coeff[0] * self.state.icaweights + np.matmul(np.matmul(f, np.diag(coeff[1:])), v.T)\
-                                    + self.mu * np.sum(coeff[1:]) * dS #np.sum(np.einsum('i,jk->ijk', coeff, dS), axis=0)
-        else:
-            self.state.icaweights = coeff[0] * self.state.icaweights + np.matmul(np.matmul(f, np.diag(coeff[1:])), v.T)
+        self.count += 1
+        if not np.all(np.isfinite(self.icaweights)):
+            raise ValueError('ORICA weights diverged (non-finite values) at block ' + str(self.count) +
+                             ': use a smaller forgetting factor (lambda_0)')
 
         # orthogonalize weight matrix
-        try:
-            D, V = eigh(np.matmul(self.state.icaweights, self.state.icaweights.T))
-        except LinAlgError:
-            raise Exception()
-
-        # curr_state = self.state.icaweights
-        self.state.icaweights = np.matmul(np.matmul(la.solve(np.diag((np.sqrt(np.abs(D)) * np.sign(D))).T, V.T).T,
-                                                    V.T), self.state.icaweights)
-
-    def genCoolingFF(self, t, gamma, lambda_0):
-        lambda_ = lambda_0 / (t ** gamma)
-        return lambda_
-
-    def genAdaptiveFF(self, dataRange, lambda_, ratioOfNormRn):
-        decayRateAlpha = self.adaptiveFF['decayRateAlpha']
-        upperBoundBeta = self.adaptiveFF['upperBoundBeta']
-        transBandWidthGamma = self.adaptiveFF['transBandWidthGamma']
-        transBandCenter = self.adaptiveFF['transBandCenter']
-
-        gainForErrors = upperBoundBeta * 0.5 * (1 + np.tanh((ratioOfNormRn - transBandCenter) / transBandWidthGamma))
-        def f(n):
-            return  (1 + gainForErrors) ** n * lambda_[-1] - decayRateAlpha * ((1 + gainForErrors) ** (2 * n - 1) -
-                                                                               (1 + gainForErrors) ** (n - 1)) / \
-                                                                                gainForErrors * lambda_[-1] **2
-        lambda_ = f(range(len(dataRange)))
-
-        return lambda_
+        if not np.mod(self.count, self.ortho_every):
+            self.icaweights = orica_orthogonalize(self.icaweights, mode=self.ortho_mode, n_iter=self.ortho_iter)
+        else:
+            # keep unit row norm on average between orthogonalizations
+            self.icaweights = self.icaweights * np.sqrt(self.icaweights.shape[0] / np.sum(self.icaweights ** 2))
 
 
-class ORICA_A_block():
-    def __init__(self, data, numpass=1, weights=None, sphering='offline', lambda_0=0.995, block_white=8, block_ica=8, nsub=0,
-                 forgetfac='cooling', localstat=np.inf, ffdecayrate=0.6, evalconverg=True, verbose=False, mu=0, eta=0,
-                 adjacency=None, regmode='L1'):
+class ORICACore(ORICABase):
+    def __init__(self, data, numpass=1, weights=None, sphering='offline', lambda_0=0.995, block_white=8, block_ica=8,
+                 nsub=0, forgetfac='cooling', localstat=np.inf, ffdecayrate=0.6, evalconverg=True, verbose=False, mu=0,
+                 eta=0, adjacency=None, regmode='L1', dtype=np.float64, rule='W', block_update=True):
         '''
+        ORICA with the W (unmixing) or A (mixing) update rule, per-sample or per-block. ORICA_W, ORICA_A,
+        ORICA_W_block and ORICA_A_block are thin wrappers around this class.
 
         Parameters
         ----------
@@ -1726,11 +2234,14 @@ class ORICA_A_block():
         weights:       initial weight matrix     (default -> eye())
         sphering:      ['offline' | 'online'] use online RLS whitening method or pre-whitening
         block_white:   block size for online whitening (in samples)
-        block_ica:     block size for ORICA (in samples)
+        block_ica:     block size for ORICA (in samples). With per-sample updates, weights are orthogonalized
+                       every block_ica samples
         nsub:          number of subgaussian sources in EEG signal (default -> 0)
         forgetfac:     ['cooling'|'constant'|'adaptive'] forgetting factor profiles
                         'cooling': monotonically decreasing, for relatively stationary data
                         'constant': constant, for online tracking non-stationary data.
+                        'adaptive': driven by the Non-Stationarity Index of the blocks (with per-sample
+                                    updates, no index is available and it decays from lambdaInitial)
                         See reference [2] for more information.
         localstat:     local stationarity (in number of samples) corresponding to
                        constant forgetting factor at steady state
@@ -1740,6 +2251,12 @@ class ORICA_A_block():
         mu:            coefficient for spatial smothing
         eta:           coefficient for temporal smoothing (when convolutive)
         adjacency:     adjavency matrix (if mu not 0)
+        regmode:       regularization (if mu not 0, see computeRegularizationFactor)
+        dtype:         [np.float64|np.float32] floating point type of whitened data, weights and sources (float32
+                       halves memory and memory bandwidth)
+        rule:          ['W'|'A'] the weights are the unmixing matrix W (y = W x) or the mixing matrix A (y = A^T x)
+        block_update:  if True, the weights are updated once per block with the forgetting factor weighted sum of
+                       the per-sample updates, otherwise once per sample
 
         Reference:
           [1] S.-H. Hsu, T. Mullen, T.-P Jung, and G. Cauwenberghs, "Real-time
@@ -1761,9 +2278,11 @@ class ORICA_A_block():
         '''
 
         nChs, nPts = data.shape
-
-        numPass = numpass
-        verbose = verbose
+        self.dtype = check_dtype(dtype)
+        if rule not in ['W', 'A']:
+            raise AttributeError('Unknown update rule: ' + str(rule))
+        self.rule = rule
+        self.block_update = block_update
 
         # Parameters for data whitening
         if sphering == 'online':
@@ -1774,55 +2293,41 @@ class ORICA_A_block():
         blockSizeICA = block_ica
         numSubgaussian = nsub
 
-        self.adaptiveFF = {'profile': forgetfac, 'tau_const': np.inf, 'gamma': 0.6, 'lambda_0': lambda_0, 'decayRateAlpha': 0.02,
+        self.adaptiveFF = {'profile': forgetfac, 'tau_const': np.inf, 'gamma': ffdecayrate, 'lambda_0': lambda_0, 'decayRateAlpha': 0.02,
                       'upperBoundBeta': 1e-3, 'transBandWidthGamma': 1, 'transBandCenter': 5, 'lambdaInitial': 0.1}
         self.evalConvergence = {'profile': evalconverg, 'leakyAvgDelta': 0.01, 'leakyAvgDeltaVar': 1e-3}
 
         self.adjacency = adjacency
         self.mu = mu
         self.eta = eta
-        self.smooth_count = 0
         self.reg = []
         self.regmode = regmode
-        self.lambdas = np.array([])
+        self.diagnostics = Diagnostics()
 
         if weights is None:
-            weights = np.eye(nChs)
-
-        if self.mu != 0:
-            self.neighbor_masks = []
-            for i in range(weights.shape[0]):
-                for j in range(weights.shape[1]):
-                    mask = []
-                    for k in range(weights.shape[0]):
-                        for l in range(weights.shape[1]):
-                            for n in adjacency[l]:
-                                if l == i or n == i:
-                                    mask.append([i, j, k, l, n])
-                    self.neighbor_masks.append(mask)
+            weights = np.eye(nChs, dtype=self.dtype)
 
         ##############################
         # initialize state variables #
         ##############################
-        icaweights = weights
-        if onlineWhitening:
-            icasphere = np.eye(nChs)
+        icaweights = np.asarray(weights, dtype=self.dtype)
 
-        lambda_k = np.zeros((1, blockSizeICA))
-        minNonStatIdx =[]
+        if self.adaptiveFF['profile'] == 'adaptive':
+            lambda_k = self.adaptiveFF['lambdaInitial'] * np.ones(blockSizeICA)
+        else:
+            lambda_k = np.zeros(blockSizeICA)
+        minNonStatIdx = -1
         counter       = 1
 
         if self.adaptiveFF['profile'] == 'cooling' or  self.adaptiveFF['profile'] == 'constant':
             self.adaptiveFF['lambda_const']  = 1-np.exp(-1 / (self.adaptiveFF['tau_const']))
 
-        if self.evalConvergence['profile']:
-            Rn =[]
-            nonStatIdx =[]
-
         # sign of kurtosis for each component: true(supergaussian), false(subgaussian)
         kurtsign = np.ones((nChs, 1))
         if numSubgaussian != 0:
             kurtsign[:numSubgaussian] = 0
+        # nonlinearity sign per component: -2 * tanh (supergaussian), 2 * tanh (subgaussian)
+        self.nlsign = np.where(kurtsign == 1, -2., 2.).astype(self.dtype)
 
 
         ######################
@@ -1831,38 +2336,107 @@ class ORICA_A_block():
         if not onlineWhitening: # pre - whitening
             if verbose:
                 print('Use pre-whitening method.')
-                icasphere = 2.0 * la.inv(sqrtm(np.cov(data))) # find the "sphering" matrix = spher()
+            icasphere = 2.0 * la.inv(sqrtm(np.cov(data))) # find the "sphering" matrix = spher()
         else: # Online RLS Whitening
             if verbose:
                 print('Use online whitening method.')
+            icasphere = np.eye(nChs)
         # whiten / sphere the data
-        data_w = np.matmul(icasphere, data)
+        data_w = np.matmul(icasphere.astype(self.dtype), data.astype(self.dtype, copy=False))
 
-        self.state = State(icaweights, icasphere, lambda_k, minNonStatIdx, counter, Rn, nonStatIdx, kurtsign)
+        self.state = State(icaweights, icasphere, lambda_k, minNonStatIdx, counter, [], [], kurtsign)
+        self.buffers = BlockBuffers(dtype=self.dtype)
         self.icasphere_1 = la.inv(self.state.icasphere)
 
         #########
         # ORICA #
         #########
 
-        # divide data into blocks for online block update
-        numBlock = int(np.floor(nPts / np.min([blockSizeICA, blockSizeWhite])))
-
         if verbose:
-            printflag = 0
             if self.adaptiveFF['profile'] == 'cooling':
                 print('Running ORICA with cooling forgetting factor...')
             elif self.adaptiveFF['profile'] == 'constant':
                 print('Running ORICA with constant forgetting factor...')
             elif self.adaptiveFF['profile'] == 'adaptive':
                 print('Running ORICA with adaptive forgetting factor...')
-
         t_start = time.time()
 
-        for it in range(numPass):
+        if block_update:
+            self.fitBlocks(data_w, numpass, np.min([blockSizeICA, blockSizeWhite]), onlineWhitening, verbose)
+            self.lambdas = self.diagnostics.get('lambdas')
+        else:
+            self.fitSamples(data_w, numpass, blockSizeICA, verbose)
+
+        if verbose:
+            processing_time = time.time() - t_start
+            print('ORICA Finished. Elapsed time: ', processing_time, ' sec.')
+
+        # output weights and sphere matrices
+        self.sphere = self.state.icasphere
+        if self.rule == 'W':
+            self.unmixing = np.matmul(self.state.icaweights, self.sphere)
+        else:
+            # mixing from data to y
+            self.unmixing = np.matmul(la.pinv(self.state.icaweights), self.sphere)
+        self.mixing = la.pinv(self.unmixing).T
+        self.y = self.transform(data)
+        self.reg = np.array(self.reg)
+
+
+    def transform(self, chunk):
+        '''Projects a chunk of data (chans-by-samples) on the sources.'''
+        return np.matmul(self.unmixing.astype(self.dtype, copy=False), chunk.astype(self.dtype, copy=False))
+
+
+    def fitSamples(self, data_w, numpass, block_ica, verbose=False):
+        '''Per-sample updates (forgetting factors are computed once for the whole recording).'''
+        nChs, nPts = data_w.shape
+        self.updateFF(np.arange(nPts))
+        # per-sample forgetting factors in the working precision (no products over samples are taken)
+        self.state.lambda_k = self.state.lambda_k.astype(self.dtype)
+        self.lambdas = self.state.lambda_k
+        lambda_k = self.state.lambda_k
+        nlsign = self.nlsign[:, 0]
+
+        printflag = 0
+        for it in range(numpass):
+            for bi in range(nPts):
+                v = data_w[:, bi]
+                W = self.weightsW()
+                y = np.matmul(W, v)
+                # choose nonlinear functions for super- vs. sub-gaussian
+                f = nlsign * np.tanh(y)
+
+                if self.rule == 'W':
+                    u = np.outer(f, v)
+                else:
+                    u = np.outer(v, f)
+                if self.mu != 0:
+                    u = u + self.mu * self.regularization(W)
+
+                self.state.icaweights = (1 - lambda_k[bi]) * self.state.icaweights + lambda_k[bi] * u
+
+                # orthogonalize weight matrix
+                if not np.mod(bi, block_ica):
+                    self.orthogonalize()
+
+                    if verbose:
+                        if printflag < np.floor(10 * (it * nPts + bi) / numpass / nPts):
+                            printflag = printflag + 1
+                            print(10 * printflag, '%')
+
+
+    def fitBlocks(self, data_w, numpass, block, onlineWhitening, verbose=False):
+        '''Block updates (the whitened data are updated in place with online whitening).'''
+        nPts = data_w.shape[1]
+        # divide data into blocks for online block update
+        numBlock = int(np.floor(nPts / block))
+
+        printflag = 0
+        for it in range(numpass):
             for bi in range(numBlock):
                 dataRange = np.arange(int(np.floor(bi * nPts / numBlock)),
-                                  int(np.min([nPts, np.floor((bi + 1) * nPts / numBlock)])))
+                                      int(np.min([nPts, np.floor((bi + 1) * nPts / numBlock)])))
                 if onlineWhitening:
                     self.dynamicWhitening(data_w[:, dataRange], dataRange)
                     data_w[:, dataRange] = np.matmul(self.state.icasphere, data_w[:, dataRange])
@@ -1870,145 +2444,161 @@ class ORICA_A_block():
                 self.dynamicOrica(data_w[:, dataRange], dataRange)
 
                 if verbose:
-                    if printflag < np.floor(10 * (it * numBlock + bi) / numPass / numBlock):
+                    if printflag < np.floor(10 * (it * numBlock + bi) / numpass / numBlock):
                         printflag = printflag + 1
                         print(10 * printflag, '%')
 
-        if verbose:
-            processing_time = time.time() - t_start
-            print('ORICA Finished. Elapsed time: ', processing_time, ' sec.')
 
+    def weightsW(self):
+        '''Returns the matrix giving the sources (y = W x) from the weights.'''
+        if self.rule == 'W':
+            return self.state.icaweights
+        return self.state.icaweights.T
 
-        # output weights and sphere matrices
-        self.sphere = self.state.icasphere
-        # mixing from data to y
-        self.unmixing = np.matmul(la.pinv(self.state.icaweights), self.sphere)
-        self.mixing = la.pinv(self.unmixing).T
-        self.y = np.matmul(self.unmixing, data)
+
+    def regularization(self, W):
+        '''Regularization gradient in the weights coordinates (the value is stored in self.reg).'''
+        dS, S = computeRegularizationFactor(W, M_1=self.icasphere_1, mode=self.regmode, adj_graph=self.adjacency)
+        self.reg.append(S)
+        if self.rule == 'W':
+            return dS
+        return dS.T
+
+
+    def orthogonalize(self):
+        '''Symmetric orthogonalization of the weights: (W W^T)^(-1/2) W.
+
+        The per-sample updates are chaotic (rounding differences grow to O(1)), so the expression of the update loops
+        before the consolidation is kept (instead of orica_orthogonalize) to reproduce their results.'''
+        try:
+            D, V = eigh(np.matmul(self.state.icaweights, self.state.icaweights.T))
+        except LinAlgError as e:
+            raise LinAlgError('Orthogonalization of the ORICA weights failed (eigendecomposition of W W^T): ' + str(e))
+        self.state.icaweights = np.matmul(np.matmul(la.solve(np.diag((np.sqrt(np.abs(D)) * np.sign(D))).T, V.T).T,
+                                                    V.T), self.state.icaweights).astype(self.dtype, copy=False)
+
+
+    def updateFF(self, dataRange):
+        '''Forgetting factors of the samples in dataRange (self.state.lambda_k).'''
+        nPts = len(dataRange)
+        if self.adaptiveFF['profile'] == 'cooling':
+            self.state.lambda_k = self.blockCoolingFF(self.state.counter + dataRange)
+            self.state.counter = self.state.counter + nPts
+        elif self.adaptiveFF['profile'] == 'constant':
+            self.state.lambda_k = np.arange(nPts) * self.adaptiveFF['lambda_0']
+        elif self.adaptiveFF['profile'] == 'adaptive':
+            if np.size(self.state.nonStatIdx) == 0:
+                # per-sample updates: the forgetting factors are computed before any non-stationarity index
+                ratioOfNormRn = 1.
+            else:
+                if self.state.minNonStatIdx == -1:
+                    self.state.minNonStatIdx = self.state.nonStatIdx
+                self.state.minNonStatIdx = np.max([np.min([self.state.minNonStatIdx, self.state.nonStatIdx]), 1])
+                ratioOfNormRn = self.state.nonStatIdx / self.state.minNonStatIdx
+            self.state.lambda_k = self.genAdaptiveFF(dataRange, self.state.lambda_k, ratioOfNormRn)
 
 
     def dynamicWhitening(self, blockdata, dataRange):
         nPts = blockdata.shape[1]
 
         if self.adaptiveFF['profile'] == 'cooling':
-            lambda_ = self.genCoolingFF(self.state.counter+dataRange, self.adaptiveFF['gamma'], self.adaptiveFF['lambda_0'])
-            if lambda_[0] < self.adaptiveFF['lambda_const']:
-                lambda_ = np.squeeze(np.tile(self.adaptiveFF['lambda_const'], (1, nPts)))
+            lambda_ = self.blockCoolingFF(self.state.counter + dataRange)
         elif self.adaptiveFF['profile'] == 'constant':
             lambda_ = np.squeeze(np.tile(self.adaptiveFF['lambda_const'], (1, nPts)))
         elif self.adaptiveFF['profile'] == 'adaptive':
             lambda_ = np.squeeze(np.tile(self.state.lambda_k[-1], (1, nPts)))
 
-
         v = np.matmul(self.state.icasphere, blockdata) # pre - whitened data
         lambda_avg = 1 - lambda_[int(np.ceil(len(lambda_) / 2))] # median lambda
-        QWhite = lambda_avg / (1-lambda_avg) + np.trace(np.matmul(v, v.T)) / nPts
-        self.state.icasphere = 1 / lambda_avg * (self.state.icasphere - np.matmul(v, v.T) / nPts
-                                            / QWhite * self.state.icasphere)
+        cov = np.matmul(v, v.T)
+        QWhite = lambda_avg / (1-lambda_avg) + np.trace(cov) / nPts
+        # the correction is applied elementwise: the sphere stays diagonal (per-channel RLS normalization)
+        self.state.icasphere = 1 / lambda_avg * (self.state.icasphere - cov / nPts / QWhite * self.state.icasphere)
 
 
     def dynamicOrica(self, blockdata, dataRange, nlfunc=None):
 
         # initialize
         nChs, nPts = blockdata.shape
-        f = np.zeros((nChs, nPts))
-        A = self.state.icaweights
-        W = self.state.icaweights.T
-        y = np.matmul(W, blockdata)
+        W = self.weightsW()
         v = blockdata
-
+        # compute source activation using previous weight matrix and
         # choose nonlinear functions for super- vs. sub-gaussian
-        if nlfunc is None:
-            f[np.where(self.state.kurtsign==1), :]  = -2 * np.tanh(y[np.where(self.state.kurtsign==1), :])  # Supergaussian
-            f[np.where(self.state.kurtsign==0), :] = 2 * np.tanh(y[np.where(self.state.kurtsign==0), :])  # Subgaussian
-        else:
-            f = nlfunc(y);
+        y, f = orica_sources(W, blockdata, self.nlsign, self.buffers, nlfunc)
 
         # compute Non-Stationarity Index (nonStatIdx) and variance of source dynamics (Var)
-        if self.evalConvergence['profile']:
+        # (the adaptive forgetting factor needs it)
+        if self.evalConvergence['profile'] or self.adaptiveFF['profile'] == 'adaptive':
             modelFitness = np.eye(nChs) + np.matmul(y, f.T)/nPts
-            variance = blockdata * blockdata
-            if len(self.state.Rn) == 0:
-                self.state.Rn = modelFitness
-            else:
-                self.state.Rn = (1 - self.evalConvergence['leakyAvgDelta']) * self.state.Rn + \
-                                self.evalConvergence['leakyAvgDelta'] * modelFitness
-                #!!! this does not account for block update!
+            self.state.Rn = self.leakyFitness(self.state.Rn, modelFitness)
             self.state.nonStatIdx = la.norm(self.state.Rn)
 
-
-        if self.adaptiveFF['profile'] == 'cooling':
-            self.state.lambda_k = self.genCoolingFF(self.state.counter + dataRange, self.adaptiveFF['gamma'],
-                                                    self.adaptiveFF['lambda_0'])
-            if self.state.lambda_k[0] < self.adaptiveFF['lambda_const']:
-                self.state.lambda_k = np.squeeze(np.tile(self.adaptiveFF['lambda_const'], (1, nPts)))
-            self.state.counter = self.state.counter + nPts;
-        elif self.adaptiveFF['profile'] == 'constant':
-            self.state.lambda_k = np.arange(nPts) * self.adaptiveFF['lambda_0']
-        elif self.adaptiveFF['profile'] == 'adaptive':
-            if len(self.state.minNonStatIdx) != 0:
-                self.state.minNonStatIdx = self.state.nonStatIdx
-            self.state.minNonStatIdx = np.max([np.min(self.state.minNonStatIdx, self.state.nonStatIdx), 1])
-            ratioOfNormRn = self.state.nonStatIdx / self.state.minNonStatIdx
-            self.state.lambda_k = self.genAdaptiveFF(dataRange, self.state.lambda_k, ratioOfNormRn)
-
+        self.updateFF(dataRange)
+        self.diagnostics.record('lambdas', self.state.lambda_k, samples=True)
 
         coeff = np.append(1, self.state.lambda_k) * np.append(1, np.cumprod(1 - self.state.lambda_k[::-1]))[::-1]
+        # coefficients are computed in float64 and applied in the working precision
+        coeff_block = coeff[1:].astype(self.dtype)
 
-        if self.mu != 0:
-            self.smooth_count += 1
-
-            dS, S = computeRegularizationFactor(W, M_1 = self.icasphere_1, mode=self.regmode, adj_graph=self.adjacency)
-            self.smooth_count = 0
-            # self.glob_count += 1
-            self.reg.append(S)
-            self.state.icaweights = coeff[0] * self.state.icaweights + np.matmul(np.matmul(v, np.diag(coeff[1:])), f.T)\
-                                    + self.mu * np.sum(coeff[1:]) * dS.T #np.sum(np.einsum('i,jk->ijk', coeff, dS), axis=0)
+        # update weight matrix using online recursive ICA block update rule
+        if self.rule == 'W':
+            icaweights = coeff[0] * self.state.icaweights + np.matmul(f * coeff_block, v.T)
         else:
-            self.state.icaweights = coeff[0] * self.state.icaweights + np.matmul(np.matmul(v, np.diag(coeff[1:])), f.T)
-
+            icaweights = coeff[0] * self.state.icaweights + np.matmul(v * coeff_block, f.T)
+        if self.mu != 0:
+            icaweights = icaweights + self.mu * np.sum(coeff[1:]) * self.regularization(W)
+        self.state.icaweights = icaweights
 
-        # orthogonalize weight matrix (A)
-        try:
-            D, V = eigh(np.matmul(self.state.icaweights, self.state.icaweights.T))
-        except LinAlgError:
-            raise Exception()
+        # orthogonalize weight matrix
+        self.orthogonalize()
 
-        # curr_state = self.state.icaweights
-        self.state.icaweights = np.matmul(np.matmul(la.solve(np.diag((np.sqrt(np.abs(D)) * np.sign(D))).T, V.T).T,
-                                                    V.T), self.state.icaweights)
 
-        # print('ciao')
+class ORICA_W(ORICACore):
+    def __init__(self, data, numpass=1, weights=None, sphering='offline', lambda_0=0.995, block_white=8, block_ica=8, nsub=0,
+                 forgetfac='cooling', localstat=np.inf, ffdecayrate=0.6, evalconverg=True, verbose=False, mu=0, eta=0,
+                 adjacency=None, regmode='L1', dtype=np.float64):
+        '''ORICA with per-sample updates of the unmixing matrix W (see ORICACore for the parameters).'''
+        ORICACore.__init__(self, data, numpass=numpass, weights=weights, sphering=sphering, lambda_0=lambda_0,
+                           block_white=block_white, block_ica=block_ica, nsub=nsub, forgetfac=forgetfac,
+                           localstat=localstat, ffdecayrate=ffdecayrate, evalconverg=evalconverg, verbose=verbose,
+                           mu=mu, eta=eta, adjacency=adjacency, regmode=regmode, dtype=dtype, rule='W',
+                           block_update=False)
 
-        # # orthogonalize weight matrix (A.T)
-        # try:
-        #     D, V = eigh(np.matmul(self.state.icaweights.T, self.state.icaweights))
-        # except LinAlgError:
-        #     raise Exception()
-        #
-        # # curr_state = self.state.icaweights
-        # self.state.icaweights = np.matmul(np.matmul(la.solve(np.diag((np.sqrt(np.abs(D)) * np.sign(D))).T, V.T).T,
-        #                                             V.T), self.state.icaweights.T).T
 
+class ORICA_A(ORICACore):
+    def __init__(self, data, numpass=1, weights=None, sphering='offline', lambda_0=0.995, block_white=8, block_ica=8, nsub=0,
+                 forgetfac='cooling', localstat=np.inf, ffdecayrate=0.6, evalconverg=True, verbose=False, mu=0, eta=0,
+                 adjacency=None, regmode='L1', dtype=np.float64):
+        '''ORICA with per-sample updates of the mixing matrix A (see ORICACore for the parameters).'''
+        ORICACore.__init__(self, data, numpass=numpass, weights=weights, sphering=sphering, lambda_0=lambda_0,
+                           block_white=block_white, block_ica=block_ica, nsub=nsub, forgetfac=forgetfac,
+                           localstat=localstat, ffdecayrate=ffdecayrate, evalconverg=evalconverg, verbose=verbose,
+                           mu=mu, eta=eta, adjacency=adjacency, regmode=regmode, dtype=dtype, rule='A',
+                           block_update=False)
 
-    def genCoolingFF(self, t, gamma, lambda_0):
-        lambda_ = lambda_0 / (t ** gamma)
-        return lambda_
 
-    def genAdaptiveFF(self, dataRange, lambda_, ratioOfNormRn):
-        decayRateAlpha = self.adaptiveFF['decayRateAlpha']
-        upperBoundBeta = self.adaptiveFF['upperBoundBeta']
-        transBandWidthGamma = self.adaptiveFF['transBandWidthGamma']
-        transBandCenter = self.adaptiveFF['transBandCenter']
+class ORICA_W_block(ORICACore):
+    def __init__(self, data, numpass=1, weights=None, sphering='offline', lambda_0=0.995, block_white=8, block_ica=8, nsub=0,
+                 forgetfac='cooling', localstat=np.inf, ffdecayrate=0.6, evalconverg=True, verbose=False, mu=0, eta=0,
+                 adjacency=None, regmode='L1', dtype=np.float64):
+        '''ORICA with block updates of the unmixing matrix W (see ORICACore for the parameters).'''
+        ORICACore.__init__(self, data, numpass=numpass, weights=weights, sphering=sphering, lambda_0=lambda_0,
+                           block_white=block_white, block_ica=block_ica, nsub=nsub, forgetfac=forgetfac,
+                           localstat=localstat, ffdecayrate=ffdecayrate, evalconverg=evalconverg, verbose=verbose,
+                           mu=mu, eta=eta, adjacency=adjacency, regmode=regmode, dtype=dtype, rule='W',
+                           block_update=True)
 
-        gainForErrors = upperBoundBeta * 0.5 * (1 + np.tanh((ratioOfNormRn - transBandCenter) / transBandWidthGamma))
-        def f(n):
-            return  (1 + gainForErrors) ** n * lambda_[-1] - decayRateAlpha * ((1 + gainForErrors) ** (2 * n - 1) -
-                                                                               (1 + gainForErrors) ** (n - 1)) / \
-                                                                                gainForErrors * lambda_[-1] **2
-        lambda_ = f(range(len(dataRange)))
 
-        return lambda_
+class ORICA_A_block(ORICACore):
+    def __init__(self, data, numpass=1, weights=None, sphering='offline', lambda_0=0.995, block_white=8, block_ica=8, nsub=0,
+                 forgetfac='cooling', localstat=np.inf, ffdecayrate=0.6, evalconverg=True, verbose=False, mu=0, eta=0,
+                 adjacency=None, regmode='L1', dtype=np.float64):
+        '''ORICA with block updates of the mixing matrix A (see ORICACore for the parameters).'''
+        ORICACore.__init__(self, data, numpass=numpass, weights=weights, sphering=sphering, lambda_0=lambda_0,
+                           block_white=block_white, block_ica=block_ica, nsub=nsub, forgetfac=forgetfac,
+                           localstat=localstat, ffdecayrate=ffdecayrate, evalconverg=evalconverg, verbose=verbose,
+                           mu=mu, eta=eta, adjacency=adjacency, regmode=regmode, dtype=dtype, rule='A',
+                           block_update=True)
 
 
 def computeRegularizationFactor(W, mode='L1', return_value=True, **kwargs):
@@ -2079,15 +2669,12 @@ def computeRegularizationFactor(W, mode='L1', return_value=True, **kwargs):
         dS = 2. * (A_cap - A_adj)  * (M_1 - A_der)
 
     elif mode == 'smooth_simple':
-        W_mat = np.zeros(W.shape)
+        A = adjacency_operator(adj_graph, W.shape[1])
+        W_mat = A.dot(W.T).T
         S = []
-        for i, comp in enumerate(W_mat):
-            ss = 0
-            for j, adj in enumerate(adj_graph):
-                W_mat[i, j] = 1. / len(adj) * np.sum(W[i, adj])
-                if return_value:
-                    ss += 1. / len(adj) * np.sum([(W[i, j] - W[i, ad]) ** 2 for ad in adj])
-            S.append(ss)
+        if return_value:
+            # sum_j mean_{k in adj[j]} (W[i, j] - W[i, k])^2
+            S = list(np.sum(W ** 2 - 2 * W * W_mat + A.dot((W ** 2).T).T, axis=1))
         dS = 2. * (W - W_mat)
 
     return dS.T, S
@@ -2095,7 +2682,8 @@ def computeRegularizationFactor(W, mode='L1', return_value=True, **kwargs):
 
 
 def instICA(X, n_comp='all', n_chunks=1, chunk_size=None, numpass=1, block_size=2000, mode='original',
-            adjacency_graph=None, mu=0):
+            adjacency_graph=None, mu=0, dtype=np.float64, chunk_mode='random', threshold=5, noise_fraction=0.2,
+            seed=None, project_size=100000, sources_file=None):
     """Performs instantaneous ICA.
 
     Parameters
@@ -2104,10 +2692,33 @@ def instICA(X, n_comp='all', n_chunks=1, chunk_size=None, numpass=1, block_size=
         2d array of analog signals (N x T)
     n_comp : int or 'all'
              number of ICA components
+    n_chunks : int
+               if > 1, ORICA is fit on n_chunks non-overlapping chunks of chunk_size samples (see
+               tools.select_chunks) and the whole recording is then projected in chunks
+    chunk_size : int
+                 number of samples per chunk
+    mode : 'original', 'W_block' or 'A_block'
+           ORICA, or block updates of the unmixing (ORICA_W_block) or mixing (ORICA_A_block) matrix. The block
+           modes separate all channels
+    dtype : np.float64 or np.float32
+            floating point type of the ORICA computations
+    chunk_mode : 'random' or 'activity'
+                 uniform chunk placement or chunks around threshold crossings plus a noise fraction
+    threshold : float
+                threshold (in robust standard deviations) of the 'activity' chunk selection
+    noise_fraction : float
+                     fraction of random (noise) chunks in 'activity' mode
+    seed : int
+           random seed of the chunk selection
+    project_size : int
+                   number of samples projected at a time on the sources
+    sources_file : str
+                   if given, sources are written to a memmapped .npy file (X can be a memmap, e.g.
+                   np.load('recordings.npy', mmap_mode='r'): with n_chunks > 1 only the chunks are loaded in memory)
 
     Returns
     -------
-    sources : sources
+    sources : sources (memmap if sources_file is given)
     A : mixing matrix
     W : unmixing matrix
 
@@ -2121,41 +2732,39 @@ def instICA(X, n_comp='all', n_chunks=1, chunk_size=None, numpass=1, block_size=
         if chunk_size is None:
             raise AttributeError('Chunk size (n_samples) is required')
         else:
-            assert chunk_size*n_chunks < n_obs
-            chunk_init = []
-            idxs = []
-            for c in range(n_chunks):
-                proceed = False
-                i = 0
-                while not proceed and i<1000:
-                    c_init = np.random.randint(n_obs-n_chunks-1)
-                    proceed = True
-                    for prev_c in chunk_init:
-                        if c_init > prev_c and c_init < c_init + chunk_size:
-                            proceed = False
-                            i += 1
-                            print('failed ', i)
-
-                idxs.extend(range(c_init, c_init + chunk_size))
-
+            idxs = select_chunks(X, n_chunks, chunk_size, mode=chunk_mode, threshold=threshold,
+                                 noise_fraction=noise_fraction, seed=seed)
             X_reduced = X[:, idxs]
-            print(X_reduced.shape)
     else:
         X_reduced = X
 
     if mode == 'original':
         orica = ORICA(X_reduced, ndim=n_comp, onlineWhitening=False, verbose=True, numpass=numpass,
-                      block_white=block_size, block_ica=block_size, adjacency=adjacency_graph, mu=mu)
-    elif mode == 'W_block':
-        orica = ORICA(X_reduced, ndim=n_comp, sphering='offline', verbose=True, numpass=numpass,
-                      block_white=block_size, block_ica=block_size, adjacency=adjacency_graph, mu=mu)
-    elif mode == 'A_block':
-        orica = ORICA(X_reduced, ndim=n_comp, sphering='offline', verbose=True, numpass=numpass,
-                      block_white=block_size, block_ica=block_size, adjacency=adjacency_graph, mu=mu)
+                      block_white=block_size, block_ica=block_size, adjacency=adjacency_graph, mu=mu, dtype=dtype)
+    elif mode in ['W_block', 'A_block']:
+        if n_comp != X.shape[0]:
+            raise AttributeError("'" + mode + "' mode separates all channels (n_comp='all')")
+        if mode == 'W_block':
+            orica_class = ORICA_W_block
+        else:
+            orica_class = ORICA_A_block
+        orica = orica_class(X_reduced, sphering='offline', verbose=True, numpass=numpass, block_white=block_size,
+                            block_ica=block_size, adjacency=adjacency_graph, mu=mu, dtype=dtype)
     else:
-        raise Exception('Unrecognized orica type')
+        raise AttributeError("Unknown ORICA mode: " + str(mode) + " (use 'original', 'W_block' or 'A_block')")
 
-    sources = orica.y
+    if n_chunks > 1 or sources_file is not None:
+        if sources_file is not None:
+            sources = np.lib.format.open_memmap(sources_file, mode='w+', dtype=orica.dtype,
+                                                shape=(orica.unmixing.shape[0], n_obs))
+        else:
+            sources = np.zeros((orica.unmixing.shape[0], n_obs), dtype=orica.dtype)
+        for start in range(0, n_obs, project_size):
+            sources[:, start:start + project_size] = orica.transform(X[:, start:start + project_size])
+        if sources_file is not None:
+            sources.flush()
+    else:
+        sources = orica.y
     A = orica.mixing
     W = orica.unmixing
 
@@ -2189,21 +2798,35 @@ def cICAemb(X, n_comp='all', L=3):
     """
     #TODO reduce number of sources to n_chan (not L*n_chan)
     n_chan = X.shape[0]
-    X_block = np.zeros((L*n_chan, X.shape[1]-L))
-    for ch in range(n_chan):
-        for lag in range(L):
-            if lag == 0:
-                X_block[L * ch + lag, :] = X[ch, L-lag:]
-            else:
-                X_block[L * ch + lag, :] = X[ch, L - lag:-lag]
+    n_feat = L * n_chan
+    # the lagged matrix (L*n_chan x T-L) is never materialized: sphering statistics, ORICA blocks and source
+    # projections are computed on chunks of the strided embedding
+    emb = delay_embedding(X, L)
+    n_samples = emb.shape[2]
+    block = 2000
+    numpass = 3
 
     if n_comp == 'all':
-        n_comp = X_block.shape[0]
-
-    orica = ORICA(X_block, sphering='offline', verbose=True, numpass=3,
-                  block_white=2000, block_ica=2000)
-
-    sources = orica.y
+        n_comp = n_feat
+
+    # offline PCA sphering from the chunked covariance
+    means, cov = embedding_stats(emb)
+    eigvals, eigvecs = eigh(cov)
+    eigvals, eigvecs = eigvals[::-1], eigvecs[:, ::-1]
+    sphere = np.matmul(np.diag(1. / np.sqrt(eigvals)), eigvecs.T)
+
+    orica = ORICA(n_chans=n_feat, sphere=sphere, verbose=True, numpass=numpass,
+                  block_white=block, block_ica=block)
+    orica.means = means
+    for it in range(numpass):
+        for start in range(0, n_samples, block):
+            orica.partial_fit(emb[:, :, start:start + block].reshape(n_feat, -1))
+        orica.flush()
+    orica.updateOutputs()
+
+    sources = np.zeros((n_feat, n_samples), dtype=orica.dtype)
+    for start in range(0, n_samples, block):
+        sources[:, start:start + block] = orica.transform(emb[:, :, start:start + block].reshape(n_feat, -1))
     A = orica.mixing
     W = orica.unmixing
 
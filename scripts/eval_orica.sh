@@ -6,7 +6,7 @@ oricamod='A_block W_block original'
 chdir=$PWD
 
 if [ $# == 0 ]; then
-    echo "Supply rec electrode folder (includeing final /), mode (block - ff - reg)"
+    echo "Supply rec electrode folder (includeing final /), mode (block - ff - reg - sweep - ica)"
 elif [ $# == 2 ]; then
     folder=$1
     analysis=$2
@@ -79,6 +79,17 @@ elif [ $# == 2 ]; then
             done
         done
 
+    elif [ $analysis == 'sweep' ]; then
+        echo 'FF analysis (single pass sweep, original ORICA)'
+        ff='cooling,constant'
+        lambda='N,5,3,0.995,0.5,0.1,0.005,0.00001'
+        bl=50
+
+        for r in $recordings
+        do
+            python ../sweep_ORICA.py -r $folder$r -block $bl -ff $ff -lambda $lambda -resfile results_sweep.csv
+        done
+
     elif [ $analysis == 'ica' ]; then
         echo 'Running FastICA'
 
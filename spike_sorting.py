@@ -28,7 +28,8 @@ root_folder = os.getcwd()
 class SpikeSorter:
     def __init__(self, save=False, rec_folder=None, alg=None, lag=None, gfmode=None, duration=None,
                  tstart=None, tstop=None, run_ss=None, plot_figures=True, merge_spikes=False, mu=0, eta=0,
-                 npass=1, block=1000, feat='pca', clust='mog', keepall=True, ndim=None, eval=False):
+                 npass=1, block=1000, feat='pca', clust='mog', keepall=True, ndim=None, eval=False, dtype=None,
+                 mmap=False):
         '''
 
         Parameters
@@ -51,8 +52,15 @@ class SpikeSorter:
         feat
         clust
         keepall
+        dtype          floating point type recordings are loaded with and of the ORICA computations (e.g. np.float32
+                       halves memory). If None, recordings are loaded as stored and ORICA runs in float64
+        mmap           if True, recordings.npy is memory-mapped (read-only, not cast to dtype) and ICA is fit on
+                       activity-selected chunks of the recording; sources are projected in chunks to ica/sources.npy
+                       (memmap), so that recordings larger than memory can be processed
         '''
         self.rec_folder = rec_folder
+        self.dtype = dtype
+        self.mmap = mmap
         self.rec_name = os.path.split(rec_folder)[-1]
         if self.rec_name == '':
             split = os.path.split(rec_folder)[0]
@@ -90,7 +98,7 @@ class SpikeSorter:
         self.minimum_spikes_per_cluster = 15
 
         if 'exp' in self.rec_folder:
-            self.recordings = np.load(join(self.rec_folder, 'recordings.npy')) #.astype('int16')
+            self.recordings = self.load_recordings()
             rec_info = [f for f in os.listdir(self.rec_folder) if '.yaml' in f or '.yml' in f][0]
             with open(join(self.rec_folder, rec_info), 'r') as f:
                 self.info = yaml.load(f)
@@ -125,7 +133,7 @@ class SpikeSorter:
 
         elif self.rec_name.startswith('recording'):
             self.gtst = np.load(join(self.rec_folder, 'spiketrains.npy'))
-            self.recordings = np.load(join(self.rec_folder, 'recordings.npy')) #.astype('int16')
+            self.recordings = self.load_recordings()
             self.templates = np.load(join(self.rec_folder, 'templates.npy'))
             self.templates_cat = np.load(join(self.rec_folder, 'templates_cat.npy'))
             self.templates_loc = np.load(join(self.rec_folder, 'templates_loc.npy'))
@@ -295,9 +303,19 @@ class SpikeSorter:
                 self.ica_folder = join(self.rec_folder, 'ica')
 
                 chunk_size = int(2*pq.s * self.fs.rescale('Hz'))
-                n_chunks = 1
-                self.s_ica, self.A_ica, self.W_ica = ica.instICA(self.recordings, n_comp=self.ndim,
-                                                                 n_chunks=n_chunks, chunk_size=chunk_size)
+                n_chunks = int(np.min([30, self.recordings.shape[1] // chunk_size]))
+                if self.mmap and n_chunks > 1:
+                    # fit on (at most) 60 s of activity-selected chunks, sources projected to disk
+                    self.s_ica, self.A_ica, self.W_ica = ica.instICA(self.recordings, n_comp=self.ndim,
+                                                                     n_chunks=n_chunks, chunk_size=chunk_size,
+                                                                     chunk_mode='activity',
+                                                                     sources_file=join(self.ica_folder,
+                                                                                       'sources.npy'))
+                else:
+                    # whole recording (shorter than two chunks with mmap, so it fits in memory)
+                    n_chunks = 1
+                    self.s_ica, self.A_ica, self.W_ica = ica.instICA(self.recordings, n_comp=self.ndim,
+                                                                     n_chunks=n_chunks, chunk_size=chunk_size)
                 print('ICA Finished. Elapsed time: ', time.time() - t_start, ' sec.')
 
                 # clean sources based on skewness and correlation
@@ -569,7 +587,8 @@ class SpikeSorter:
                 n_chunks = 1
                 self.s_orica, self.A_orica, self.W_orica = orICA.instICA(self.recordings, n_comp=self.ndim,
                                                                          n_chunks=n_chunks, chunk_size=chunk_size,
-                                                                         numpass=npass, block_size=block, mode='original')
+                                                                         numpass=npass, block_size=block, mode='original',
+                                                                         dtype=self.dtype)
 
                 # self.avg_smoothing = []
                 # for i in range(self.recordings.shape[0]):
@@ -996,7 +1015,7 @@ class SpikeSorter:
                                                numpass=1, block=self.block, step_size=self.step,
                                                skew_window=self.skew_window, pca_window=self.pca_window,
                                                ica_window=self.ica_window, verbose=True,
-                                               detect_trheshold=10, onlineDetection=False)
+                                               detect_trheshold=10, onlineDetection=False, dtype=self.dtype)
 
                 # self.ori = orICA.onlineORICAss(self.recordings, fs=self.fs, forgetfac='cooling',
                 #                                skew_thresh=self.skew_thresh_online, lambda_0=0.995,
@@ -1771,6 +1790,15 @@ class SpikeSorter:
                 ax1, ax2 = plot_matched_raster(self.gtst, self.sst, self.pairs)
 
 
+    def load_recordings(self):
+        '''Loads recordings.npy, cast to dtype if given (memory-mapped and not cast if mmap is True)'''
+        if self.mmap:
+            return np.load(join(self.rec_folder, 'recordings.npy'), mmap_mode='r')
+        recordings = np.load(join(self.rec_folder, 'recordings.npy')) #.astype('int16')
+        if self.dtype is not None:
+            recordings = recordings.astype(self.dtype, copy=False)
+        return recordings
+
     def plot_results(self):
         fig = plt.figure()
         ax1 = fig.add_subplot(211)
@@ -1876,6 +1904,12 @@ if __name__ == '__main__':
         eval = True
     else:
         eval = False
+    if '-dtype' in sys.argv:
+        pos = sys.argv.index('-dtype')
+        dtype = sys.argv[pos + 1]
+    else:
+        dtype = None
+    mmap = '-mmap' in sys.argv
 
     debug = False
     if debug:
@@ -1891,7 +1925,8 @@ if __name__ == '__main__':
               '- kilosort - mountainsort - spykingcircus  -yass\n   -dur duration in s\n   -tstart start time in s\n' \
               '   -tstop stop time in s\n   -M   number of dimensions\n   -thresh threshold for spike detection\n' \
               '   -block ORICA block size\n   -feat amp|pca feature to use for clustering\n   -clust mog|kmeans ' \
-              'clustering algorithm\n   -nokeep only keep largest cluster')
+              'clustering algorithm\n   -nokeep only keep largest cluster\n   -dtype float32|float64 precision of ' \
+              'recordings and ORICA\n   -mmap memory-map recordings and write ICA sources to disk')
 
     elif '-r' not in sys.argv and not debug:
         raise AttributeError('Provide model folder for data')
@@ -1899,4 +1934,4 @@ if __name__ == '__main__':
         sps = SpikeSorter(save=save, rec_folder=rec_folder, alg=mod, duration=dur,
                           tstart=tstart, tstop=tstop, run_ss=spikesort, plot_figures=plot_figures,
                           merge_spikes=merge_spikes, mu=mu, eta=eta, npass=npass, block=block, feat=feat,
-                          clust=clust, keepall=keepall, ndim=ndim, eval=eval)
\ No newline at end of file
+                          clust=clust, keepall=keepall, ndim=ndim, eval=eval, dtype=dtype, mmap=mmap)
\ No newline at end of file
@@ -0,0 +1,111 @@
+'''
+ORICA parameter sweep on a gtICA recording: all the forgetting factor x lambda_0 x mu x numpass configurations of a
+block size are run in a single pass through the data (see orICA.ORICASweep)
+'''
+from __future__ import print_function
+
+import numpy as np
+import os, sys
+from os.path import join
+import time
+import yaml
+import pandas as pd
+
+import orICA as orica
+from tools import extract_adjacency
+
+
+if __name__ == '__main__':
+    if '-r' in sys.argv:
+        pos = sys.argv.index('-r')
+        folder = sys.argv[pos + 1]
+    else:
+        raise Exception('Indicate recording folder -r')
+    if '-block' in sys.argv:
+        pos = sys.argv.index('-block')
+        blocks = [int(b) for b in sys.argv[pos + 1].split(',')]
+    else:
+        blocks = [50]
+    if '-ff' in sys.argv:
+        pos = sys.argv.index('-ff')
+        ffs = sys.argv[pos + 1].split(',')
+    else:
+        ffs = ['cooling', 'constant']
+    if '-lambda' in sys.argv:
+        pos = sys.argv.index('-lambda')
+        lambdas = sys.argv[pos + 1].split(',')
+    else:
+        lambdas = ['N', '5', '3', '0.995', '0.5', '0.1', '0.005', '0.00001']
+    if '-mu' in sys.argv:
+        pos = sys.argv.index('-mu')
+        mus = [float(m) for m in sys.argv[pos + 1].split(',')]
+    else:
+        mus = [0]
+    if '-npass' in sys.argv:
+        pos = sys.argv.index('-npass')
+        npasses = [int(n) for n in sys.argv[pos + 1].split(',')]
+    else:
+        npasses = [1]
+    if '-M' in sys.argv:
+        pos = sys.argv.index('-M')
+        ndim = int(sys.argv[pos + 1])
+    else:
+        ndim = 'all'
+    if '-resfile' in sys.argv:
+        pos = sys.argv.index('-resfile')
+        resfile = sys.argv[pos + 1]
+    else:
+        resfile = 'results_sweep.csv'
+
+    folder = os.path.abspath(folder)
+    print(folder)
+
+    recordings = np.load(join(folder, 'recordings.npy')).astype('float')
+    mixing = np.load(join(folder, 'mixing.npy')).T
+
+    if np.any(np.array(mus) != 0):
+        import MEAutility as MEA
+        rec_info = [f for f in os.listdir(folder) if '.yaml' in f or '.yml' in f][0]
+        with open(join(folder, rec_info), 'r') as f:
+            info = yaml.load(f)
+        electrode_name = info['General']['electrode name']
+        mea_pos, mea_dim, mea_pitch = MEA.return_mea(electrode_name)
+        adj_graph = extract_adjacency(mea_pos, np.max(mea_pitch) + 5)
+    else:
+        adj_graph = None
+
+    configs = []
+    for ff in ffs:
+        for lambda_v in lambdas:
+            if lambda_v == 'N':
+                lambda_val = 1. / recordings.shape[1]
+            else:
+                lambda_val = float(lambda_v)
+            for mu in mus:
+                for npass in npasses:
+                    configs.append({'forgetfac': ff, 'lambda_0': lambda_val, 'mu': mu, 'numpass': npass})
+
+    results = []
+    for block_size in blocks:
+        print('Block size: ', block_size, ' - ', len(configs), ' configurations')
+        t_start = time.time()
+        sweep = orica.ORICASweep(recordings, configs, block=block_size, ndim=ndim, adjacency=adj_graph,
+                                 verbose=True)
+        proc_time = time.time() - t_start
+        for res in sweep.evaluate(mixing):
+            res.update({'block': block_size, 'time': proc_time / len(configs)})
+            results.append(res)
+            print(res)
+
+    df = pd.DataFrame(results)
+    if not os.path.isfile(join(folder, resfile)):
+        print('Saving to ', join(folder, resfile))
+        with open(join(folder, resfile), 'w') as f:
+            df.to_csv(f)
+    else:
+        with open(join(folder, resfile), 'r') as f:
+            new_index = len(pd.read_csv(f))
+        df.index = np.arange(new_index, new_index + len(df))
+        print('Appending to ', join(folder, resfile))
+        with open(join(folder, resfile), 'a') as f:
+            df.to_csv(f, header=False)
@@ -57,6 +57,110 @@ def whiten_data(X, n_comp=None):
 
     return np.transpose(data), eigvecs, eigvals, sphere
 
+def delay_embedding(X, L):
+    '''Zero-copy delay embedding of X for convolutive ICA.
+
+    Parameters
+    ----------
+    X: nchans x nsamples
+    L: number of lags
+
+    Returns
+    -------
+    emb: read-only strided view (nchans x L x nsamples-L) with emb[ch, lag] = X[ch, L-lag:nsamples-lag].
+         emb[:, :, t0:t1].reshape(nchans*L, -1) materializes only samples t0:t1 of the (L*ch + lag)-ordered lagged
+         matrix used by cICAemb
+    '''
+    from numpy.lib.stride_tricks import as_strided
+
+    n_chan, n_samples = X.shape
+    s_ch, s_t = X.strides
+    return as_strided(X[:, L:], shape=(n_chan, L, n_samples - L), strides=(s_ch, -s_t, s_t), writeable=False)
+
+def embedding_stats(emb, chunk_size=10000):
+    '''Mean and covariance of a delay embedding, accumulated over chunks of samples (the lagged matrix is never
+    materialized as a whole).
+
+    Parameters
+    ----------
+    emb: delay embedding (nchans x L x nsamples) from delay_embedding()
+    chunk_size: number of samples materialized at a time
+
+    Returns
+    -------
+    means: (nchans*L x 1) means
+    cov: (nchans*L x nchans*L) covariance (normalized by nsamples-1, as np.cov)
+    '''
+    n_chan, L, n_samples = emb.shape
+    n_feat = n_chan * L
+    sums = np.zeros(n_feat)
+    prods = np.zeros((n_feat, n_feat))
+    for start in range(0, n_samples, chunk_size):
+        chunk = emb[:, :, start:start + chunk_size].reshape(n_feat, -1).astype(np.float64)
+        sums += np.sum(chunk, axis=1)
+        prods += np.matmul(chunk, chunk.T)
+    means = sums / n_samples
+    cov = (prods - n_samples * np.outer(means, means)) / (n_samples - 1)
+
+    return means[:, np.newaxis], cov
+
+def select_chunks(X, n_chunks, chunk_size, mode='random', threshold=5, noise_fraction=0.2, seed=None,
+                  n_noise_samples=100000):
+    '''Selects non-overlapping chunks of samples to fit ICA on a subset of a recording.
+
+    The recording is divided in consecutive windows of chunk_size samples and n_chunks windows are drawn without
+    replacement, uniformly ('random') or, in 'activity' mode, preferentially where spikes occur: windows are ranked
+    by the number of threshold crossings (|x - median| > threshold * MAD / 0.6745 on any channel) and the
+    (1 - noise_fraction) * n_chunks most active windows are taken together with noise_fraction * n_chunks random
+    windows among the others (noise sample).
+
+    Parameters
+    ----------
+    X: nchans x nsamples
+    n_chunks: number of chunks
+    chunk_size: number of samples per chunk
+    mode: ['random'|'activity']
+    threshold: detection threshold (in robust standard deviations) for 'activity'
+    noise_fraction: fraction of random (noise) chunks for 'activity'
+    seed: random seed
+    n_noise_samples: number of (evenly spaced) samples used to estimate median and MAD
+
+    Returns
+    -------
+    idxs: sorted sample indices of the selected chunks
+    '''
+    n_obs = X.shape[1]
+    n_windows = n_obs // chunk_size
+    if n_chunks > n_windows:
+        raise AttributeError('Recording is too short for ' + str(n_chunks) + ' chunks of ' + str(chunk_size) +
+                             ' samples')
+    rng = np.random.RandomState(seed)
+
+    if mode == 'random':
+        windows = rng.choice(n_windows, n_chunks, replace=False)
+    elif mode == 'activity':
+        step = int(np.max([1, n_obs // n_noise_samples]))
+        medians = np.median(X[:, ::step], axis=1)
+        thresholds = threshold * np.median(np.abs(X[:, ::step] - medians[:, np.newaxis]), axis=1) / 0.6745
+        # threshold crossings per window, computed over groups of windows to bound memory
+        counts = np.zeros(n_windows)
+        n_group = int(np.max([1, 1000000 // (chunk_size * X.shape[0])]))
+        for w_start in range(0, n_windows, n_group):
+            w_stop = np.min([n_windows, w_start + n_group])
+            block = X[:, w_start * chunk_size:w_stop * chunk_size]
+            above = np.any(np.abs(block - medians[:, np.newaxis]) > thresholds[:, np.newaxis], axis=0)
+            counts[w_start:w_stop] = np.sum(above.reshape(w_stop - w_start, chunk_size), axis=1)
+        n_noise = int(np.round(noise_fraction * n_chunks))
+        ranked = np.argsort(-counts, kind='mergesort')
+        active = ranked[:n_chunks - n_noise]
+        noise = rng.choice(ranked[n_chunks - n_noise:], n_noise, replace=False)
+        windows = np.concatenate((active, noise))
+    else:
+        raise AttributeError('Unknown chunk mode: ' + str(mode))
+
+    windows = np.sort(windows)
+    return (windows[:, np.newaxis] * chunk_size + np.arange(chunk_size)).ravel()
+
 # def whiten_data(X, n_comp=None):
 #     '''
 #
@@ -914,7 +1018,75 @@ def integrate_sources(sources):
     return integ_source
 
 
-def clean_sources(sources, kurt_thresh=0.7, skew_thresh=0.5, remove_correlated=True):
+class RunningMoments():
+    def __init__(self, n_sources):
+        '''Skewness and kurtosis of multiple signals from running power sums.
+
+        Blocks are added with update(). For a sliding window, the samples leaving the window are passed to update()
+        and subtracted, so the cost is O(block) instead of O(window). Samples are shifted by the mean of the first
+        block to limit cancellation in the power sums; reset() recomputes the sums exactly (e.g. to clear the
+        rounding accumulated by the subtractions).
+        '''
+        self.n_sources = n_sources
+        self.sums = np.zeros((4, n_sources))
+        self.count = 0
+        self.shift = None
+
+    def reset(self, data=None):
+        self.sums[:] = 0
+        self.count = 0
+        self.shift = None
+        if data is not None:
+            self.update(data)
+
+    def power_sums(self, data):
+        x = data - self.shift[:, np.newaxis]
+        x2 = x * x
+        return np.array([np.sum(x, axis=1), np.sum(x2, axis=1), np.sum(x2 * x, axis=1), np.sum(x2 * x2, axis=1)])
+
+    def update(self, block, leaving=None):
+        if block.shape[1] == 0:
+            return
+        if self.shift is None:
+            # float64 shift: power sums of float32 blocks are computed in float64
+            self.shift = np.mean(block, axis=1, dtype=np.float64)
+        self.sums += self.power_sums(block)
+        self.count += block.shape[1]
+        if leaving is not None and leaving.shape[1] > 0:
+            self.sums -= self.power_sums(leaving)
+            self.count -= leaving.shape[1]
+
+    def central_moments(self):
+        mean = self.sums[0] / self.count
+        s2 = self.sums[1] / self.count
+        s3 = self.sums[2] / self.count
+        s4 = self.sums[3] / self.count
+        m2 = s2 - mean ** 2
+        m3 = s3 - 3 * mean * s2 + 2 * mean ** 3
+        m4 = s4 - 4 * mean * s3 + 6 * mean ** 2 * s2 - 3 * mean ** 4
+        return m2, m3, m4
+
+    def mean(self):
+        return self.shift + self.sums[0] / self.count
+
+    def skew(self):
+        '''Biased skewness (as scipy.stats.skew). Constant signals have 0 skewness.'''
+        m2, m3, _ = self.central_moments()
+        sk = np.zeros(self.n_sources)
+        nonzero = m2 > 0
+        sk[nonzero] = m3[nonzero] / m2[nonzero] ** 1.5
+        return sk
+
+    def kurtosis(self):
+        '''Biased excess kurtosis (as scipy.stats.kurtosis). Constant signals have 0 kurtosis.'''
+        m2, _, m4 = self.central_moments()
+        ku = np.zeros(self.n_sources)
+        nonzero = m2 > 0
+        ku[nonzero] = m4[nonzero] / m2[nonzero] ** 2 - 3
+        return ku
+
+
+def clean_sources(sources, kurt_thresh=0.7, skew_thresh=0.5, remove_correlated=True, chunk_size=100000):
     '''
 
     Parameters
@@ -922,16 +1094,17 @@ def clean_sources(sources, kurt_thresh=0.7, skew_thresh=0.5, remove_correlated=T
     s
     corr_thresh
     skew_thresh
+    chunk_size: number of samples per chunk to accumulate skewness and kurtosis (sources can be memmapped)
 
     Returns
     -------
 
     '''
-    import scipy.stats as stat
-    import scipy.signal as ss
-
-    sk = stat.skew(sources, axis=1)
-    ku = stat.kurtosis(sources, axis=1)
+    moments = RunningMoments(sources.shape[0])
+    for start in range(0, sources.shape[1], chunk_size):
+        moments.update(sources[:, start:start + chunk_size])
+    sk = moments.skew()
+    ku = moments.kurtosis()
 
     high_sk = np.where(np.abs(sk) >= skew_thresh)[0]
     low_sk = np.where(np.abs(sk) < skew_thresh)[0]
@@ -977,7 +1150,7 @@ def clean_sources(sources, kurt_thresh=0.7, skew_thresh=0.5, remove_correlated=T
     # source_idx = high_sk
 
     spike_sources = sources[idxs]
-    sk_sp = stat.skew(spike_sources, axis=1)
+    sk_sp = sk[idxs]
 
     # invert sources with positive skewness
     spike_sources[sk_sp > 0] = -spike_sources[sk_sp > 0]